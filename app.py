@@ -1,29 +1,1096 @@
 import os
+
+# Асинхронный режим: BRIDGE_ASYNC_MODE=eventlet|gevent. Ожидание ответа Pi не держит поток,
+# тысячи запросов в полете обслуживаются зелеными потоками. Патчить стандартную библиотеку
+# нужно до остальных импортов. По умолчанию - обычные потоки (локальная разработка)
+ASYNC_MODE = os.environ.get('BRIDGE_ASYNC_MODE', 'threading')
+if ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+elif ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+import atexit
+import base64
+import csv
+import gzip
+import io
+import hashlib
+import mimetypes
 import logging
+import re
+import shutil
+import socket
 import sqlite3
+import tempfile
 import uuid
 import json
+import zipfile
+import zlib
+import heapq
 import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import chain, islice
 from datetime import datetime
-from flask import Flask, request, jsonify, session, redirect, render_template_string
-from flask_socketio import SocketIO, emit
+from flask import Flask, Response, request, jsonify, session, redirect, render_template, stream_with_context
+from flask_socketio import SocketIO, join_room
+
+import wire
+
+# SQLite блокирует поток ОС целиком: в асинхронном режиме запросы к резервной БД уходят
+# в пул настоящих потоков, а соединения привязаны к потоку ОС, а не к зеленому потоку
+if ASYNC_MODE == 'eventlet':
+    from eventlet import patcher, tpool
+    os_thread_local = patcher.original('threading').local
 
-app = Flask(__name__)
+    def run_blocking(func, *args):
+        return tpool.execute(func, *args)
+elif ASYNC_MODE == 'gevent':
+    import gevent
+    os_thread_local = monkey.get_original('threading', 'local')
+
+    def run_blocking(func, *args):
+        return gevent.get_hub().threadpool.apply(func, args)
+else:
+    os_thread_local = threading.local
+
+    def run_blocking(func, *args):
+        return func(*args)
+
+app = Flask(__name__, static_folder=None)
 app.secret_key = os.environ.get('SECRET_KEY', 'school-secret-2024')
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=ASYNC_MODE)
+
+class PiTimeoutError(Exception):
+    """Raspberry Pi не ответил до дедлайна"""
+
+
+class PiOverloadedError(Exception):
+    """Очередь команд к Raspberry Pi переполнена: запрос отклонен сразу, а не по таймауту"""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# Реестр запросов, ожидающих ответа от Raspberry Pi
+class PendingRequest:
+    """Ожидаемый ответ на одну команду (future с дедлайном)"""
+
+    def __init__(self, request_id, pi_id, command, timeout):
+        self.request_id = request_id
+        self.pi_id = pi_id
+        self.command = command
+        self.deadline = time.monotonic() + timeout
+        self.response = None
+        self.error = None
+        # Отправка Pi и его ответ: задержка Pi без ожидания в планировщике
+        self.sent_at = None
+        self.answered_at = None
+        # Освобождает место в планировщике, когда запрос снят с учета
+        self.on_finish = None
+        self._event = threading.Event()
+
+    def resolve(self, response):
+        self.response = response
+        self.answered_at = time.perf_counter()
+        self._event.set()
+
+    def fail(self, error):
+        self.error = error
+        self._event.set()
+
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self):
+        """Блокирует поток до ответа или дедлайна, возвращает True если ответ пришел"""
+        return self._event.wait(max(0, self.deadline - time.monotonic()))
+
+    def result(self):
+        """Ответ или ошибка запроса, который уже снят с учета: событие вот-вот выставят"""
+        self._event.wait()
+        if self.error:
+            raise self.error
+        return self.response
+
+    def round_trip(self):
+        """Секунды от отправки команды до ответа Pi"""
+        return self.answered_at - self.sent_at
+
+
+class RequestRegistry:
+    """Запросы к Raspberry Pi в полете: ответ доставляется сразу из handle_raspberry_response"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = {}
+        self.completed = 0
+        self.timed_out = 0
+        self.late = 0
+
+    def __len__(self):
+        return len(self._requests)
+
+    def __contains__(self, request_id):
+        return request_id in self._requests
+
+    def get(self, request_id):
+        return self._requests.get(request_id)
+
+    def register(self, pi_id, command, timeout, on_finish=None):
+        pending = PendingRequest(str(uuid.uuid4()), pi_id, command, timeout)
+        pending.on_finish = on_finish
+        with self._lock:
+            self._requests[pending.request_id] = pending
+        return pending
+
+    @staticmethod
+    def _finish(pending):
+        if pending.on_finish:
+            pending.on_finish()
+
+    def resolve(self, request_id, response):
+        """Передает ответ ожидающему потоку; опоздавшие и чужие ответы отбрасываются"""
+        with self._lock:
+            pending = self._requests.pop(request_id, None)
+            if pending is None:
+                self.late += 1
+                return False
+            self.completed += 1
+        self._finish(pending)
+        pending.resolve(response)
+        return True
+
+    def cancel(self, pending):
+        """Снимает с учета запрос, который не удалось отправить"""
+        with self._lock:
+            if self._requests.pop(pending.request_id, None) is None:
+                return
+        self._finish(pending)
+
+    def wait(self, pending):
+        """Ждет ответ на запрос; по истечении дедлайна снимает его с учета и поднимает Timeout"""
+        if pending.wait():
+            return pending.result()
+
+        with self._lock:
+            # Ответ или обрыв связи мог прийти между wait() и захватом блокировки:
+            # resolve/drop_pi уже сняли запрос, но результат выставляют после _finish
+            finished = self._requests.pop(pending.request_id, None) is None
+            if not finished:
+                self.timed_out += 1
+        if finished:
+            return pending.result()
+        self._finish(pending)
+        raise PiTimeoutError("Timeout")
+
+    def drop_pi(self, pi_id):
+        """Снимает с учета запросы к отключившемуся Raspberry Pi"""
+        with self._lock:
+            orphaned = [p for p in self._requests.values() if p.pi_id == pi_id]
+            for pending in orphaned:
+                del self._requests[pending.request_id]
+        for pending in orphaned:
+            self._finish(pending)
+            pending.fail(Exception("Raspberry Pi disconnected"))
+        return len(orphaned)
+
+    def stats(self):
+        return {
+            'in_flight': len(self._requests),
+            'completed': self.completed,
+            'timed_out': self.timed_out,
+            'late_responses': self.late
+        }
+
+# Классы приоритета команд к Pi, от высшего к низшему
+PRIORITY_CLASSES = ['write', 'login', 'read', 'sync', 'bulk']
+
+SYNC_COMMANDS = {'sync_batch', 'get_snapshot', 'get_changes'}
+
+# Служебные команды идут мимо очереди: heartbeat должен видеть сам Pi, а не очередь к нему
+UNSCHEDULED_COMMANDS = {'ping'}
+
+PI_MAX_IN_FLIGHT = int(os.environ.get('PI_MAX_IN_FLIGHT', 8))
+PI_QUEUE_SIZE = int(os.environ.get('PI_QUEUE_SIZE', 64))
+PI_QUEUE_WAIT = float(os.environ.get('PI_QUEUE_WAIT', 5))
+
+def command_priority(command, data):
+    """Класс приоритета команды: записи с урока важнее входа, вход важнее чтений, фон - в конце"""
+    if command in BACKUP_WRITE_COMMANDS:
+        return 'write'
+    if command == 'login':
+        return 'login'
+    if command in SYNC_COMMANDS:
+        return 'sync'
+    if command in PAGED_QUERIES:
+        # Весь список или страницы потоковой выгрузки
+        limit = (data or {}).get('limit')
+        if (not limit and command == 'get_all_students') or (limit or 0) >= STREAM_PAGE_SIZE:
+            return 'bulk'
+    return 'read'
+
+
+class CommandScheduler:
+    """Ограничивает число команд в полете к каждому Pi, остальные ждут в очереди по приоритету.
+
+    Место занимается при отправке и освобождается, когда запрос снят с учета
+    (ответ, таймаут, отключение Pi), и сразу передается лучшему ожидающему.
+    При полной очереди вытесняется самый низкий класс; если новый запрос
+    не важнее всех ожидающих, отклоняется он сам - быстро, без таймаута.
+    """
+
+    class _Waiter:
+        def __init__(self):
+            self.event = threading.Event()
+            self.granted = False
+            self.shed = False
+
+    def __init__(self, max_in_flight=PI_MAX_IN_FLIGHT, max_queue=PI_QUEUE_SIZE, max_wait=PI_QUEUE_WAIT):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._pis = {}
+        self._seq = 0
+
+    def _pi(self, pi_id):
+        return self._pis.setdefault(pi_id, {'in_flight': 0, 'queue': [], 'queued': 0, 'shed': 0, 'expired': 0})
+
+    def acquire(self, pi_id, priority, timeout):
+        """Ждет места не дольше timeout; PiOverloadedError, если очередь полна или ожидание вышло"""
+        rank = PRIORITY_CLASSES.index(priority)
+        with self._lock:
+            pi = self._pi(pi_id)
+            if pi['in_flight'] < self.max_in_flight and not pi['queue']:
+                pi['in_flight'] += 1
+                return
+            if len(pi['queue']) >= self.max_queue:
+                # Худший ожидающий: низший класс, из равных - пришедший последним
+                victim = max(pi['queue'])
+                if victim[0] <= rank:
+                    pi['shed'] += 1
+                    metrics.inc('scheduler_shed', pi=pi_id, priority=priority)
+                    raise PiOverloadedError(f"Raspberry Pi {pi_id} перегружен")
+                pi['queue'].remove(victim)
+                heapq.heapify(pi['queue'])
+                victim[2].shed = True
+                victim[2].event.set()
+            waiter = self._Waiter()
+            self._seq += 1
+            heapq.heappush(pi['queue'], (rank, self._seq, waiter))
+            pi['queued'] += 1
+
+        started = time.perf_counter()
+        waiter.event.wait(min(timeout, self.max_wait))
+        metrics.add('scheduler_wait_seconds', time.perf_counter() - started, priority=priority)
+        with self._lock:
+            if waiter.granted:
+                return
+            if waiter.shed:
+                pi['shed'] += 1
+                metrics.inc('scheduler_shed', pi=pi_id, priority=priority)
+                raise PiOverloadedError(f"Raspberry Pi {pi_id} перегружен")
+            # Место так и не освободилось: запрос ушел бы на Pi слишком поздно
+            pi['queue'] = [entry for entry in pi['queue'] if entry[2] is not waiter]
+            heapq.heapify(pi['queue'])
+            pi['expired'] += 1
+            metrics.inc('scheduler_expired', pi=pi_id, priority=priority)
+        raise PiOverloadedError(f"Очередь к Raspberry Pi {pi_id} не продвинулась за {min(timeout, self.max_wait):g} с")
+
+    def release(self, pi_id):
+        with self._lock:
+            pi = self._pi(pi_id)
+            if pi['queue']:
+                # Место переходит к ожидающему, счетчик в полете не меняется
+                waiter = heapq.heappop(pi['queue'])[2]
+                waiter.granted = True
+                waiter.event.set()
+            else:
+                pi['in_flight'] = max(0, pi['in_flight'] - 1)
+
+    def stats(self, pi_id):
+        with self._lock:
+            pi = self._pi(pi_id)
+            waiting = {}
+            for rank, _, _ in pi['queue']:
+                waiting[PRIORITY_CLASSES[rank]] = waiting.get(PRIORITY_CLASSES[rank], 0) + 1
+            return {
+                'in_flight': pi['in_flight'],
+                'max_in_flight': self.max_in_flight,
+                'waiting': waiting,
+                'queued': pi['queued'],
+                'shed': pi['shed'],
+                'expired': pi['expired']
+            }
+
+# Кэш справочных данных Raspberry Pi
+CACHE_TTL = {
+    'get_groups': 600,
+    'get_teachers': 600,
+    'get_students': 300,
+    'get_all_students': 300,
+    'get_homework': 60
+}
+
+# Какие кэшированные команды устаревают после успешной записи
+CACHE_INVALIDATION = {
+    'add_group': ['get_groups'],
+    'add_student': ['get_students', 'get_all_students'],
+    'add_teacher': ['get_teachers'],
+    'add_homework': ['get_homework']
+}
+
+
+class ResponseCache:
+    """LRU-кэш ответов Pi с собственным TTL для каждого ключа"""
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # Счетчики сбросов: общий и по командам, см. generation()
+        self._cleared = 0
+        self._generations = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale_puts = 0
+
+    @staticmethod
+    def make_key(pi_id, command, data):
+        return pi_id, command, json.dumps(data or {}, sort_keys=True, ensure_ascii=False)
+
+    def get(self, pi_id, command, data):
+        key = self.make_key(pi_id, command, data)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def generation(self, command):
+        """Снимок счетчика сбросов: берется до запроса к Pi и передается в put"""
+        with self._lock:
+            return self._cleared, self._generations.get(command, 0)
+
+    def put(self, pi_id, command, data, value, ttl, generation=None):
+        """Кладет ответ в кэш; если команду сбросили после снимка generation, ответ мог устареть и не кладется"""
+        key = self.make_key(pi_id, command, data)
+        with self._lock:
+            if generation is not None and generation != (self._cleared, self._generations.get(command, 0)):
+                self.stale_puts += 1
+                return
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, commands=None):
+        """Сбрасывает записи указанных команд (или весь кэш)"""
+        with self._lock:
+            if commands is None:
+                self._cleared += 1
+                removed = len(self._entries)
+                self._entries.clear()
+                return removed
+            for command in commands:
+                self._generations[command] = self._generations.get(command, 0) + 1
+            stale = [key for key in self._entries if key[1] in commands]
+            for key in stale:
+                del self._entries[key]
+            return len(stale)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'stale_puts': self.stale_puts,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0
+        }
+
+class SingleFlight:
+    """Склеивает одинаковые одновременные запросы: к Pi уходит один, результат получают все"""
+
+    class _Call:
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def stats(self):
+        return {
+            'in_flight': len(self._calls),
+            'leaders': self.leaders,
+            'coalesced': self.coalesced
+        }
+
+# Метрики в текстовом формате Prometheus
+class Metrics:
+    """Гистограммы задержек по командам и счетчики событий моста"""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+
+    def observe(self, source, command, seconds):
+        key = (('source', source), ('command', command))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(self.BUCKETS), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    def inc(self, name, **labels):
+        self.add(name, 1, **labels)
+
+    def add(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @staticmethod
+    def _labels(pairs):
+        if not pairs:
+            return ''
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+    def render(self, samples):
+        """samples: список (имя, тип, описание, [(метки, значение), ...]) со снятыми в момент запроса значениями"""
+        lines = []
+        name = 'school_bridge_command_duration_seconds'
+        lines.append(f'# HELP {name} Время выполнения команды (Pi или резервная БД)')
+        lines.append(f'# TYPE {name} histogram')
+        with self._lock:
+            histograms = {k: dict(v, buckets=list(v['buckets'])) for k, v in self._histograms.items()}
+            counters = dict(self._counters)
+        for key, histogram in sorted(histograms.items()):
+            for bound, value in zip(self.BUCKETS, histogram['buckets']):
+                lines.append(f'{name}_bucket{self._labels(key + (("le", bound),))} {value}')
+            lines.append(f'{name}_bucket{self._labels(key + (("le", "+Inf"),))} {histogram["count"]}')
+            lines.append(f'{name}_sum{self._labels(key)} {histogram["sum"]:.6f}')
+            lines.append(f'{name}_count{self._labels(key)} {histogram["count"]}')
+
+        for counter in sorted({name for name, _ in counters}):
+            lines.append(f'# TYPE school_bridge_{counter}_total counter')
+            for (name, labels), value in sorted(counters.items()):
+                if name == counter:
+                    value = f'{value:.6f}' if isinstance(value, float) else value
+                    lines.append(f'school_bridge_{name}_total{self._labels(labels)} {value}')
+
+        for name, kind, description, values in samples:
+            name = f'school_bridge_{name}_total' if kind == 'counter' else f'school_bridge_{name}'
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in values:
+                lines.append(f'{name}{self._labels(tuple(sorted(labels.items())))} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+# Предохранитель связи с Pi: closed - работаем, open - сразу в резерв, half_open - пробный запрос
+BREAKER_CLOSED = 'closed'
+BREAKER_OPEN = 'open'
+BREAKER_HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """Размыкается после серии сбоев или когда Pi стабильно отвечает слишком медленно"""
+
+    def __init__(self, failure_threshold=3, slow_call_seconds=3.0, reset_timeout=15.0):
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.state = BREAKER_CLOSED
+        self.failures = 0
+        self.latency = None
+        self.opened_at = None
+        self.trips = 0
+
+    def _open(self):
+        if self.state != BREAKER_OPEN:
+            self.trips += 1
+        self.state = BREAKER_OPEN
+        self.opened_at = time.monotonic()
+
+    def record_success(self, seconds):
+        """Учитывает успешный ответ; возвращает True, если предохранитель разомкнулся из-за задержки"""
+        with self._lock:
+            # Сглаженная задержка: одиночный медленный ответ не размыкает цепь
+            self.latency = seconds if self.latency is None else 0.3 * seconds + 0.7 * self.latency
+            self.failures = 0
+            if self.latency > self.slow_call_seconds:
+                self._open()
+                return True
+            self.state = BREAKER_CLOSED
+            return False
+
+    def record_failure(self):
+        """Учитывает сбой; возвращает True, если предохранитель разомкнулся"""
+        with self._lock:
+            self.failures += 1
+            if self.state == BREAKER_HALF_OPEN or self.failures >= self.failure_threshold:
+                self._open()
+                return True
+            return False
+
+    def trip(self):
+        with self._lock:
+            self._open()
+
+    def reset(self):
+        with self._lock:
+            self.state = BREAKER_CLOSED
+            self.failures = 0
+            self.latency = None
+
+    def ready_for_probe(self):
+        """Переводит разомкнутый предохранитель в half_open по истечении паузы"""
+        with self._lock:
+            if self.state == BREAKER_OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = BREAKER_HALF_OPEN
+            return self.state != BREAKER_OPEN
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'latency_seconds': round(self.latency, 3) if self.latency is not None else None,
+            'trips': self.trips
+        }
+
+# Несколько процессов моста (воркеры gunicorn): общее состояние и пересылка команд
+BRIDGE_STATE_TTL = float(os.environ.get('BRIDGE_STATE_TTL', 0.5))
+BRIDGE_SOCKET_DIR = os.environ.get('BRIDGE_SOCKET_DIR', os.path.join(tempfile.gettempdir(), 'school-bridge'))
+
+
+class SharedState:
+    """Владелец соединения и резервный режим каждого Pi, общие для всех воркеров.
+
+    Хранятся в резервной БД (bridge_pis); процесс перечитывает их не чаще раза
+    в ttl секунд, собственные изменения видит сразу. Тем же опросом разносится
+    сброс кэша: воркер, увидевший новую версию команды в bridge_cache_versions,
+    сбрасывает ее у себя, - и статус: изменения, сделанные другими воркерами
+    (резервный режим, ход синхронизации), он рассылает своим браузерам.
+    """
+
+    def __init__(self, ttl=BRIDGE_STATE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._pis = {}
+        self._versions = None
+        self._expires = 0.0
+
+    @staticmethod
+    def _load():
+        conn = get_backup_db()
+        pis = {row[0]: SharedState._pi(row[1:])
+               for row in conn.execute('SELECT pi_id, owner, backup_mode, sync_json FROM bridge_pis')}
+        return pis, dict(conn.execute('SELECT command, version FROM bridge_cache_versions'))
+
+    @staticmethod
+    def _pi(row):
+        owner, backup_mode, sync_json = row
+        return {'owner': owner, 'backup_mode': bool(backup_mode), 'sync': json.loads(sync_json) if sync_json else None}
+
+    def refresh(self, force=False):
+        now = time.monotonic()
+        if not force and now < self._expires:
+            return
+        pis, versions = run_blocking(self._load)
+        with self._lock:
+            previous, self._versions = self._versions, versions
+            previous_pis, self._pis = self._pis, pis
+            self._expires = now + self.ttl
+        if previous is None:
+            return
+        if pis != previous_pis:
+            publish_status()
+        changed = {command for command, version in versions.items() if previous.get(command) != version}
+        if '*' in changed:
+            response_cache.invalidate()
+        elif changed:
+            response_cache.invalidate(changed)
+
+    def _get(self, pi_id):
+        self.refresh()
+        return self._pis.get(pi_id) or {'owner': None, 'backup_mode': False, 'sync': None}
+
+    def owner(self, pi_id):
+        return self._get(pi_id)['owner']
+
+    def backup_mode(self, pi_id):
+        return self._get(pi_id)['backup_mode']
+
+    def sync(self, pi_id):
+        return self._get(pi_id)['sync']
+
+    def owned_pis(self):
+        self.refresh()
+        return {pi_id for pi_id, pi in self._pis.items() if pi['owner']}
+
+    @staticmethod
+    def _update(pi_id, sql, params):
+        with backup_transaction(immediate=True) as conn:
+            row = conn.execute('SELECT owner, backup_mode FROM bridge_pis WHERE pi_id = ?', (pi_id,)).fetchone()
+            conn.execute('INSERT OR IGNORE INTO bridge_pis (pi_id, updated_at) VALUES (?, ?)', (pi_id, time.time()))
+            conn.execute(sql, params)
+            current = conn.execute('SELECT owner, backup_mode, sync_json FROM bridge_pis WHERE pi_id = ?', (pi_id,)).fetchone()
+        return row, current
+
+    def _write(self, pi_id, sql, params):
+        row, current = run_blocking(self._update, pi_id, sql, params)
+        with self._lock:
+            pis = dict(self._pis)
+            pis[pi_id] = self._pi(current)
+            self._pis = pis
+        return {'owner': row[0], 'backup_mode': bool(row[1])} if row else {'owner': None, 'backup_mode': False}
+
+    def set_backup_mode(self, pi_id, enabled):
+        """Возвращает прежнее значение резервного режима"""
+        return self._write(pi_id, 'UPDATE bridge_pis SET backup_mode = ?, updated_at = ? WHERE pi_id = ?',
+                           (int(enabled), time.time(), pi_id))['backup_mode']
+
+    def set_sync(self, pi_id, status):
+        self._write(pi_id, 'UPDATE bridge_pis SET sync_json = ?, updated_at = ? WHERE pi_id = ?',
+                    (json.dumps(status, ensure_ascii=False), time.time(), pi_id))
+
+    def claim(self, pi_id, owner):
+        self._write(pi_id, 'UPDATE bridge_pis SET owner = ?, updated_at = ? WHERE pi_id = ?', (owner, time.time(), pi_id))
+
+    def release(self, pi_id, owner):
+        """Снимает владельца, только если Pi тем временем не переподключился к другому воркеру"""
+        self._write(pi_id, 'UPDATE bridge_pis SET owner = NULL, updated_at = ? WHERE pi_id = ? AND owner = ?',
+                    (time.time(), pi_id, owner))
+
+    def prune(self):
+        """Снимает владельцев, чьих сокетов больше нет (процесс завершился)"""
+        for pi_id, owner in query_backup('SELECT pi_id, owner FROM bridge_pis WHERE owner IS NOT NULL'):
+            if not os.path.exists(owner):
+                self.release(pi_id, owner)
+
+    @staticmethod
+    def _bump(commands):
+        with backup_transaction(immediate=True) as conn:
+            conn.executemany('''
+                INSERT INTO bridge_cache_versions (command, version) VALUES (?, 1)
+                ON CONFLICT (command) DO UPDATE SET version = version + 1
+            ''', [(command,) for command in commands])
+            return dict(conn.execute(
+                f"SELECT command, version FROM bridge_cache_versions WHERE command IN ({','.join('?' * len(commands))})",
+                commands
+            ))
+
+    def bump_cache_versions(self, commands=None):
+        commands = sorted(commands) if commands is not None else ['*']
+        versions = run_blocking(self._bump, commands)
+        # Собственный сброс уже выполнен, повторять его при следующем опросе не нужно
+        with self._lock:
+            if self._versions is not None:
+                self._versions = {**self._versions, **versions}
+
+
+class PeerBridge:
+    """Пересылка команд Pi между воркерами через unix-сокеты.
+
+    Pi держит Socket.IO-соединение только с одним воркером. Этот воркер записан
+    владельцем Pi в bridge_pis и принимает на своем сокете команды остальных:
+    одна строка JSON на запрос и одна на ответ. Клиентские соединения
+    переиспользуются, по одному на поток и владельца.
+    """
+
+    def __init__(self, socket_dir):
+        self.address = os.path.join(socket_dir, f'worker-{os.getpid()}.sock')
+        self._local = threading.local()
+        self._started = threading.Event()
+        self.forwarded = 0
+        self.served = 0
+        self.failed = 0
+
+    def start(self):
+        if self._started.is_set():
+            return
+        self._started.set()
+        os.makedirs(os.path.dirname(self.address), exist_ok=True)
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.address)
+        server.listen(64)
+        atexit.register(self._remove_socket)
+        socketio.start_background_task(self._accept, server)
+
+    def _remove_socket(self):
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+
+    def _accept(self, server):
+        while True:
+            conn, _ = server.accept()
+            socketio.start_background_task(self._serve, conn)
+
+    def _serve(self, conn):
+        with conn, conn.makefile('rwb') as stream:
+            try:
+                for line in stream:
+                    reply = self._handle(line)
+                    self.served += 1
+                    stream.write(json.dumps(reply, ensure_ascii=False).encode() + b'\n')
+                    stream.flush()
+            except OSError:
+                pass
+
+    def _handle(self, line):
+        try:
+            message = json.loads(line)
+            pi_id, command = message['pi_id'], message['command']
+        except (ValueError, TypeError, KeyError) as e:
+            # Поврежденная или обрезанная строка: отвечаем ошибкой, поток обслуживания продолжает работу
+            self.failed += 1
+            return {'error': f'некорректный запрос: {e}'}
+        try:
+            pending = dispatch_command(pi_id, command, message.get('data'), message.get('timeout', 10))
+            response = pending_requests.wait(pending)
+            return {'response': response, 'round_trip': pending.round_trip()}
+        except PiTimeoutError:
+            return {'error': 'timeout'}
+        except PiOverloadedError as e:
+            return {'error': 'overloaded', 'message': str(e), 'retry_after': e.retry_after}
+        except Exception as e:
+            return {'error': str(e)}
+
+    def _connection(self, owner):
+        connections_by_owner = getattr(self._local, 'connections', None)
+        if connections_by_owner is None:
+            connections_by_owner = self._local.connections = {}
+        if owner not in connections_by_owner:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(owner)
+            except OSError:
+                sock.close()
+                raise
+            connections_by_owner[owner] = (sock, sock.makefile('rwb'))
+        return connections_by_owner[owner]
+
+    def _close(self, owner):
+        sock, stream = self._local.connections.pop(owner)
+        stream.close()
+        sock.close()
+
+    def forward(self, pi_id, command, data, timeout=10):
+        """Выполняет команду через воркер, к которому подключен Pi; возвращает ответ и задержку Pi"""
+        owner = shared_state.owner(pi_id)
+        if owner is None:
+            raise Exception("Raspberry Pi not connected")
+        try:
+            sock, stream = self._connection(owner)
+        except (FileNotFoundError, ConnectionRefusedError):
+            # Владелец завершился, не успев снять отметку
+            shared_state.release(pi_id, owner)
+            raise Exception("Raspberry Pi not connected")
+
+        message = {'pi_id': pi_id, 'command': command, 'data': data, 'timeout': timeout}
+        try:
+            # Владелец сам отвечает по таймауту; запас - на случай, если он завис
+            sock.settimeout(timeout + 1)
+            stream.write(json.dumps(message, ensure_ascii=False).encode() + b'\n')
+            stream.flush()
+            line = stream.readline()
+            if not line:
+                raise ConnectionError('воркер-владелец Pi закрыл соединение')
+            reply = json.loads(line)
+        except (OSError, ValueError) as e:
+            # Опоздавший или обрезанный ответ в этом соединении сбил бы очередность, поэтому оно закрывается
+            self._close(owner)
+            self.failed += 1
+            if isinstance(e, ValueError):
+                raise ConnectionError(f'некорректный ответ воркера-владельца Pi: {e}') from e
+            raise
+
+        self.forwarded += 1
+        if reply.get('error') == 'timeout':
+            raise PiTimeoutError("Timeout")
+        if reply.get('error') == 'overloaded':
+            raise PiOverloadedError(reply['message'], reply['retry_after'])
+        if 'error' in reply:
+            raise Exception(reply['error'])
+        return reply['response'], reply['round_trip']
+
+    def stats(self):
+        return {
+            'pid': os.getpid(),
+            'listening': self._started.is_set(),
+            'forwarded': self.forwarded,
+            'served': self.served,
+            'failed': self.failed
+        }
+
+# Маршрутизация между Raspberry Pi корпусов
+DEFAULT_PI = os.environ.get('DEFAULT_PI_ID', 'default_pi')
+
+
+class PiRouter:
+    """Определяет, какой Raspberry Pi обслуживает группу или корпус.
+
+    Конфигурация (переменная PI_ROUTES, JSON):
+    {"default": "pi_main", "campuses": {"north": "pi_north"},
+     "groups": {"ИС-21": "pi_north"}, "group_prefixes": {"ИС-": "pi_north"}}
+    Группы, которые Pi вернул в get_groups, запоминаются автоматически.
+    """
+
+    def __init__(self, config=None):
+        config = config or {}
+        self.default = config.get('default', DEFAULT_PI)
+        self.campuses = dict(config.get('campuses', {}))
+        self.groups = dict(config.get('groups', {}))
+        # Длинные префиксы проверяются первыми
+        self.group_prefixes = sorted(config.get('group_prefixes', {}).items(), key=lambda item: -len(item[0]))
+        self._lock = threading.Lock()
+
+    def route(self, data):
+        data = data or {}
+        campus = data.get('campus')
+        if campus in self.campuses:
+            return self.campuses[campus]
+
+        group_name = data.get('group_name')
+        if group_name:
+            with self._lock:
+                if group_name in self.groups:
+                    return self.groups[group_name]
+            for prefix, pi_id in self.group_prefixes:
+                if group_name.startswith(prefix):
+                    return pi_id
+        return self.default
+
+    def learn(self, group_name, pi_id):
+        with self._lock:
+            self.groups.setdefault(group_name, pi_id)
+
+    def known_pis(self):
+        with self._lock:
+            pis = {self.default} | set(self.campuses.values()) | set(self.groups.values())
+        return pis | {pi_id for _, pi_id in self.group_prefixes} | set(connections) | shared_state.owned_pis()
 
 # Хранилища
 connections = {}
-pending_requests = {}
-backup_mode = False
+pending_requests = RequestRegistry()
+command_scheduler = CommandScheduler()
+response_cache = ResponseCache()
+single_flight = SingleFlight()
+pi_router = PiRouter(json.loads(os.environ.get('PI_ROUTES') or '{}'))
+# Резервный режим ведется отдельно для каждого Pi и общий для всех воркеров
+shared_state = SharedState()
+peer_bridge = PeerBridge(BRIDGE_SOCKET_DIR)
 
-# Инициализация резервной БД
-def init_backup_db():
-    conn = sqlite3.connect('/tmp/backup.db')
-    cursor = conn.cursor()
-    
-    # Таблица преподавателей (должна быть всегда актуальной)
-    cursor.execute('''
+breakers = {}
+
+def get_breaker(pi_id):
+    breaker = breakers.get(pi_id)
+    if breaker is None:
+        breaker = breakers.setdefault(pi_id, CircuitBreaker(
+            failure_threshold=int(os.environ.get('BREAKER_FAILURES', 3)),
+            slow_call_seconds=float(os.environ.get('BREAKER_SLOW_SECONDS', 3.0)),
+            reset_timeout=float(os.environ.get('BREAKER_RESET_SECONDS', 15.0))
+        ))
+    return breaker
+
+def pi_connected(pi_id):
+    """Pi подключен к этому процессу или к другому воркеру моста"""
+    return pi_id in connections or shared_state.owner(pi_id) is not None
+
+def is_online(pi_id):
+    return pi_connected(pi_id) and not shared_state.backup_mode(pi_id)
+
+def set_backup_mode(pi_id, enabled):
+    """Переключает резервный режим Pi (для всех воркеров) и считает переходы"""
+    if shared_state.set_backup_mode(pi_id, enabled) != enabled:
+        metrics.inc('backup_transitions', pi_id=pi_id, direction='enter' if enabled else 'exit')
+    publish_status()
+
+def invalidate_cache(commands=None):
+    """Сбрасывает кэш у себя и сообщает о сбросе остальным воркерам"""
+    removed = response_cache.invalidate(commands)
+    shared_state.bump_cache_versions(commands)
+    return removed
+
+# Резервная БД: одно соединение на поток, WAL и кэш подготовленных выражений
+BACKUP_DB_PATH = os.environ.get('BACKUP_DB_PATH', '/tmp/backup.db')
+
+BACKUP_DB_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-16000',
+    'PRAGMA mmap_size=67108864',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA busy_timeout=5000'
+)
+
+BACKUP_WRITE_COMMANDS = {'add_journal_entry', 'add_journal_entries', 'add_group', 'add_student', 'add_teacher', 'add_homework'}
+
+# Записи, которые зеркалируются в резерв и при штатной работе; ключ нужен, чтобы узнать строку в ленте изменений Pi
+MIRRORED_WRITE_COMMANDS = {'add_journal_entry', 'add_journal_entries', 'add_homework'}
+
+JOURNAL_INSERT = '''
+    INSERT INTO backup_journal
+    (date, student_name, group_name, subject, topic, grade, attendance, comments, teacher_id, sync_key)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+HOMEWORK_INSERT = '''
+    INSERT INTO backup_homework
+    (group_name, subject, homework_text, date_assigned, date_due, teacher_id, sync_key)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+
+def journal_rows(data, entries, sync_key):
+    """Строки backup_journal для одной оценки (entries=[data]) или пачки"""
+    today = datetime.now().strftime('%Y-%m-%d')
+    return [(
+        data.get('date') or today,
+        entry.get('student_name'),
+        data.get('group_name'),
+        data.get('subject'),
+        entry.get('topic', data.get('topic')),
+        entry.get('grade'),
+        entry.get('attendance', True),
+        entry.get('comments', ''),
+        data.get('teacher_id'),
+        sync_key
+    ) for entry in entries]
+
+def homework_row(data, sync_key):
+    return (
+        data.get('group_name'),
+        data.get('subject'),
+        data.get('homework_text'),
+        data.get('date_assigned', datetime.now().strftime('%Y-%m-%d')),
+        data.get('date_due'),
+        data.get('teacher_id'),
+        sync_key
+    )
+
+_db_local = os_thread_local()
+
+def get_backup_db():
+    """Соединение текущего потока ОС с резервной БД (открывается один раз)
+
+    Зеленые потоки одного потока ОС делят соединение: транзакция не должна переживать переключение,
+    поэтому внутри backup_transaction нет ожидания сети.
+    """
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        # isolation_level=None: транзакциями управляет backup_transaction
+        conn = sqlite3.connect(BACKUP_DB_PATH, isolation_level=None, cached_statements=256,
+                               check_same_thread=False)
+        for pragma in BACKUP_DB_PRAGMAS:
+            conn.execute(pragma)
+        _db_local.conn = conn
+    return conn
+
+@contextmanager
+def backup_transaction(immediate=False):
+    """Транзакция на соединении потока; вложенные вызовы работают внутри внешней транзакции"""
+    conn = get_backup_db()
+    if conn.in_transaction:
+        yield conn
+        return
+
+    # BEGIN IMMEDIATE сразу берет блокировку записи и не ловит SQLITE_BUSY при повышении блокировки
+    conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+def query_backup(sql, params=()):
+    """Короткий запрос на чтение вне зеленого потока: SQLite может ждать блокировку до busy_timeout"""
+    return run_blocking(lambda: get_backup_db().execute(sql, params).fetchall())
+
+def open_backup_reader():
+    """Отдельное соединение для потоковой выдачи.
+
+    Курсор живет между yield, пока другие зеленые потоки этого же потока ОС
+    открывают транзакции на общем соединении, поэтому поток читает через свое.
+    """
+    conn = sqlite3.connect(BACKUP_DB_PATH, check_same_thread=False)
+    conn.execute('PRAGMA busy_timeout=5000')
+    conn.execute('PRAGMA query_only=1')
+    return conn
+
+def fetch_rows(cursor, size):
+    """Строки курсора пачками по size, каждая пачка читается вне зеленого потока"""
+    while True:
+        rows = run_blocking(cursor.fetchmany, size)
+        if not rows:
+            return
+        yield from rows
+
+# Миграции схемы резервной БД: версия хранится в PRAGMA user_version
+MIGRATIONS = [
+    (1, 'Базовые таблицы', [
+        # Таблица преподавателей (должна быть всегда актуальной)
+        '''
         CREATE TABLE IF NOT EXISTS backup_teachers (
             teacher_id TEXT PRIMARY KEY,
             name TEXT NOT NULL,
@@ -32,20 +1099,18 @@ def init_backup_db():
             subject TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-    ''')
-    
-    # Таблица групп
-    cursor.execute('''
+        ''',
+        # Таблица групп
+        '''
         CREATE TABLE IF NOT EXISTS backup_groups (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT UNIQUE NOT NULL,
             course TEXT NOT NULL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-    ''')
-    
-    # Таблица студентов
-    cursor.execute('''
+        ''',
+        # Таблица студентов
+        '''
         CREATE TABLE IF NOT EXISTS backup_students (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL,
@@ -53,10 +1118,9 @@ def init_backup_db():
             student_id TEXT UNIQUE,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-    ''')
-    
-    # Таблица журнала
-    cursor.execute('''
+        ''',
+        # Таблица журнала
+        '''
         CREATE TABLE IF NOT EXISTS backup_journal (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             date TEXT NOT NULL,
@@ -70,10 +1134,9 @@ def init_backup_db():
             teacher_id TEXT NOT NULL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-    ''')
-    
-    # Таблица домашних заданий
-    cursor.execute('''
+        ''',
+        # Таблица домашних заданий
+        '''
         CREATE TABLE IF NOT EXISTS backup_homework (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             group_name TEXT NOT NULL,
@@ -84,18 +1147,567 @@ def init_backup_db():
             teacher_id TEXT NOT NULL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-    ''')
-    
-    # Очередь синхронизации
-    cursor.execute('''
+        ''',
+        # Очередь синхронизации
+        '''
         CREATE TABLE IF NOT EXISTS sync_queue (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             action_type TEXT NOT NULL,
             data_json TEXT NOT NULL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-    ''')
-    
+        '''
+    ]),
+    (2, 'Индексы для частых запросов', [
+        # Покрывающий индекс: id входит в индекс как rowid
+        'CREATE INDEX IF NOT EXISTS idx_students_group_name ON backup_students (group_name, name, student_id)',
+        'CREATE INDEX IF NOT EXISTS idx_groups_course_name ON backup_groups (course, name)',
+        'CREATE INDEX IF NOT EXISTS idx_teachers_name ON backup_teachers (name, role, subject)',
+        'CREATE INDEX IF NOT EXISTS idx_homework_group_date ON backup_homework (group_name, date_assigned DESC)',
+        'CREATE INDEX IF NOT EXISTS idx_journal_group_subject_date ON backup_journal (group_name, subject, date)',
+        'CREATE INDEX IF NOT EXISTS idx_sync_queue_created ON sync_queue (created_at, id)'
+    ]),
+    (3, 'Ключи идемпотентности в очереди синхронизации', [
+        'ALTER TABLE sync_queue ADD COLUMN idempotency_key TEXT',
+        'UPDATE sync_queue SET idempotency_key = lower(hex(randomblob(16))) WHERE idempotency_key IS NULL',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_sync_queue_key ON sync_queue (idempotency_key)'
+    ]),
+    (4, 'Индексы с уникальным ключом сортировки для постраничной выдачи', [
+        'DROP INDEX IF EXISTS idx_students_group_name',
+        'CREATE INDEX IF NOT EXISTS idx_students_group_name_id ON backup_students (group_name, name, id, student_id)',
+        'DROP INDEX IF EXISTS idx_teachers_name',
+        'CREATE INDEX IF NOT EXISTS idx_teachers_name_id ON backup_teachers (name, teacher_id, role, subject)',
+        'DROP INDEX IF EXISTS idx_homework_group_date',
+        'CREATE INDEX IF NOT EXISTS idx_homework_group_date_id ON backup_homework (group_name, date_assigned, id)'
+    ]),
+    (5, 'Очередь синхронизации по Raspberry Pi', [
+        "ALTER TABLE sync_queue ADD COLUMN pi_id TEXT NOT NULL DEFAULT 'default_pi'",
+        'DROP INDEX IF EXISTS idx_sync_queue_created',
+        'CREATE INDEX IF NOT EXISTS idx_sync_queue_pi ON sync_queue (pi_id, created_at, id)'
+    ]),
+    (6, 'Общее состояние воркеров моста', [
+        # owner - unix-сокет процесса, к которому подключен Pi
+        '''
+        CREATE TABLE IF NOT EXISTS bridge_pis (
+            pi_id TEXT PRIMARY KEY,
+            owner TEXT,
+            backup_mode INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL
+        )
+        ''',
+        # Версии кэшированных команд: '*' - полный сброс
+        '''
+        CREATE TABLE IF NOT EXISTS bridge_cache_versions (
+            command TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        )
+        '''
+    ]),
+    (7, 'Репликация данных Pi', [
+        # source_pi/source_id - строка на Pi, sync_key - ключ записи очереди или онлайн-команды, создавшей строку
+        'ALTER TABLE backup_journal ADD COLUMN source_pi TEXT',
+        'ALTER TABLE backup_journal ADD COLUMN source_id INTEGER',
+        'ALTER TABLE backup_journal ADD COLUMN sync_key TEXT',
+        'ALTER TABLE backup_homework ADD COLUMN source_pi TEXT',
+        'ALTER TABLE backup_homework ADD COLUMN source_id INTEGER',
+        'ALTER TABLE backup_homework ADD COLUMN sync_key TEXT',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_journal_source ON backup_journal (source_pi, source_id) WHERE source_id IS NOT NULL',
+        'CREATE INDEX IF NOT EXISTS idx_journal_sync_key ON backup_journal (sync_key) WHERE sync_key IS NOT NULL',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_homework_source ON backup_homework (source_pi, source_id) WHERE source_id IS NOT NULL',
+        'CREATE INDEX IF NOT EXISTS idx_homework_sync_key ON backup_homework (sync_key) WHERE sync_key IS NOT NULL',
+        # Отметка: до какой версии ленты изменений Pi резерв уже догнал
+        '''
+        CREATE TABLE IF NOT EXISTS replication_state (
+            pi_id TEXT PRIMARY KEY,
+            version INTEGER NOT NULL,
+            snapshot_version INTEGER,
+            updated_at REAL NOT NULL
+        )
+        '''
+    ]),
+    (8, 'Сводки оценок и посещаемости', [
+        # Сводки по месяцам; журнал любой длины сворачивается в строки (группа, предмет, месяц[, студент])
+        '''
+        CREATE TABLE IF NOT EXISTS journal_group_stats (
+            group_name TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            period TEXT NOT NULL,
+            entries INTEGER NOT NULL,
+            graded INTEGER NOT NULL,
+            grade_sum INTEGER NOT NULL,
+            present INTEGER NOT NULL,
+            PRIMARY KEY (group_name, subject, period)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS journal_student_stats (
+            group_name TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            period TEXT NOT NULL,
+            student_name TEXT NOT NULL,
+            entries INTEGER NOT NULL,
+            graded INTEGER NOT NULL,
+            grade_sum INTEGER NOT NULL,
+            present INTEGER NOT NULL,
+            PRIMARY KEY (group_name, subject, period, student_name)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        INSERT INTO journal_group_stats (group_name, subject, period, entries, graded, grade_sum, present)
+        SELECT group_name, subject, substr(date, 1, 7), COUNT(*), COUNT(grade), COALESCE(SUM(grade), 0),
+            SUM(CASE WHEN attendance THEN 1 ELSE 0 END)
+        FROM backup_journal GROUP BY group_name, subject, substr(date, 1, 7)
+        ''',
+        '''
+        INSERT INTO journal_student_stats (group_name, subject, period, student_name, entries, graded, grade_sum, present)
+        SELECT group_name, subject, substr(date, 1, 7), student_name, COUNT(*), COUNT(grade), COALESCE(SUM(grade), 0),
+            SUM(CASE WHEN attendance THEN 1 ELSE 0 END)
+        FROM backup_journal GROUP BY group_name, subject, substr(date, 1, 7), student_name
+        ''',
+        # Сводки обновляются триггерами: резервный режим, зеркалирование и репликация пишут в журнал одинаково
+        '''
+        CREATE TRIGGER IF NOT EXISTS journal_stats_insert AFTER INSERT ON backup_journal BEGIN
+            INSERT INTO journal_group_stats (group_name, subject, period, entries, graded, grade_sum, present)
+            VALUES (NEW.group_name, NEW.subject, substr(NEW.date, 1, 7),
+                1, NEW.grade IS NOT NULL, COALESCE(NEW.grade, 0), CASE WHEN NEW.attendance THEN 1 ELSE 0 END)
+            ON CONFLICT DO UPDATE SET entries = entries + 1, graded = graded + excluded.graded,
+                grade_sum = grade_sum + excluded.grade_sum, present = present + excluded.present;
+            INSERT INTO journal_student_stats (group_name, subject, period, student_name, entries, graded, grade_sum, present)
+            VALUES (NEW.group_name, NEW.subject, substr(NEW.date, 1, 7), NEW.student_name,
+                1, NEW.grade IS NOT NULL, COALESCE(NEW.grade, 0), CASE WHEN NEW.attendance THEN 1 ELSE 0 END)
+            ON CONFLICT DO UPDATE SET entries = entries + 1, graded = graded + excluded.graded,
+                grade_sum = grade_sum + excluded.grade_sum, present = present + excluded.present;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS journal_stats_delete AFTER DELETE ON backup_journal BEGIN
+            UPDATE journal_group_stats SET entries = entries - 1, graded = graded - (OLD.grade IS NOT NULL),
+                grade_sum = grade_sum - COALESCE(OLD.grade, 0),
+                present = present - (CASE WHEN OLD.attendance THEN 1 ELSE 0 END)
+            WHERE group_name = OLD.group_name AND subject = OLD.subject AND period = substr(OLD.date, 1, 7);
+            DELETE FROM journal_group_stats WHERE group_name = OLD.group_name AND subject = OLD.subject
+                AND period = substr(OLD.date, 1, 7)
+                AND entries = 0;
+            UPDATE journal_student_stats SET entries = entries - 1, graded = graded - (OLD.grade IS NOT NULL),
+                grade_sum = grade_sum - COALESCE(OLD.grade, 0),
+                present = present - (CASE WHEN OLD.attendance THEN 1 ELSE 0 END)
+            WHERE group_name = OLD.group_name AND subject = OLD.subject AND period = substr(OLD.date, 1, 7)
+                AND student_name = OLD.student_name;
+            DELETE FROM journal_student_stats WHERE group_name = OLD.group_name AND subject = OLD.subject
+                AND period = substr(OLD.date, 1, 7) AND student_name = OLD.student_name
+                AND entries = 0;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS journal_stats_update
+        AFTER UPDATE OF date, student_name, group_name, subject, grade, attendance ON backup_journal BEGIN
+            UPDATE journal_group_stats SET entries = entries - 1, graded = graded - (OLD.grade IS NOT NULL),
+                grade_sum = grade_sum - COALESCE(OLD.grade, 0),
+                present = present - (CASE WHEN OLD.attendance THEN 1 ELSE 0 END)
+            WHERE group_name = OLD.group_name AND subject = OLD.subject AND period = substr(OLD.date, 1, 7);
+            DELETE FROM journal_group_stats WHERE group_name = OLD.group_name AND subject = OLD.subject
+                AND period = substr(OLD.date, 1, 7)
+                AND entries = 0;
+            UPDATE journal_student_stats SET entries = entries - 1, graded = graded - (OLD.grade IS NOT NULL),
+                grade_sum = grade_sum - COALESCE(OLD.grade, 0),
+                present = present - (CASE WHEN OLD.attendance THEN 1 ELSE 0 END)
+            WHERE group_name = OLD.group_name AND subject = OLD.subject AND period = substr(OLD.date, 1, 7)
+                AND student_name = OLD.student_name;
+            DELETE FROM journal_student_stats WHERE group_name = OLD.group_name AND subject = OLD.subject
+                AND period = substr(OLD.date, 1, 7) AND student_name = OLD.student_name
+                AND entries = 0;
+            INSERT INTO journal_group_stats (group_name, subject, period, entries, graded, grade_sum, present)
+            VALUES (NEW.group_name, NEW.subject, substr(NEW.date, 1, 7),
+                1, NEW.grade IS NOT NULL, COALESCE(NEW.grade, 0), CASE WHEN NEW.attendance THEN 1 ELSE 0 END)
+            ON CONFLICT DO UPDATE SET entries = entries + 1, graded = graded + excluded.graded,
+                grade_sum = grade_sum + excluded.grade_sum, present = present + excluded.present;
+            INSERT INTO journal_student_stats (group_name, subject, period, student_name, entries, graded, grade_sum, present)
+            VALUES (NEW.group_name, NEW.subject, substr(NEW.date, 1, 7), NEW.student_name,
+                1, NEW.grade IS NOT NULL, COALESCE(NEW.grade, 0), CASE WHEN NEW.attendance THEN 1 ELSE 0 END)
+            ON CONFLICT DO UPDATE SET entries = entries + 1, graded = graded + excluded.graded,
+                grade_sum = grade_sum + excluded.grade_sum, present = present + excluded.present;
+        END
+        '''
+    ]),
+    (9, 'Полнотекстовый поиск', [
+        # Внешнее содержимое: индекс хранит только токены, строки берутся из самих таблиц.
+        # unicode61 приводит кириллицу к нижнему регистру, ё заменяется на е и в индексе, и в запросе;
+        # prefix ускоряет поиск по началу слова
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS students_fts USING fts5(
+            name, content='backup_students', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS students_fts_insert AFTER INSERT ON backup_students BEGIN
+            INSERT INTO students_fts (rowid, name)
+            VALUES (NEW.id, replace(replace(NEW.name, 'ё', 'е'), 'Ё', 'Е'));
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS students_fts_delete AFTER DELETE ON backup_students BEGIN
+            INSERT INTO students_fts (students_fts, rowid, name)
+            VALUES ('delete', OLD.id, replace(replace(OLD.name, 'ё', 'е'), 'Ё', 'Е'));
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS students_fts_update AFTER UPDATE OF name ON backup_students BEGIN
+            INSERT INTO students_fts (students_fts, rowid, name)
+            VALUES ('delete', OLD.id, replace(replace(OLD.name, 'ё', 'е'), 'Ё', 'Е'));
+            INSERT INTO students_fts (rowid, name)
+            VALUES (NEW.id, replace(replace(NEW.name, 'ё', 'е'), 'Ё', 'Е'));
+        END
+        ''',
+        '''
+        INSERT INTO students_fts (rowid, name)
+        SELECT id, replace(replace(name, 'ё', 'е'), 'Ё', 'Е') FROM backup_students
+        ''',
+        # У преподавателей ключ текстовый, а rowid может смениться после VACUUM: индекс хранит свою копию
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS teachers_fts USING fts5(
+            teacher_id UNINDEXED, name, subject,
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS teachers_fts_insert AFTER INSERT ON backup_teachers BEGIN
+            INSERT INTO teachers_fts (teacher_id, name, subject)
+            VALUES (NEW.teacher_id, replace(replace(NEW.name, 'ё', 'е'), 'Ё', 'Е'), replace(replace(NEW.subject, 'ё', 'е'), 'Ё', 'Е'));
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS teachers_fts_delete AFTER DELETE ON backup_teachers BEGIN
+            DELETE FROM teachers_fts WHERE teacher_id = OLD.teacher_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS teachers_fts_update AFTER UPDATE OF teacher_id, name, subject ON backup_teachers BEGIN
+            DELETE FROM teachers_fts WHERE teacher_id = OLD.teacher_id;
+            INSERT INTO teachers_fts (teacher_id, name, subject)
+            VALUES (NEW.teacher_id, replace(replace(NEW.name, 'ё', 'е'), 'Ё', 'Е'), replace(replace(NEW.subject, 'ё', 'е'), 'Ё', 'Е'));
+        END
+        ''',
+        '''
+        INSERT INTO teachers_fts (teacher_id, name, subject)
+        SELECT teacher_id, replace(replace(name, 'ё', 'е'), 'Ё', 'Е'), replace(replace(subject, 'ё', 'е'), 'Ё', 'Е') FROM backup_teachers
+        ''',
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS homework_fts USING fts5(
+            homework_text, subject, content='backup_homework', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS homework_fts_insert AFTER INSERT ON backup_homework BEGIN
+            INSERT INTO homework_fts (rowid, homework_text, subject)
+            VALUES (NEW.id, replace(replace(NEW.homework_text, 'ё', 'е'), 'Ё', 'Е'), replace(replace(NEW.subject, 'ё', 'е'), 'Ё', 'Е'));
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS homework_fts_delete AFTER DELETE ON backup_homework BEGIN
+            INSERT INTO homework_fts (homework_fts, rowid, homework_text, subject)
+            VALUES ('delete', OLD.id, replace(replace(OLD.homework_text, 'ё', 'е'), 'Ё', 'Е'), replace(replace(OLD.subject, 'ё', 'е'), 'Ё', 'Е'));
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS homework_fts_update AFTER UPDATE OF homework_text, subject ON backup_homework BEGIN
+            INSERT INTO homework_fts (homework_fts, rowid, homework_text, subject)
+            VALUES ('delete', OLD.id, replace(replace(OLD.homework_text, 'ё', 'е'), 'Ё', 'Е'), replace(replace(OLD.subject, 'ё', 'е'), 'Ё', 'Е'));
+            INSERT INTO homework_fts (rowid, homework_text, subject)
+            VALUES (NEW.id, replace(replace(NEW.homework_text, 'ё', 'е'), 'Ё', 'Е'), replace(replace(NEW.subject, 'ё', 'е'), 'Ё', 'Е'));
+        END
+        ''',
+        '''
+        INSERT INTO homework_fts (rowid, homework_text, subject)
+        SELECT id, replace(replace(homework_text, 'ё', 'е'), 'Ё', 'Е'), replace(replace(subject, 'ё', 'е'), 'Ё', 'Е') FROM backup_homework
+        '''
+    ]),
+    (10, 'Архив закрытых семестров', [
+        # Семестры, перенесенные в архивные БД; ends - первый день после семестра
+        '''
+        CREATE TABLE IF NOT EXISTS archive_terms (
+            term TEXT PRIMARY KEY,
+            starts TEXT NOT NULL,
+            ends TEXT NOT NULL,
+            journal_rows INTEGER NOT NULL DEFAULT 0,
+            homework_rows INTEGER NOT NULL DEFAULT 0,
+            queue_rows INTEGER NOT NULL DEFAULT 0,
+            archived_at REAL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS maintenance_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            archiving INTEGER NOT NULL DEFAULT 0,
+            last_run REAL
+        )
+        ''',
+        'INSERT OR IGNORE INTO maintenance_state (id) VALUES (1)',
+        # Перенос строк в архив не меняет сводки: они хранят всю историю журнала
+        'DROP TRIGGER IF EXISTS journal_stats_delete',
+        '''
+        CREATE TRIGGER journal_stats_delete AFTER DELETE ON backup_journal
+        WHEN NOT (SELECT archiving FROM maintenance_state) BEGIN
+            UPDATE journal_group_stats SET entries = entries - 1, graded = graded - (OLD.grade IS NOT NULL),
+                grade_sum = grade_sum - COALESCE(OLD.grade, 0),
+                present = present - (CASE WHEN OLD.attendance THEN 1 ELSE 0 END)
+            WHERE group_name = OLD.group_name AND subject = OLD.subject AND period = substr(OLD.date, 1, 7);
+            DELETE FROM journal_group_stats WHERE group_name = OLD.group_name AND subject = OLD.subject
+                AND period = substr(OLD.date, 1, 7)
+                AND entries = 0;
+            UPDATE journal_student_stats SET entries = entries - 1, graded = graded - (OLD.grade IS NOT NULL),
+                grade_sum = grade_sum - COALESCE(OLD.grade, 0),
+                present = present - (CASE WHEN OLD.attendance THEN 1 ELSE 0 END)
+            WHERE group_name = OLD.group_name AND subject = OLD.subject AND period = substr(OLD.date, 1, 7)
+                AND student_name = OLD.student_name;
+            DELETE FROM journal_student_stats WHERE group_name = OLD.group_name AND subject = OLD.subject
+                AND period = substr(OLD.date, 1, 7) AND student_name = OLD.student_name
+                AND entries = 0;
+        END
+        '''
+    ]),
+    (11, 'Отклоненные Pi записи очереди синхронизации', [
+        # Pi явно отказал в применении: запись больше не отправляется и не держит резервный режим
+        'ALTER TABLE sync_queue ADD COLUMN failed_at REAL',
+        'ALTER TABLE sync_queue ADD COLUMN error TEXT'
+    ]),
+    (12, 'Состояние синхронизации в общем состоянии воркеров', [
+        # Синхронизацию ведет воркер-владелец Pi, статус показывают все воркеры
+        'ALTER TABLE bridge_pis ADD COLUMN sync_json TEXT'
+    ])
+]
+
+# Частые запросы и индексы, которые они обязаны использовать
+QUERY_PLAN_EXPECTATIONS = [
+    ('SELECT id, name, course FROM backup_groups ORDER BY course, name',
+     (), 'idx_groups_course_name'),
+    ('SELECT * FROM backup_journal WHERE group_name = ? AND subject = ? AND date BETWEEN ? AND ? ORDER BY date',
+     ('Г-1', 'Математика', '2024-09-01', '2024-12-31'), 'idx_journal_group_subject_date'),
+    ('SELECT id, action_type, data_json, idempotency_key FROM sync_queue WHERE pi_id = ? AND failed_at IS NULL '
+     'ORDER BY created_at, id',
+     ('default_pi',), 'idx_sync_queue_pi'),
+    ('SELECT period, SUM(entries) FROM journal_group_stats WHERE group_name = ? AND subject = ? '
+     'AND period BETWEEN ? AND ? GROUP BY period ORDER BY period',
+     ('Г-1', 'Математика', '2024-09', '2024-12'), 'PRIMARY KEY'),
+    # Выгрузка по всей школе идет в порядке индекса, без сортировки всей выборки
+    ('SELECT date, student_name, grade FROM backup_journal WHERE date >= ? AND date <= ? '
+     'ORDER BY group_name, subject, date, id',
+     ('2024-09-01', '2024-12-31'), 'idx_journal_group_subject_date')
+]
+
+# Списки с постраничной выдачей по ключу (keyset): сортировка по уникальному набору колонок,
+# курсор - значения этих колонок у последней отданной строки
+PAGED_QUERIES = {
+    'get_students': {
+        'select': 'SELECT id, name, group_name, student_id FROM backup_students',
+        'filters': ['group_name'],
+        'sort': ['name', 'id'],
+        'descending': False,
+        'index': 'idx_students_group_name_id',
+        'row': lambda r: {'id': r[0], 'name': r[1], 'group_name': r[2], 'student_id': r[3]}
+    },
+    'get_all_students': {
+        'select': 'SELECT id, name, group_name, student_id FROM backup_students',
+        'filters': [],
+        'sort': ['group_name', 'name', 'id'],
+        'descending': False,
+        'index': 'idx_students_group_name_id',
+        'row': lambda r: {'id': r[0], 'name': r[1], 'group_name': r[2], 'student_id': r[3]}
+    },
+    'get_teachers': {
+        'select': 'SELECT teacher_id, name, role, subject FROM backup_teachers',
+        'filters': [],
+        'sort': ['name', 'teacher_id'],
+        'descending': False,
+        'index': 'idx_teachers_name_id',
+        'row': lambda r: {'id': r[0], 'name': r[1], 'role': r[2], 'subject': r[3]}
+    },
+    'get_homework': {
+        'select': 'SELECT id, group_name, subject, homework_text, date_assigned, date_due, teacher_id FROM backup_homework',
+        'filters': ['group_name'],
+        'sort': ['date_assigned', 'id'],
+        'descending': True,
+        'index': 'idx_homework_group_date_id',
+        'row': lambda h: {
+            'id': h[0], 'group_name': h[1], 'subject': h[2],
+            'homework_text': h[3], 'date_assigned': h[4], 'date_due': h[5], 'teacher_id': h[6]
+        }
+    }
+}
+
+# Ключ сортировки строки в том виде, в каком его отдает API (для курсора)
+PAGE_KEY_FIELDS = {'teacher_id': 'id'}
+
+MAX_PAGE_SIZE = 1000
+STREAM_PAGE_SIZE = 500
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, ensure_ascii=False).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        values = None
+    if not isinstance(values, list):
+        raise ValueError('Некорректный курсор')
+    return values
+
+def build_paged_query(command, data, limit=None):
+    """SQL и параметры для страницы списка: фильтры, условие по курсору, сортировка, LIMIT"""
+    spec = PAGED_QUERIES[command]
+    where = [f'{column} = ?' for column in spec['filters']]
+    params = [data.get(column) for column in spec['filters']]
+
+    if data.get('cursor'):
+        values = decode_cursor(data['cursor'])
+        if len(values) != len(spec['sort']):
+            raise ValueError('Некорректный курсор')
+        columns = ', '.join(spec['sort'])
+        placeholders = ', '.join('?' for _ in values)
+        where.append(f"({columns}) {'<' if spec['descending'] else '>'} ({placeholders})")
+        params.extend(values)
+
+    sql = spec['select']
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    direction = ' DESC' if spec['descending'] else ''
+    sql += ' ORDER BY ' + ', '.join(column + direction for column in spec['sort'])
+    if limit:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    return sql, params
+
+def page_cursor(command, row):
+    """Курсор, указывающий на строку (значения колонок сортировки)"""
+    return encode_cursor([row[PAGE_KEY_FIELDS.get(column, column)] for column in PAGED_QUERIES[command]['sort']])
+
+def fetch_backup_page(conn, command, data):
+    """Страница списка из резервной БД; без limit отдается весь список, как раньше"""
+    spec = PAGED_QUERIES[command]
+    limit = data.get('limit')
+    sql, params = build_paged_query(command, data, limit + 1 if limit else None)
+    rows = [spec['row'](r) for r in conn.execute(sql, params)]
+
+    next_cursor = None
+    if limit and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = page_cursor(command, rows[-1])
+    return {'status': 'success', 'data': rows, 'next_cursor': next_cursor, 'backup_mode': True}
+
+def iter_backup_rows(command, data):
+    """Строки списка прямо из курсора SQLite, без загрузки всей выборки в память"""
+    spec = PAGED_QUERIES[command]
+    sql, params = build_paged_query(command, data, data.get('limit'))
+    conn = run_blocking(open_backup_reader)
+    try:
+        for row in fetch_rows(run_blocking(conn.execute, sql, params), STREAM_PAGE_SIZE):
+            yield spec['row'](row)
+    finally:
+        conn.close()
+
+# Полнотекстовый поиск: каждое слово запроса - начало слова в тексте, лучшие совпадения (bm25) первыми
+SEARCH_TYPES = {
+    'students': {
+        'type': 'student',
+        'sql': '''
+            SELECT s.id, s.name, s.group_name, s.student_id, students_fts.rank
+            FROM students_fts JOIN backup_students s ON s.id = students_fts.rowid
+            WHERE students_fts MATCH ? {group_filter}
+            ORDER BY students_fts.rank LIMIT ?
+        ''',
+        'group_filter': 'AND s.group_name = ?',
+        'fields': ('id', 'name', 'group_name', 'student_id')
+    },
+    'teachers': {
+        'type': 'teacher',
+        'sql': '''
+            SELECT t.teacher_id, t.name, t.subject, teachers_fts.rank
+            FROM teachers_fts JOIN backup_teachers t ON t.teacher_id = teachers_fts.teacher_id
+            WHERE teachers_fts MATCH ?
+            ORDER BY teachers_fts.rank LIMIT ?
+        ''',
+        'fields': ('id', 'name', 'subject')
+    },
+    'homework': {
+        'type': 'homework',
+        'sql': '''
+            SELECT h.id, h.group_name, h.subject, h.homework_text, h.date_assigned, h.date_due, homework_fts.rank
+            FROM homework_fts JOIN backup_homework h ON h.id = homework_fts.rowid
+            WHERE homework_fts MATCH ? {group_filter}
+            ORDER BY homework_fts.rank LIMIT ?
+        ''',
+        'group_filter': 'AND h.group_name = ?',
+        'fields': ('id', 'group_name', 'subject', 'homework_text', 'date_assigned', 'date_due')
+    }
+}
+
+SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+
+def search_match_expression(query):
+    """'ива мар' -> '"ива"* "мар"*': в совпадении есть все слова, каждое как начало слова"""
+    query = (query or '').replace('ё', 'е').replace('Ё', 'Е')
+    return ' '.join(f'"{token}"*' for token in re.findall(r'\w+', query))
+
+def search_backup(conn, data):
+    """Поиск по резервной БД через FTS5"""
+    match = search_match_expression(data.get('q'))
+    limit = data.get('limit') or SEARCH_LIMIT
+    hits = []
+    for name in data.get('types') or SEARCH_TYPES:
+        spec = SEARCH_TYPES[name]
+        group_filter = spec.get('group_filter') if data.get('group_name') else None
+        params = [match] + ([data['group_name']] if group_filter else []) + [limit]
+        for row in conn.execute(spec['sql'].format(group_filter=group_filter or ''), params):
+            hits.append(dict(zip(spec['fields'], row), type=spec['type'], rank=round(row[-1], 4)))
+    # Каждая таблица отдала свои лучшие limit совпадений, значит общие лучшие limit среди них
+    hits.sort(key=lambda hit: hit['rank'])
+    return {'status': 'success', 'data': hits[:limit], 'backup_mode': True}
+
+def paged_query_expectations():
+    """Планы запросов постраничной выдачи: первая страница и страница по курсору"""
+    samples = {'group_name': 'Г-1', 'name': 'Иванов', 'id': 1, 'teacher_id': 'teacher_001', 'date_assigned': '2024-09-01'}
+    for command, spec in PAGED_QUERIES.items():
+        data = {column: samples[column] for column in spec['filters']}
+        for cursor in (None, encode_cursor([samples[column] for column in spec['sort']])):
+            sql, params = build_paged_query(command, dict(data, cursor=cursor), 50)
+            yield sql, params, spec['index']
+
+def migrate_backup_db(conn):
+    """Применяет недостающие миграции, каждую в своей транзакции.
+
+    Воркеры стартуют одновременно: версию перечитываем под блокировкой записи,
+    иначе миграцию, которую уже применил соседний процесс, выполнили бы второй раз.
+    """
+    for version, description, statements in MIGRATIONS:
+        if version <= conn.execute('PRAGMA user_version').fetchone()[0]:
+            continue
+        with backup_transaction(immediate=True):
+            if version <= conn.execute('PRAGMA user_version').fetchone()[0]:
+                continue
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {version}')
+        logging.info(f"Миграция резервной БД {version}: {description}")
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def check_query_plans(conn=None):
+    """Проверяет, что частые запросы идут по индексам без полного сканирования и сортировки"""
+    conn = conn or get_backup_db()
+    problems = []
+    for sql, params, index_name in QUERY_PLAN_EXPECTATIONS + list(paged_query_expectations()):
+        plan = ' | '.join(row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params))
+        if index_name not in plan or 'TEMP B-TREE' in plan:
+            problems.append(f'{sql} -> {plan}')
+    return problems
+
+# Инициализация резервной БД
+def init_backup_db():
+    conn = get_backup_db()
+    migrate_backup_db(conn)
+
     # Добавляем стандартных преподавателей если их нет
     default_teachers = [
         ('admin', 'Администратор Системы', 'admin123', 'admin', 'Администрирование'),
@@ -103,566 +1715,2321 @@ def init_backup_db():
         ('teacher_002', 'Петров Алексей Владимирович', '123456', 'teacher', 'Русский язык'),
         ('teacher_003', 'Сидорова Елена Ивановна', '123456', 'teacher', 'История')
     ]
-    
-    for teacher in default_teachers:
-        cursor.execute('''
+
+    with backup_transaction(immediate=True):
+        conn.executemany('''
             INSERT OR IGNORE INTO backup_teachers (teacher_id, name, password, role, subject)
             VALUES (?, ?, ?, ?, ?)
-        ''', teacher)
-    
-    conn.commit()
-    conn.close()
+        ''', default_teachers)
+
+    for problem in check_query_plans(conn):
+        logging.warning(f"⚠️ Запрос не использует индекс: {problem}")
+
+    shared_state.prune()
 
 init_backup_db()
 
-def get_backup_db():
-    return sqlite3.connect('/tmp/backup.db')
+@app.cli.command('check-db')
+def check_db_command():
+    """Проверяет версию схемы и планы частых запросов резервной БД"""
+    conn = get_backup_db()
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    print(f"Версия схемы: {version} (ожидается {MIGRATIONS[-1][0]})")
+    problems = check_query_plans(conn)
+    for problem in problems:
+        print(f"❌ {problem}")
+    if problems or version != MIGRATIONS[-1][0]:
+        raise SystemExit(1)
+    print("✅ Все частые запросы используют индексы")
 
 # WebSocket события
 @socketio.on('connect')
 def handle_connect():
     logging.info(f"Client connected: {request.sid}")
 
+@socketio.on('subscribe_status')
+def handle_subscribe_status():
+    # Браузер получает текущий статус сразу, дальше - только изменения
+    join_room(STATUS_ROOM)
+    start_status_poll()
+    status = bridge_status()
+    socketio.emit('bridge_status', dict(status, etag=status_etag(status)), to=request.sid)
+
+@socketio.on('disconnect')
+def handle_disconnect():
+    # Запросы к отключившемуся Pi завершаем сразу, не дожидаясь таймаута
+    for pi_id, sid in list(connections.items()):
+        if sid == request.sid:
+            del connections[pi_id]
+            wire_codecs.pop(sid, None)
+            shared_state.release(pi_id, peer_bridge.address)
+            dropped = pending_requests.drop_pi(pi_id)
+            logging.warning(f"⚠️ Raspberry Pi {pi_id} отключился, прервано запросов: {dropped}")
+            set_backup_mode(pi_id, True)
+            get_sync_worker(pi_id).mark_offline()
+
 @socketio.on('raspberry_connect')
 def handle_raspberry_connect(data):
-    pi_id = data.get('pi_id', 'default_pi')
+    pi_id = data.get('pi_id', DEFAULT_PI)
     connections[pi_id] = request.sid
-    
-    global backup_mode
-    if backup_mode:
-        logging.info(f"✅ Raspberry Pi восстановил соединение! Начинаем синхронизацию...")
-        backup_mode = False
-        sync_and_cleanup(pi_id)
-    
+    # Формат канала: старая прошивка ничего не предлагает и остается на JSON-объектах
+    settings = wire.negotiate(data.get('wire'))
+    if settings:
+        wire_codecs[request.sid] = wire.WireCodec(settings, WIRE_COMPRESS_MIN_BYTES)
+    else:
+        wire_codecs.pop(request.sid, None)
+    # Остальные воркеры шлют команды этому Pi через наш unix-сокет
+    peer_bridge.start()
+    shared_state.claim(pi_id, peer_bridge.address)
+    get_breaker(pi_id).reset()
+    start_heartbeat()
+
+    # Очередь могла накопиться и без обрыва связи (например, Pi еще не подключался после старта моста)
+    queued = query_backup('SELECT 1 FROM sync_queue WHERE pi_id = ? AND failed_at IS NULL LIMIT 1', (pi_id,))
+    if shared_state.backup_mode(pi_id) or queued:
+        set_backup_mode(pi_id, True)
+        # Очередь догоняется в фоне, подтверждение подключения уходит сразу
+        logging.info(f"✅ Raspberry Pi {pi_id} восстановил соединение! Начинаем синхронизацию...")
+        get_sync_worker(pi_id).start(pi_id)
+    else:
+        get_sync_worker(pi_id).mark_online()
+        request_replication()
+
+    publish_status()
     logging.info(f"Raspberry Pi {pi_id} connected")
-    return {'status': 'success', 'connected': True}
+    return {'status': 'success', 'connected': True, 'wire': settings}
 
 @socketio.on('raspberry_response')
 def handle_raspberry_response(data):
+    data = decode_from_pi(request.sid, data)
+    if data is None:
+        return
     request_id = data.get('request_id')
-    if request_id in pending_requests:
-        pending_requests[request_id] = data.get('response')
+    if not pending_requests.resolve(request_id, data.get('response')):
+        logging.debug(f"Ответ на неизвестный или просроченный запрос {request_id} отброшен")
+
+@socketio.on('cache_invalidate')
+def handle_cache_invalidate(data):
+    # Pi сообщает об изменении данных в обход моста: {'commands': ['get_groups', ...]} или {} для полного сброса
+    if request.sid not in connections.values():
+        # Сбрасывать кэш могут только соединения, представившиеся Pi через raspberry_connect
+        logging.warning(f"⚠️ cache_invalidate от соединения {request.sid}, которое не является Pi, отклонен")
+        return {'status': 'error', 'message': 'Доступно только Raspberry Pi'}
+    commands = (data or {}).get('commands')
+    removed = invalidate_cache(set(commands) if commands else None)
+    logging.info(f"Кэш сброшен по событию Raspberry Pi, удалено записей: {removed}")
 
 # Функция проверки прав доступа
 def check_permission(teacher_id, required_role=None, required_subject=None):
     """Проверяет права доступа преподавателя"""
-    conn = get_backup_db()
-    cursor = conn.cursor()
-    
-    teacher = cursor.execute(
-        'SELECT * FROM backup_teachers WHERE teacher_id = ?', (teacher_id,)
-    ).fetchone()
-    
-    conn.close()
-    
+    # Внутри process_in_backup_mode используется то же соединение и та же транзакция
+    with backup_transaction() as conn:
+        teacher = conn.execute(
+            'SELECT * FROM backup_teachers WHERE teacher_id = ?', (teacher_id,)
+        ).fetchone()
+
     if not teacher:
         return False
-    
+
     teacher_data = {
         'id': teacher[0],
         'name': teacher[1],
         'role': teacher[3],
         'subject': teacher[4]
     }
-    
+
     # Админ имеет все права
     if teacher_data['role'] == 'admin':
         return teacher_data
-    
+
     # Проверка роли
     if required_role and teacher_data['role'] != required_role:
         return False
-    
+
     # Проверка предмета
     if required_subject and teacher_data['subject'] != required_subject:
         return False
-    
+
     return teacher_data
 
+def session_teacher():
+    """Преподаватель, вошедший через /login, с ролью и предметом из резерва; None - вход не выполнен"""
+    if 'teacher_id' not in session:
+        return None
+    return run_blocking(check_permission, session['teacher_id'])
+
+def login_required_error():
+    return jsonify({'status': 'error', 'message': 'Требуется вход в систему'}), 401
+
 # Основная функция отправки команд
 def send_command(pi_id, command, data, timeout=10):
-    global backup_mode
-    
-    if pi_id in connections and not backup_mode:
+    if command in BACKUP_WRITE_COMMANDS:
+        # Запись не должна обогнать очередь, которую начал другой воркер
+        shared_state.refresh(force=True)
+    if command in MIRRORED_WRITE_COMMANDS and not data.get('idempotency_key'):
+        data = dict(data, idempotency_key=uuid.uuid4().hex)
+    if is_online(pi_id):
+        if command in CACHE_TTL:
+            cached = response_cache.get(pi_id, command, data)
+            if cached is not None:
+                return cached
+        breaker = get_breaker(pi_id)
+
+        def fetch():
+            # Выполняет тот, кто идет к Pi: склеенные запросы получают готовый результат,
+            # а предохранитель и кэш видят один вызов Pi, а не каждого ожидающего
+            generation = response_cache.generation(command)
+            try:
+                result, round_trip = send_command_timed(pi_id, command, data, timeout)
+            except PiOverloadedError:
+                raise
+            except Exception as e:
+                if breaker.record_failure():
+                    trip_pi(pi_id, str(e))
+                raise
+            if breaker.record_success(round_trip):
+                trip_pi(pi_id, 'Pi отвечает слишком медленно')
+            # Запись, сбросившая кэш во время запроса, не даст положить ответ, прочитанный до нее
+            if command in CACHE_TTL and result.get('status') == 'success':
+                response_cache.put(pi_id, command, data, result, CACHE_TTL[command], generation)
+            return result
+
         try:
-            result = send_command_direct(pi_id, command, data, timeout)
-            # Дублируем важные данные в резерв
-            if result.get('status') == 'success' and command in ['add_group', 'add_student', 'add_homework', 'add_teacher']:
-                save_to_backup(command, data)
+            if command in CACHE_TTL:
+                # Одинаковые чтения (звонок с урока) делят один запрос к Pi
+                result = single_flight.do(response_cache.make_key(pi_id, command, data), fetch)
+            else:
+                result = fetch()
+            if result.get('status') == 'success':
+                # Дублируем записи в резерв, не дожидаясь ленты изменений
+                if command in BACKUP_WRITE_COMMANDS:
+                    run_blocking(save_to_backup, command, data, result)
+                if command in CACHE_INVALIDATION:
+                    invalidate_cache(CACHE_INVALIDATION[command])
             return result
+        except PiOverloadedError:
+            # Pi жив, просто занят: предохранитель и резерв тут ни при чем, клиент получит 503
+            raise
         except Exception as e:
-            logging.warning(f"⚠️ Ошибка связи: {e}")
-            backup_mode = True
-    
-    return process_in_backup_mode(command, data)
+            logging.warning(f"⚠️ Ошибка связи с {pi_id}: {e}")
+            # Запись, ушедшая в очередь, требует резервного режима: иначе следующие записи обгонят ее
+            if command in BACKUP_WRITE_COMMANDS:
+                trip_pi(pi_id, str(e))
+
+    result = process_in_backup_mode(command, data, pi_id)
+    if result.get('status') == 'success' and command in CACHE_INVALIDATION:
+        invalidate_cache(CACHE_INVALIDATION[command])
+    return result
 
 # Обработка в режиме резерва
-def process_in_backup_mode(command, data):
-    conn = get_backup_db()
-    cursor = conn.cursor()
-    
+def process_in_backup_mode(command, data, pi_id=DEFAULT_PI):
+    started = time.perf_counter()
     try:
-        if command == 'get_groups':
-            groups = cursor.execute('SELECT * FROM backup_groups ORDER BY course, name').fetchall()
-            return {
-                'status': 'success', 
-                'data': [{'id': g[0], 'name': g[1], 'course': g[2]} for g in groups],
-                'backup_mode': True
-            }
-            
-        elif command == 'get_students':
-            group_name = data.get('group_name')
-            students = cursor.execute(
-                'SELECT * FROM backup_students WHERE group_name = ? ORDER BY name', (group_name,)
-            ).fetchall()
-            return {
-                'status': 'success',
-                'data': [{'id': s[0], 'name': s[1], 'group_name': s[2], 'student_id': s[3]} for s in students],
-                'backup_mode': True
-            }
-            
-        elif command == 'get_all_students':
-            students = cursor.execute('SELECT * FROM backup_students ORDER BY group_name, name').fetchall()
-            return {
-                'status': 'success',
-                'data': [{'id': s[0], 'name': s[1], 'group_name': s[2], 'student_id': s[3]} for s in students],
-                'backup_mode': True
-            }
-            
-        elif command == 'get_teachers':
-            teachers = cursor.execute('SELECT * FROM backup_teachers ORDER BY name').fetchall()
-            return {
-                'status': 'success',
-                'data': [{'id': t[0], 'name': t[1], 'role': t[3], 'subject': t[4]} for t in teachers],
-                'backup_mode': True
-            }
-            
-        elif command == 'login':
-            teacher_id = data.get('teacher_id')
-            password = data.get('password')
-            
-            teacher = cursor.execute(
-                'SELECT * FROM backup_teachers WHERE teacher_id = ? AND password = ?', 
-                (teacher_id, password)
-            ).fetchone()
-            
-            if teacher:
+        return run_blocking(_process_in_backup_mode, command, data, pi_id)
+    finally:
+        metrics.observe('backup', command, time.perf_counter() - started)
+
+def _process_in_backup_mode(command, data, pi_id):
+    with backup_transaction(immediate=command in BACKUP_WRITE_COMMANDS) as conn:
+        cursor = conn.cursor()
+
+        try:
+            if command == 'get_groups':
+                groups = cursor.execute('SELECT id, name, course FROM backup_groups ORDER BY course, name').fetchall()
+                return {
+                    'status': 'success', 
+                    'data': [{'id': g[0], 'name': g[1], 'course': g[2]} for g in groups],
+                    'backup_mode': True
+                }
+
+            elif command in PAGED_QUERIES:
+                return fetch_backup_page(conn, command, data)
+
+            elif command == 'search':
+                return search_backup(conn, data)
+
+            elif command == 'login':
+                teacher_id = data.get('teacher_id')
+                password = data.get('password')
+
+                teacher = cursor.execute(
+                    'SELECT * FROM backup_teachers WHERE teacher_id = ? AND password = ?', 
+                    (teacher_id, password)
+                ).fetchone()
+
+                if teacher:
+                    return {
+                        'status': 'success',
+                        'teacher': {
+                            'id': teacher[0],
+                            'name': teacher[1],
+                            'role': teacher[3],
+                            'subject': teacher[4]
+                        },
+                        'backup_mode': True
+                    }
+                else:
+                    return {'status': 'error', 'message': 'Неверный ID или пароль'}
+
+            elif command == 'add_journal_entry':
+                # Проверяем права доступа
+                teacher_info = check_permission(data.get('teacher_id'))
+                if not teacher_info:
+                    return {'status': 'error', 'message': 'Доступ запрещен'}
+
+                # Преподаватель может ставить оценки только по своему предмету
+                if teacher_info['role'] == 'teacher' and teacher_info['subject'] != data.get('subject'):
+                    return {'status': 'error', 'message': f'Вы можете ставить оценки только по предмету: {teacher_info["subject"]}'}
+
+                sync_key = enqueue_sync(cursor, 'add_journal_entry', data, pi_id)
+                cursor.executemany(JOURNAL_INSERT, journal_rows(data, [data], sync_key))
+
+                return {'status': 'success', 'message': '✅ Оценка сохранена', 'backup_mode': True}
+
+            elif command == 'add_journal_entries':
+                # Права проверяются один раз на всю пачку
+                teacher_info = check_permission(data.get('teacher_id'))
+                if not teacher_info:
+                    return {'status': 'error', 'message': 'Доступ запрещен'}
+
+                if teacher_info['role'] == 'teacher' and teacher_info['subject'] != data.get('subject'):
+                    return {'status': 'error', 'message': f'Вы можете ставить оценки только по предмету: {teacher_info["subject"]}'}
+
+                entries = data.get('entries', [])
+                # Вся пачка уходит на Pi одной записью очереди
+                sync_key = enqueue_sync(cursor, 'add_journal_entries', data, pi_id)
+                cursor.executemany(JOURNAL_INSERT, journal_rows(data, entries, sync_key))
+
                 return {
                     'status': 'success',
-                    'teacher': {
-                        'id': teacher[0],
-                        'name': teacher[1],
-                        'role': teacher[3],
-                        'subject': teacher[4]
-                    },
+                    'message': f'✅ Сохранено оценок: {len(entries)}',
+                    'results': [{'status': 'success'} for _ in entries],
                     'backup_mode': True
                 }
+
+            elif command == 'add_group':
+                # Только админ может добавлять группы
+                if not check_permission(data.get('teacher_id'), 'admin'):
+                    return {'status': 'error', 'message': 'Только администратор может добавлять группы'}
+
+                cursor.execute('INSERT OR IGNORE INTO backup_groups (name, course) VALUES (?, ?)', 
+                              (data.get('group_name'), 'Новый курс'))
+                enqueue_sync(cursor, 'add_group', data, pi_id)
+                return {'status': 'success', 'message': '✅ Группа добавлена', 'backup_mode': True}
+
+            elif command == 'add_student':
+                # Только админ может добавлять студентов
+                if not check_permission(data.get('teacher_id'), 'admin'):
+                    return {'status': 'error', 'message': 'Только администратор может добавлять студентов'}
+
+                cursor.execute('INSERT OR IGNORE INTO backup_students (name, group_name, student_id) VALUES (?, ?, ?)',
+                              (data.get('student_name'), data.get('group_name'), data.get('student_id')))
+                enqueue_sync(cursor, 'add_student', data, pi_id)
+                return {'status': 'success', 'message': '✅ Студент добавлен', 'backup_mode': True}
+
+            elif command == 'add_teacher':
+                # Только админ может добавлять преподавателей
+                if not check_permission(data.get('teacher_id'), 'admin'):
+                    return {'status': 'error', 'message': 'Только администратор может добавлять преподавателей'}
+
+                cursor.execute('INSERT OR IGNORE INTO backup_teachers (teacher_id, name, password, role, subject) VALUES (?, ?, ?, ?, ?)',
+                              (data.get('new_teacher_id'), data.get('new_teacher_name'), data.get('new_teacher_password'), 
+                               data.get('new_teacher_role', 'teacher'), data.get('new_teacher_subject')))
+                return {'status': 'success', 'message': '✅ Преподаватель добавлен', 'backup_mode': True}
+
+            elif command == 'add_homework':
+                # Проверяем права доступа
+                teacher_info = check_permission(data.get('teacher_id'))
+                if not teacher_info:
+                    return {'status': 'error', 'message': 'Доступ запрещен'}
+
+                # Преподаватель может добавлять ДЗ только по своему предмету
+                if teacher_info['role'] == 'teacher' and teacher_info['subject'] != data.get('subject'):
+                    return {'status': 'error', 'message': f'Вы можете добавлять ДЗ только по предмету: {teacher_info["subject"]}'}
+
+                sync_key = enqueue_sync(cursor, 'add_homework', data, pi_id)
+                cursor.execute(HOMEWORK_INSERT, homework_row(data, sync_key))
+                return {'status': 'success', 'message': '✅ ДЗ добавлено', 'backup_mode': True}
+
             else:
-                return {'status': 'error', 'message': 'Неверный ID или пароль'}
-            
-        elif command == 'add_journal_entry':
-            # Проверяем права доступа
-            teacher_info = check_permission(data.get('teacher_id'))
-            if not teacher_info:
-                return {'status': 'error', 'message': 'Доступ запрещен'}
-            
-            # Преподаватель может ставить оценки только по своему предмету
-            if teacher_info['role'] == 'teacher' and teacher_info['subject'] != data.get('subject'):
-                return {'status': 'error', 'message': f'Вы можете ставить оценки только по предмету: {teacher_info["subject"]}'}
-            
-            cursor.execute('''
-                INSERT INTO backup_journal 
-                (date, student_name, group_name, subject, topic, grade, attendance, comments, teacher_id)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                data.get('date', datetime.now().strftime('%Y-%m-%d')),
-                data.get('student_name'),
-                data.get('group_name'),
-                data.get('subject'),
-                data.get('topic'),
-                data.get('grade'),
-                data.get('attendance', True),
-                data.get('comments', ''),
-                data.get('teacher_id')
-            ))
-            
-            cursor.execute('INSERT INTO sync_queue (action_type, data_json) VALUES (?, ?)', 
-                          ('add_journal_entry', json.dumps(data)))
-            
-            conn.commit()
-            return {'status': 'success', 'message': '✅ Оценка сохранена', 'backup_mode': True}
-            
-        elif command == 'add_group':
-            # Только админ может добавлять группы
-            if not check_permission(data.get('teacher_id'), 'admin'):
-                return {'status': 'error', 'message': 'Только администратор может добавлять группы'}
-            
-            cursor.execute('INSERT OR IGNORE INTO backup_groups (name, course) VALUES (?, ?)', 
-                          (data.get('group_name'), 'Новый курс'))
-            cursor.execute('INSERT INTO sync_queue (action_type, data_json) VALUES (?, ?)', 
-                          ('add_group', json.dumps(data)))
-            conn.commit()
-            return {'status': 'success', 'message': '✅ Группа добавлена', 'backup_mode': True}
-            
-        elif command == 'add_student':
-            # Только админ может добавлять студентов
-            if not check_permission(data.get('teacher_id'), 'admin'):
-                return {'status': 'error', 'message': 'Только администратор может добавлять студентов'}
-            
-            cursor.execute('INSERT OR IGNORE INTO backup_students (name, group_name, student_id) VALUES (?, ?, ?)',
-                          (data.get('student_name'), data.get('group_name'), data.get('student_id')))
-            cursor.execute('INSERT INTO sync_queue (action_type, data_json) VALUES (?, ?)',
-                          ('add_student', json.dumps(data)))
-            conn.commit()
-            return {'status': 'success', 'message': '✅ Студент добавлен', 'backup_mode': True}
-            
-        elif command == 'add_teacher':
-            # Только админ может добавлять преподавателей
-            if not check_permission(data.get('teacher_id'), 'admin'):
-                return {'status': 'error', 'message': 'Только администратор может добавлять преподавателей'}
-            
-            cursor.execute('INSERT OR IGNORE INTO backup_teachers (teacher_id, name, password, role, subject) VALUES (?, ?, ?, ?, ?)',
-                          (data.get('new_teacher_id'), data.get('new_teacher_name'), data.get('new_teacher_password'), 
-                           data.get('new_teacher_role', 'teacher'), data.get('new_teacher_subject')))
-            conn.commit()
-            return {'status': 'success', 'message': '✅ Преподаватель добавлен', 'backup_mode': True}
-            
-        elif command == 'add_homework':
-            # Проверяем права доступа
-            teacher_info = check_permission(data.get('teacher_id'))
-            if not teacher_info:
-                return {'status': 'error', 'message': 'Доступ запрещен'}
-            
-            # Преподаватель может добавлять ДЗ только по своему предмету
-            if teacher_info['role'] == 'teacher' and teacher_info['subject'] != data.get('subject'):
-                return {'status': 'error', 'message': f'Вы можете добавлять ДЗ только по предмету: {teacher_info["subject"]}'}
-            
-            cursor.execute('''
-                INSERT INTO backup_homework 
-                (group_name, subject, homework_text, date_assigned, date_due, teacher_id)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (
-                data.get('group_name'),
-                data.get('subject'),
-                data.get('homework_text'),
-                data.get('date_assigned', datetime.now().strftime('%Y-%m-%d')),
-                data.get('date_due'),
-                data.get('teacher_id')
-            ))
-            cursor.execute('INSERT INTO sync_queue (action_type, data_json) VALUES (?, ?)',
-                          ('add_homework', json.dumps(data)))
-            conn.commit()
-            return {'status': 'success', 'message': '✅ ДЗ добавлено', 'backup_mode': True}
-            
-        elif command == 'get_homework':
-            group_name = data.get('group_name')
-            homeworks = cursor.execute(
-                'SELECT * FROM backup_homework WHERE group_name = ? ORDER BY date_assigned DESC', (group_name,)
-            ).fetchall()
-            return {
-                'status': 'success',
-                'data': [{
-                    'id': h[0], 'group_name': h[1], 'subject': h[2], 
-                    'homework_text': h[3], 'date_assigned': h[4], 'date_due': h[5], 'teacher_id': h[6]
-                } for h in homeworks],
-                'backup_mode': True
-            }
-            
-        else:
-            return {'status': 'error', 'message': '❌ Команда недоступна', 'backup_mode': True}
-        
-    except Exception as e:
-        conn.rollback()
-        return {'status': 'error', 'message': f'Ошибка: {str(e)}'}
-    finally:
-        conn.close()
+                return {'status': 'error', 'message': '❌ Команда недоступна', 'backup_mode': True}
 
-def save_to_backup(command, data):
+        except Exception as e:
+            conn.rollback()
+            return {'status': 'error', 'message': f'Ошибка: {str(e)}'}
+
+def save_to_backup(command, data, result=None):
     """Дублирование данных при штатной работе"""
-    conn = get_backup_db()
-    cursor = conn.cursor()
-    
     try:
-        if command == 'add_group':
-            cursor.execute('INSERT OR IGNORE INTO backup_groups (name, course) VALUES (?, ?)', 
-                          (data.get('group_name'), 'Новый курс'))
-        elif command == 'add_student':
-            cursor.execute('INSERT OR IGNORE INTO backup_students (name, group_name, student_id) VALUES (?, ?, ?)',
-                          (data.get('student_name'), data.get('group_name'), data.get('student_id')))
-        elif command == 'add_teacher':
-            cursor.execute('INSERT OR IGNORE INTO backup_teachers (teacher_id, name, password, role, subject) VALUES (?, ?, ?, ?, ?)',
-                          (data.get('new_teacher_id'), data.get('new_teacher_name'), data.get('new_teacher_password'), 
-                           data.get('new_teacher_role', 'teacher'), data.get('new_teacher_subject')))
-        elif command == 'add_homework':
-            cursor.execute('''
-                INSERT OR IGNORE INTO backup_homework 
-                (group_name, subject, homework_text, date_assigned, date_due, teacher_id)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (
-                data.get('group_name'), data.get('subject'), data.get('homework_text'),
-                data.get('date_assigned'), data.get('date_due'), data.get('teacher_id')
-            ))
-        
-        conn.commit()
+        with backup_transaction(immediate=True) as conn:
+            cursor = conn.cursor()
+            if command == 'add_group':
+                cursor.execute('INSERT OR IGNORE INTO backup_groups (name, course) VALUES (?, ?)', 
+                              (data.get('group_name'), 'Новый курс'))
+            elif command == 'add_student':
+                cursor.execute('INSERT OR IGNORE INTO backup_students (name, group_name, student_id) VALUES (?, ?, ?)',
+                              (data.get('student_name'), data.get('group_name'), data.get('student_id')))
+            elif command == 'add_teacher':
+                cursor.execute('INSERT OR IGNORE INTO backup_teachers (teacher_id, name, password, role, subject) VALUES (?, ?, ?, ?, ?)',
+                              (data.get('new_teacher_id'), data.get('new_teacher_name'), data.get('new_teacher_password'), 
+                               data.get('new_teacher_role', 'teacher'), data.get('new_teacher_subject')))
+            elif command == 'add_homework':
+                cursor.execute(HOMEWORK_INSERT, homework_row(data, data.get('idempotency_key')))
+            elif command == 'add_journal_entry':
+                cursor.executemany(JOURNAL_INSERT, journal_rows(data, [data], data.get('idempotency_key')))
+            elif command == 'add_journal_entries':
+                # Зеркалируются только оценки, которые Pi принял
+                entries = data.get('entries', [])
+                results = (result or {}).get('results')
+                if results is not None:
+                    entries = [entry for entry, r in zip(entries, results) if r.get('status') == 'success']
+                cursor.executemany(JOURNAL_INSERT, journal_rows(data, entries, data.get('idempotency_key')))
+
     except Exception as e:
         logging.error(f"Ошибка дублирования: {e}")
-    finally:
-        conn.close()
 
-def sync_and_cleanup(pi_id):
-    """Синхронизация новых данных"""
-    conn = get_backup_db()
-    cursor = conn.cursor()
-    
-    try:
-        synced_count = 0
-        queue_items = cursor.execute('SELECT * FROM sync_queue ORDER BY created_at').fetchall()
-        
-        for item in queue_items:
-            data = json.loads(item[2])
-            result = send_command_direct(pi_id, item[1], data, timeout=5)
-            
-            if result.get('status') == 'success':
-                cursor.execute('DELETE FROM sync_queue WHERE id = ?', (item[0],))
-                synced_count += 1
-        
-        conn.commit()
-        logging.info(f"✅ Синхронизировано записей: {synced_count}")
-        
-    except Exception as e:
-        logging.error(f"❌ Ошибка синхронизации: {e}")
-    finally:
-        conn.close()
+def enqueue_sync(cursor, action_type, data, pi_id=DEFAULT_PI):
+    """Ставит действие в очередь синхронизации Pi с ключом идемпотентности и возвращает ключ"""
+    # Запись, не дошедшая до Pi онлайн, сохраняет свой ключ: Pi не применит ее дважды
+    key = data.get('idempotency_key') or uuid.uuid4().hex
+    cursor.execute('INSERT INTO sync_queue (action_type, data_json, idempotency_key, pi_id) VALUES (?, ?, ?, ?)',
+                   (action_type, json.dumps(data), key, pi_id))
+    return key
 
-def send_command_direct(pi_id, command, data, timeout=10):
-    """Прямая отправка команды на Raspberry Pi"""
+# Пакетная синхронизация очереди
+SYNC_BATCH_SIZE = int(os.environ.get('SYNC_BATCH_SIZE', 50))
+SYNC_WINDOW = int(os.environ.get('SYNC_WINDOW', 4))
+SYNC_BATCH_TIMEOUT = 15
+# Повтор синхронизации, которая не довезла очередь: пауза удваивается до SYNC_RETRY_MAX
+SYNC_RETRY_MIN = float(os.environ.get('SYNC_RETRY_MIN', 5))
+SYNC_RETRY_MAX = float(os.environ.get('SYNC_RETRY_MAX', 300))
+
+# Повторы этих команд с тем же значением поля ничего не меняют на Pi (INSERT OR IGNORE)
+SYNC_COALESCE_FIELDS = {
+    'add_group': 'group_name',
+    'add_student': 'student_id'
+}
+
+def compact_sync_queue(rows):
+    """Схлопывает избыточные записи очереди.
+
+    Возвращает список записей к отправке и словарь {id оставленной записи: [id дубликатов]}.
+    Дубликаты удаляются из очереди вместе с подтверждением оставленной записи.
+    """
+    items = []
+    duplicates = {}
+    seen = {}
+    for row_id, action_type, data_json, key in rows:
+        data = json.loads(data_json)
+        field = SYNC_COALESCE_FIELDS.get(action_type)
+        value = data.get(field) if field else None
+        if value:
+            kept_id = seen.get((action_type, value))
+            if kept_id is not None:
+                duplicates[kept_id].append(row_id)
+                continue
+            seen[(action_type, value)] = row_id
+        duplicates[row_id] = []
+        items.append({'id': row_id, 'command': action_type, 'data': data, 'idempotency_key': key})
+    return items, duplicates
+
+def dispatch_sync_batch(pi_id, batch):
+    """Отправляет пачку записей одной командой sync_batch, не дожидаясь ответа"""
+    return dispatch_command(pi_id, 'sync_batch', {
+        'items': [
+            {'idempotency_key': item['idempotency_key'], 'command': item['command'], 'data': item['data']}
+            for item in batch
+        ]
+    }, SYNC_BATCH_TIMEOUT)
+
+def acknowledged_ids(batch, response):
+    """id записей пачки, которые Pi подтвердил (в т.ч. как уже примененные по ключу)"""
+    if not response:
+        return []
+    results = response.get('results')
+    if results is None:
+        return [item['id'] for item in batch] if response.get('status') == 'success' else []
+    acked_keys = {r.get('idempotency_key') for r in results if r.get('status') in ('success', 'duplicate')}
+    return [item['id'] for item in batch if item['idempotency_key'] in acked_keys]
+
+def rejected_items(batch, response):
+    """{id записи: причина} для записей, которые Pi получил и явно отказался применять.
+
+    Пачка без ответа (таймаут, отказ планировщика, обрыв) ничего не отклоняет: она будет отправлена снова.
+    """
+    results = (response or {}).get('results') or []
+    errors = {r.get('idempotency_key'): r.get('message') or 'ошибка' for r in results if r.get('status') == 'error'}
+    return {item['id']: errors[item['idempotency_key']] for item in batch if item['idempotency_key'] in errors}
+
+def settle_sync_rows(doomed, failed):
+    with backup_transaction(immediate=True) as tx:
+        tx.executemany('DELETE FROM sync_queue WHERE id = ?', doomed)
+        tx.executemany('UPDATE sync_queue SET failed_at = ?, error = ? WHERE id = ?', failed)
+
+def replay_sync_queue(pi_id, batch_size=None, window=None, on_progress=None):
+    """Отправляет очередь синхронизации пачками, держа в полете не больше window пачек"""
+    batch_size = batch_size or SYNC_BATCH_SIZE
+    window = window or SYNC_WINDOW
+    rows = query_backup(
+        'SELECT id, action_type, data_json, idempotency_key FROM sync_queue WHERE pi_id = ? AND failed_at IS NULL '
+        'ORDER BY created_at, id',
+        (pi_id,)
+    )
+    items, duplicates = compact_sync_queue(rows)
+    stats = {'queued': len(rows), 'coalesced': len(rows) - len(items), 'sent': 0, 'acknowledged': 0,
+             'rejected': 0, 'failed': 0}
+
+    def complete(batch, pending):
+        try:
+            response = pending_requests.wait(pending)
+        except Exception as e:
+            logging.warning(f"⚠️ Пачка синхронизации не подтверждена: {e}")
+            response = None
+        acked = acknowledged_ids(batch, response)
+        rejected = rejected_items(batch, response)
+        stats['failed'] += len(batch) - len(acked)
+
+        # Удаляем подтвержденные записи и помечаем отклоненные (вместе со схлопнутыми дубликатами) одной транзакцией
+        doomed = [(row_id,) for item_id in acked for row_id in [item_id] + duplicates[item_id]]
+        now = time.time()
+        failed = [(now, error, row_id) for item_id, error in rejected.items() for row_id in [item_id] + duplicates[item_id]]
+        stats['acknowledged'] += len(doomed)
+        stats['rejected'] += len(failed)
+        if doomed or failed:
+            run_blocking(settle_sync_rows, doomed, failed)
+            for _, error, row_id in failed:
+                logging.warning(f"⚠️ {pi_id} отклонил запись очереди {row_id}: {error}")
+        if on_progress:
+            on_progress(stats)
+
+    in_flight = []
+    for start in range(0, len(items), batch_size):
+        batch = items[start:start + batch_size]
+        if len(in_flight) >= window:
+            complete(*in_flight.pop(0))
+        try:
+            in_flight.append((batch, dispatch_sync_batch(pi_id, batch)))
+        except Exception as e:
+            # Pi пропал: остаток очереди уйдет при следующем подключении
+            logging.warning(f"⚠️ Синхронизация прервана: {e}")
+            stats['failed'] += len(items) - start
+            break
+        stats['sent'] += len(batch)
+
+    while in_flight:
+        complete(*in_flight.pop(0))
+    return stats
+
+# Состояния моста: offline - работаем с резервом, draining - Pi догоняет очередь, online - работаем с Pi
+SYNC_OFFLINE = 'offline'
+SYNC_DRAINING = 'draining'
+SYNC_ONLINE = 'online'
+
+
+class SyncWorker:
+    """Фоновая синхронизация очереди после восстановления связи с Raspberry Pi.
+
+    Пока идет синхронизация, Pi остается в резервном режиме: новые записи попадают
+    в конец очереди (порядок сохраняется), а чтения обслуживает резервная БД,
+    в которой уже есть все еще не доставленные на Pi изменения. Резервный режим
+    снимается, только когда в очереди не осталось записей, кроме явно отклоненных Pi;
+    иначе синхронизация повторяется из heartbeat с растущей паузой.
+    """
+
+    def __init__(self, pi_id):
+        self.pi_id = pi_id
+        self._lock = threading.Lock()
+        self.state = SYNC_OFFLINE
+        self.progress = {}
+        self._acknowledged = 0
+        self._sent = 0
+        self._retries = 0
+        self._retry_at = 0.0
+
+    def start(self, pi_id):
+        with self._lock:
+            if self.state == SYNC_DRAINING:
+                return False
+            self.state = SYNC_DRAINING
+            self.progress = {'pi_id': pi_id, 'queued': 0, 'sent': 0, 'acknowledged': 0,
+                             'failed': 0, 'eta_seconds': None, 'started_at': time.time()}
+        self._publish()
+        socketio.start_background_task(self._run, pi_id)
+        return True
+
+    def mark_online(self):
+        with self._lock:
+            if self.state != SYNC_DRAINING:
+                self.state = SYNC_ONLINE
+        self._publish()
+
+    def mark_offline(self):
+        with self._lock:
+            self.state = SYNC_OFFLINE
+        self._publish()
+
+    def retry_due(self):
+        """Пора повторить синхронизацию: она не идет и пауза после неудачи истекла"""
+        with self._lock:
+            return self.state != SYNC_DRAINING and time.monotonic() >= self._retry_at
+
+    def _update(self, stats):
+        acknowledged = self._acknowledged + stats['acknowledged']
+        queued = self._acknowledged + stats['queued']
+        remaining = queued - acknowledged - stats['failed']
+        elapsed = time.time() - self.progress['started_at']
+        self.progress.update({
+            'queued': queued,
+            'sent': self._sent + stats['sent'],
+            'acknowledged': acknowledged,
+            'failed': stats['failed'],
+            'eta_seconds': round(remaining * elapsed / acknowledged, 1) if acknowledged else None
+        })
+        self._publish()
+
+    def _run(self, pi_id):
+        self._acknowledged = self._sent = 0
+        try:
+            # Повторяем проходы, пока пользователи дописывают в очередь; выходим, когда проход
+            # не нашел ни одной недоставленной записи
+            rejected = 0
+            while True:
+                stats = replay_sync_queue(pi_id, on_progress=self._update)
+                self._acknowledged += stats['acknowledged']
+                self._sent += stats['sent']
+                rejected += stats['rejected']
+                if pi_id not in connections:
+                    raise Exception("Raspberry Pi disconnected")
+                if stats['queued'] == 0:
+                    break
+                if stats['acknowledged'] + stats['rejected'] == 0:
+                    # Pi не ответил или отказал всей пачке (например, снял ее под нагрузкой)
+                    raise Exception(f"Pi не подтвердил ни одной записи, в очереди {stats['queued']}")
+
+            set_backup_mode(pi_id, False)
+            invalidate_cache()
+            request_replication()
+            # Записи, попавшие в очередь в момент переключения
+            stats = replay_sync_queue(pi_id)
+            rejected += stats['rejected']
+            if stats['acknowledged'] + stats['rejected'] < stats['queued']:
+                # Недоставленные записи не должны отстать от новых: возвращаемся в резерв
+                set_backup_mode(pi_id, True)
+                raise Exception(f"после переключения не доставлено записей: "
+                                f"{stats['queued'] - stats['acknowledged'] - stats['rejected']}")
+            with self._lock:
+                self.state = SYNC_ONLINE
+                self._retries = 0
+            logging.info(f"✅ Синхронизировано записей: {self._acknowledged}, отклонено Pi: {rejected}")
+        except Exception as e:
+            with self._lock:
+                self.state = SYNC_OFFLINE
+                delay = min(SYNC_RETRY_MAX, SYNC_RETRY_MIN * 2 ** self._retries)
+                self._retries += 1
+                self._retry_at = time.monotonic() + delay
+            logging.error(f"❌ Ошибка синхронизации: {e}; повтор не раньше чем через {delay:.0f} с")
+        self.progress['eta_seconds'] = 0 if self.state == SYNC_ONLINE else None
+        self._publish()
+
+    def _publish(self):
+        # Остальные воркеры узнают о ходе синхронизации из bridge_pis
+        shared_state.set_sync(self.pi_id, self.status())
+        socketio.emit('sync_progress', self.status(), room=STATUS_ROOM)
+        publish_status()
+
+    def status(self):
+        return dict(self.progress, state=self.state)
+
+sync_workers = {}
+
+def get_sync_worker(pi_id):
+    worker = sync_workers.get(pi_id)
+    if worker is None:
+        worker = sync_workers.setdefault(pi_id, SyncWorker(pi_id))
+    return worker
+
+def sync_status(pi_id):
+    """Синхронизация Pi по данным воркера-владельца, который ее ведет"""
+    return shared_state.sync(pi_id) or get_sync_worker(pi_id).status()
+
+# Статус для браузеров: рассылается в комнату подписчиков только при изменении.
+# Браузер может быть подключен не к тому воркеру, что изменил статус: пока есть
+# подписчики, воркер опрашивает bridge_pis, и refresh рассылает увиденные изменения
+STATUS_ROOM = 'status_watchers'
+STATUS_POLL_INTERVAL = float(os.environ.get('STATUS_POLL_INTERVAL', 1))
+_status_lock = threading.Lock()
+_last_status = None
+_status_poll_started = threading.Event()
+
+def bridge_status():
+    """Сводка подключения, резервного режима и синхронизации по каждому Pi"""
+    pis = {}
+    for pi_id in sorted(pi_router.known_pis()):
+        sync = sync_status(pi_id)
+        pis[pi_id] = {
+            'connected': pi_connected(pi_id),
+            'backup_mode': shared_state.backup_mode(pi_id),
+            'online': is_online(pi_id),
+            'sync': {key: sync.get(key) for key in ('state', 'queued', 'acknowledged', 'failed', 'eta_seconds')}
+        }
+    all_online = all(pi['online'] for pi in pis.values())
+    return {'raspberry_pi_connected': all_online, 'backup_mode': not all_online, 'pis': pis}
+
+def status_etag(status):
+    return hashlib.sha1(json.dumps(status, sort_keys=True).encode()).hexdigest()[:16]
+
+def publish_status():
+    """Рассылает статус подписчикам, если он изменился с прошлой рассылки"""
+    global _last_status
+    status = bridge_status()
+    etag = status_etag(status)
+    with _status_lock:
+        if etag == _last_status:
+            return
+        _last_status = etag
+    socketio.emit('bridge_status', dict(status, etag=etag), room=STATUS_ROOM)
+
+def trip_pi(pi_id, reason):
+    """Размыкает предохранитель Pi: запросы сразу идут в резервную БД"""
+    get_breaker(pi_id).trip()
+    if not shared_state.backup_mode(pi_id):
+        logging.warning(f"⚠️ {pi_id} переведен в резервный режим: {reason}")
+    set_backup_mode(pi_id, True)
+    get_sync_worker(pi_id).mark_offline()
+
+# Активная проверка связи с Pi
+HEARTBEAT_INTERVAL = float(os.environ.get('HEARTBEAT_INTERVAL', 5))
+HEARTBEAT_TIMEOUT = float(os.environ.get('HEARTBEAT_TIMEOUT', 2))
+_heartbeat_started = threading.Event()
+
+def heartbeat_once():
+    """Пингует все подключенные Pi одновременно и обновляет их предохранители"""
+    probes = {}
+    for pi_id in list(connections):
+        if not get_breaker(pi_id).ready_for_probe():
+            continue
+        try:
+            probes[pi_id] = (time.perf_counter(), dispatch_command(pi_id, 'ping', {}, HEARTBEAT_TIMEOUT))
+        except Exception:
+            continue
+
+    for pi_id, (started, pending) in probes.items():
+        breaker = get_breaker(pi_id)
+        try:
+            # Любой ответ, даже ошибка старой прошивки о неизвестной команде, означает, что Pi жив
+            pending_requests.wait(pending)
+        except Exception as e:
+            if breaker.record_failure():
+                trip_pi(pi_id, f'нет ответа на heartbeat ({e})')
+            continue
+        if breaker.record_success(time.perf_counter() - started):
+            trip_pi(pi_id, 'Pi отвечает слишком медленно')
+        elif shared_state.backup_mode(pi_id) and get_sync_worker(pi_id).retry_due():
+            # Pi снова в норме без переподключения: догоняем очередь и возвращаемся к нему
+            logging.info(f"✅ {pi_id} снова отвечает, начинаем синхронизацию")
+            get_sync_worker(pi_id).start(pi_id)
+
+def heartbeat_loop():
+    while True:
+        socketio.sleep(HEARTBEAT_INTERVAL)
+        try:
+            heartbeat_once()
+        except Exception as e:
+            logging.error(f"❌ Ошибка heartbeat: {e}")
+
+# Репликация: полный снимок данных Pi, затем лента изменений от сохраненной отметки
+REPLICATION_INTERVAL = float(os.environ.get('REPLICATION_INTERVAL', 30))
+REPLICATION_PAGE_SIZE = int(os.environ.get('REPLICATION_PAGE_SIZE', 1000))
+REPLICATION_TIMEOUT = 30
+
+# Таблицы Pi -> резерв. Справочники сливаются по естественному ключу, журнал и ДЗ - по id строки на Pi
+REPLICATED_TABLES = {
+    'teachers': {
+        'columns': ('teacher_id', 'name', 'password', 'role', 'subject'),
+        'upsert': '''
+            INSERT INTO backup_teachers (teacher_id, name, password, role, subject) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (teacher_id) DO UPDATE SET name = excluded.name, password = excluded.password,
+                role = excluded.role, subject = excluded.subject
+        ''',
+        'delete': ('DELETE FROM backup_teachers WHERE teacher_id = ?', ('teacher_id',)),
+        'invalidates': ['get_teachers']
+    },
+    'groups': {
+        'columns': ('name', 'course'),
+        'upsert': '''
+            INSERT INTO backup_groups (name, course) VALUES (?, ?)
+            ON CONFLICT (name) DO UPDATE SET course = excluded.course
+        ''',
+        'delete': ('DELETE FROM backup_groups WHERE name = ?', ('name',)),
+        'invalidates': ['get_groups']
+    },
+    'students': {
+        'columns': ('name', 'group_name', 'student_id'),
+        'upsert': '''
+            INSERT INTO backup_students (name, group_name, student_id) VALUES (?, ?, ?)
+            ON CONFLICT (student_id) DO UPDATE SET name = excluded.name, group_name = excluded.group_name
+        ''',
+        'delete': ('DELETE FROM backup_students WHERE student_id = ?', ('student_id',)),
+        'invalidates': ['get_students', 'get_all_students']
+    },
+    'journal': {
+        'sourced': True,
+        'columns': ('id', 'date', 'student_name', 'group_name', 'subject', 'topic', 'grade', 'attendance',
+                    'comments', 'teacher_id'),
+        'upsert': '''
+            INSERT INTO backup_journal (source_pi, source_id, date, student_name, group_name, subject, topic,
+                grade, attendance, comments, teacher_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (source_pi, source_id) WHERE source_id IS NOT NULL DO UPDATE SET
+                date = excluded.date, student_name = excluded.student_name, group_name = excluded.group_name,
+                subject = excluded.subject, topic = excluded.topic, grade = excluded.grade,
+                attendance = excluded.attendance, comments = excluded.comments, teacher_id = excluded.teacher_id
+        ''',
+        # Строка, записанная мостом (в резерве или зеркалом онлайн-команды), узнается по ключу и ученику
+        'adopt': '''
+            UPDATE backup_journal SET source_pi = ?, source_id = ? WHERE id = (
+                SELECT id FROM backup_journal WHERE sync_key = ? AND student_name = ? AND source_id IS NULL LIMIT 1
+            )
+        ''',
+        'adopt_columns': ('student_name',),
+        'delete': ('DELETE FROM backup_journal WHERE source_pi = ? AND source_id = ?', ('id',)),
+        'purge': 'DELETE FROM backup_journal WHERE source_pi = ? AND date >= ?',
+        # Строки моста, которые Pi уже получил (их нет в очереди), но снимок не смог узнать по ключу
+        'unsourced_groups': 'SELECT DISTINCT group_name FROM backup_journal WHERE source_id IS NULL',
+        'purge_delivered': '''
+            DELETE FROM backup_journal WHERE source_id IS NULL AND group_name = ? AND date >= ?
+                AND sync_key IS NOT NULL
+                AND sync_key NOT IN (SELECT idempotency_key FROM sync_queue WHERE idempotency_key IS NOT NULL)
+        ''',
+        'date': 'date',
+        'invalidates': []
+    },
+    'homework': {
+        'sourced': True,
+        'columns': ('id', 'group_name', 'subject', 'homework_text', 'date_assigned', 'date_due', 'teacher_id'),
+        'upsert': '''
+            INSERT INTO backup_homework (source_pi, source_id, group_name, subject, homework_text, date_assigned,
+                date_due, teacher_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (source_pi, source_id) WHERE source_id IS NOT NULL DO UPDATE SET
+                group_name = excluded.group_name, subject = excluded.subject, homework_text = excluded.homework_text,
+                date_assigned = excluded.date_assigned, date_due = excluded.date_due, teacher_id = excluded.teacher_id
+        ''',
+        'adopt': '''
+            UPDATE backup_homework SET source_pi = ?, source_id = ? WHERE id = (
+                SELECT id FROM backup_homework WHERE sync_key = ? AND source_id IS NULL LIMIT 1
+            )
+        ''',
+        'adopt_columns': (),
+        'delete': ('DELETE FROM backup_homework WHERE source_pi = ? AND source_id = ?', ('id',)),
+        'purge': 'DELETE FROM backup_homework WHERE source_pi = ? AND date_assigned >= ?',
+        'unsourced_groups': 'SELECT DISTINCT group_name FROM backup_homework WHERE source_id IS NULL',
+        'purge_delivered': '''
+            DELETE FROM backup_homework WHERE source_id IS NULL AND group_name = ? AND date_assigned >= ?
+                AND sync_key IS NOT NULL
+                AND sync_key NOT IN (SELECT idempotency_key FROM sync_queue WHERE idempotency_key IS NOT NULL)
+        ''',
+        'date': 'date_assigned',
+        'invalidates': ['get_homework']
+    }
+}
+
+replication_status = {}
+_replication_wakeup = threading.Event()
+_replication_started = threading.Event()
+
+def apply_replicated_rows(conn, pi_id, table, rows):
+    """Вставляет или обновляет строки таблицы Pi пачкой executemany"""
+    spec = REPLICATED_TABLES[table]
+    prefix = (pi_id,) if spec.get('sourced') else ()
+    cutoff = spec.get('date') and archived_until(conn)
+    if cutoff:
+        # Закрытые семестры уже в архиве и не меняются; иначе снимок вернул бы их в рабочие таблицы
+        rows = [row for row in rows if not row.get(spec['date']) or row[spec['date']] >= cutoff]
+    if spec.get('adopt'):
+        conn.executemany(spec['adopt'], [
+            (pi_id, row['id'], row['idempotency_key']) + tuple(row.get(c) for c in spec['adopt_columns'])
+            for row in rows if row.get('idempotency_key')
+        ])
+    conn.executemany(spec['upsert'], [prefix + tuple(row.get(c) for c in spec['columns']) for row in rows])
+
+def delete_replicated_rows(conn, pi_id, table, rows):
+    spec = REPLICATED_TABLES[table]
+    sql, key_columns = spec['delete']
+    prefix = (pi_id,) if spec.get('sourced') else ()
+    conn.executemany(sql, [prefix + tuple(row.get(c) for c in key_columns) for row in rows])
+
+def purge_delivered_rows(conn, pi_id, table):
+    """Удаляет строки, записанные мостом в резерв и уже доставленные на этот Pi.
+
+    Снимок содержит их копии, а узнать строку по ключу можно, только если Pi отдает
+    idempotency_key в строках снимка. Строки, ждущие в очереди (или отклоненные Pi),
+    остаются; закрытые семестры снимок не трогает, их строки тоже остаются.
+    """
+    spec = REPLICATED_TABLES[table]
+    groups = [group for (group,) in conn.execute(spec['unsourced_groups'])
+              if pi_router.route({'group_name': group}) == pi_id]
+    cutoff = archived_until(conn) or ''
+    conn.executemany(spec['purge_delivered'], [(group, cutoff) for group in groups])
+
+def save_replication_version(conn, pi_id, version, snapshot=False):
+    conn.execute('''
+        INSERT INTO replication_state (pi_id, version, snapshot_version, updated_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT (pi_id) DO UPDATE SET version = excluded.version, updated_at = excluded.updated_at,
+            snapshot_version = COALESCE(excluded.snapshot_version, snapshot_version)
+    ''', (pi_id, version, version if snapshot else None, time.time()))
+
+def save_snapshot(pi_id, version, tables):
+    with backup_transaction(immediate=True) as conn:
+        for table, rows in tables.items():
+            spec = REPLICATED_TABLES[table]
+            if spec.get('purge'):
+                # Строки этого Pi заменяются снимком; строки, еще не дошедшие до Pi, остаются.
+                # Закрытые семестры снимок не возвращает, поэтому и не удаляет: их строки ждут архивации
+                conn.execute(spec['purge'], (pi_id, archived_until(conn) or ''))
+            apply_replicated_rows(conn, pi_id, table, rows)
+            if spec.get('purge_delivered'):
+                # Сначала снимок забирает свои строки по ключу, остальные доставленные - дубли
+                purge_delivered_rows(conn, pi_id, table)
+        save_replication_version(conn, pi_id, version, snapshot=True)
+
+def load_snapshot(pi_id):
+    """Забирает все таблицы Pi постранично и загружает их в резерв одной транзакцией"""
+    version = None
+    tables = {}
+    for table in REPLICATED_TABLES:
+        rows = tables[table] = []
+        cursor = None
+        while True:
+            response = send_command_direct(pi_id, 'get_snapshot',
+                                           {'table': table, 'cursor': cursor, 'limit': REPLICATION_PAGE_SIZE},
+                                           REPLICATION_TIMEOUT)
+            if response.get('status') != 'success':
+                raise Exception(response.get('message', 'снимок не получен'))
+            # Версия на начало снимка: изменения, сделанные во время выгрузки, догонит лента
+            if version is None:
+                version = response['version']
+            rows.extend(response.get('rows', []))
+            cursor = response.get('next_cursor')
+            if not cursor:
+                break
+
+    run_blocking(save_snapshot, pi_id, version, tables)
+    invalidate_cache()
+    return version, sum(len(rows) for rows in tables.values())
+
+def apply_changes(pi_id, changes):
+    """Применяет страницу ленты одной транзакцией; возвращает команды, чей кэш устарел"""
+    touched = set()
+    with backup_transaction(immediate=True) as conn:
+        # Подряд идущие изменения одной таблицы и типа применяются одной пачкой, порядок сохраняется
+        start = 0
+        while start < len(changes):
+            end = start
+            table, op = changes[start]['table'], changes[start]['op']
+            while end < len(changes) and (changes[end]['table'], changes[end]['op']) == (table, op):
+                end += 1
+            rows = [change['row'] for change in changes[start:end]]
+            if op == 'delete':
+                delete_replicated_rows(conn, pi_id, table, rows)
+            else:
+                apply_replicated_rows(conn, pi_id, table, rows)
+            touched.update(REPLICATED_TABLES[table]['invalidates'])
+            start = end
+        save_replication_version(conn, pi_id, changes[-1]['version'])
+    return touched
+
+def pull_changes(pi_id, version):
+    """Применяет ленту изменений после отметки; None - Pi требует новый снимок"""
+    applied = 0
+    while True:
+        response = send_command_direct(pi_id, 'get_changes', {'since': version, 'limit': REPLICATION_PAGE_SIZE},
+                                       REPLICATION_TIMEOUT)
+        if response.get('snapshot_required'):
+            return None, applied
+        if response.get('status') != 'success':
+            raise Exception(response.get('message', 'лента изменений не получена'))
+        changes = response.get('changes', [])
+        if not changes:
+            return version, applied
+
+        touched = run_blocking(apply_changes, pi_id, changes)
+        version = changes[-1]['version']
+        if touched:
+            invalidate_cache(touched)
+        applied += len(changes)
+        if not response.get('has_more'):
+            return version, applied
+
+def replicate_pi(pi_id):
+    """Доводит резерв до текущего состояния Pi: снимок при первом подключении, дальше только дельты"""
+    rows = query_backup('SELECT version FROM replication_state WHERE pi_id = ?', (pi_id,))
+    status = replication_status.setdefault(pi_id, {})
+    snapshot_rows = None
+    version = rows[0][0] if rows else None
+    if version is None:
+        version, snapshot_rows = load_snapshot(pi_id)
+    version, applied = pull_changes(pi_id, version)
+    if version is None:
+        # Pi уже обрезал ленту до нашей отметки
+        logging.warning(f"⚠️ Лента изменений {pi_id} обрезана, загружаем снимок заново")
+        version, snapshot_rows = load_snapshot(pi_id)
+        version, applied = pull_changes(pi_id, version)
+    status.update({'version': version, 'applied': status.get('applied', 0) + applied,
+                   'updated_at': time.time(), 'error': None})
+    if snapshot_rows is not None:
+        status['snapshot_rows'] = snapshot_rows
+        logging.info(f"✅ Снимок {pi_id} загружен в резерв: {snapshot_rows} строк, версия {version}")
+
+def replication_loop():
+    while True:
+        _replication_wakeup.wait(REPLICATION_INTERVAL)
+        _replication_wakeup.clear()
+        # Пока Pi догоняет очередь, его данные неполны: реплицируем только онлайн
+        for pi_id in [pi_id for pi_id in list(connections) if is_online(pi_id)]:
+            try:
+                replicate_pi(pi_id)
+            except Exception as e:
+                replication_status.setdefault(pi_id, {})['error'] = str(e)
+                logging.warning(f"⚠️ Репликация {pi_id} не удалась: {e}")
+
+def request_replication():
+    """Будит репликацию (подключение Pi, окончание синхронизации очереди)"""
+    if not _replication_started.is_set():
+        _replication_started.set()
+        socketio.start_background_task(replication_loop)
+    _replication_wakeup.set()
+
+def start_heartbeat():
+    if not _heartbeat_started.is_set():
+        _heartbeat_started.set()
+        socketio.start_background_task(heartbeat_loop)
+
+def status_poll_loop():
+    while True:
+        socketio.sleep(STATUS_POLL_INTERVAL)
+        try:
+            shared_state.refresh()
+        except Exception as e:
+            logging.error(f"❌ Ошибка опроса общего состояния: {e}")
+
+def start_status_poll():
+    if not _status_poll_started.is_set():
+        _status_poll_started.set()
+        socketio.start_background_task(status_poll_loop)
+
+def dispatch_command(pi_id, command, data, timeout=10):
+    """Отправляет команду на Raspberry Pi и возвращает ожидающий ответа запрос"""
     if pi_id not in connections:
         raise Exception("Raspberry Pi not connected")
-    
-    request_id = str(uuid.uuid4())
+
+    on_finish = None
+    if command not in UNSCHEDULED_COMMANDS:
+        # Ожидание в очереди расходует тот же дедлайн, что и ответ Pi
+        started = time.monotonic()
+        command_scheduler.acquire(pi_id, command_priority(command, data), timeout)
+        timeout = max(0, timeout - (time.monotonic() - started))
+        on_finish = lambda: command_scheduler.release(pi_id)
+
+    pending = pending_requests.register(pi_id, command, timeout, on_finish)
     command_data = {
-        'request_id': request_id,
+        'request_id': pending.request_id,
         'command': command,
         'data': data
     }
-    
-    pending_requests[request_id] = None
-    emit('command', command_data, room=connections[pi_id])
-    
-    start_time = time.time()
-    while time.time() - start_time < timeout:
-        if pending_requests.get(request_id) is not None:
-            response = pending_requests[request_id]
-            del pending_requests[request_id]
-            return response
-        time.sleep(0.1)
-    
-    if request_id in pending_requests:
-        del pending_requests[request_id]
-    raise Exception("Timeout")
+
+    try:
+        sid = connections[pi_id]
+        # socketio.emit работает и вне обработчиков сокета (HTTP-запросы, фоновые задачи)
+        pending.sent_at = time.perf_counter()
+        socketio.emit('command', encode_for_pi(sid, command, command_data), room=sid)
+    except Exception:
+        pending_requests.cancel(pending)
+        raise
+    return pending
+
+# Формат канала с Pi, согласованный при подключении (по sid соединения)
+WIRE_COMPRESS_MIN_BYTES = int(os.environ.get('WIRE_COMPRESS_MIN_BYTES', wire.COMPRESS_MIN_BYTES))
+wire_codecs = {}
+
+def encode_for_pi(sid, command, message):
+    """Кодирует команду в формат соединения и учитывает объем и время"""
+    codec = wire_codecs.get(sid)
+    if codec is None:
+        # Старая прошивка: объект сериализует Socket.IO, размер считаем для сравнения
+        metrics.add('wire_bytes', len(json.dumps(message)), command=command, direction='out', format='json')
+        return message
+    started = time.perf_counter()
+    frame = codec.encode(message)
+    metrics.add('wire_codec_seconds', time.perf_counter() - started, command=command, stage='encode')
+    metrics.add('wire_bytes', len(frame), command=command, direction='out', format=codec.settings['format'])
+    return frame
+
+def decode_from_pi(sid, payload):
+    """Разбирает ответ Pi: кадр (бинарный или base64) или обычный объект старой прошивки.
+
+    Поврежденный кадр не разобрать, запрос завершится по таймауту. Соединение после
+    этого переводим на обычные объекты: Pi принимает их при любом согласованном формате.
+    """
+    if not isinstance(payload, (bytes, bytearray, str)):
+        pending = pending_requests.get((payload or {}).get('request_id'))
+        command = pending.command if pending else 'unknown'
+        metrics.add('wire_bytes', len(json.dumps(payload)), command=command, direction='in', format='json')
+        return payload
+    started = time.perf_counter()
+    try:
+        message = wire.WireCodec.decode(payload)
+    except wire.FrameError as e:
+        metrics.inc('wire_errors', direction='in')
+        if wire_codecs.pop(sid, None):
+            logging.warning(f"⚠️ {e}; соединение {sid} переведено на JSON-объекты")
+        return None
+    elapsed = time.perf_counter() - started
+    pending = pending_requests.get(message.get('request_id'))
+    command = pending.command if pending else 'unknown'
+    codec = wire_codecs.get(sid)
+    metrics.add('wire_codec_seconds', elapsed, command=command, stage='decode')
+    metrics.add('wire_bytes', len(payload), command=command, direction='in',
+                format=codec.settings['format'] if codec else 'binary')
+    return message
+
+def send_command_direct(pi_id, command, data, timeout=10):
+    """Прямая отправка команды на Raspberry Pi"""
+    return send_command_timed(pi_id, command, data, timeout)[0]
+
+def send_command_timed(pi_id, command, data, timeout=10):
+    """Прямая отправка команды; возвращает ответ и задержку самого Pi.
+
+    Задержка считается от отправки команды, без ожидания места в планировщике:
+    очередь на нашей стороне не должна размыкать предохранитель Pi.
+    """
+    started = time.perf_counter()
+    try:
+        if pi_id in connections:
+            pending = dispatch_command(pi_id, command, data, timeout)
+            response = pending_requests.wait(pending)
+            round_trip = pending.round_trip()
+        else:
+            # Сокет Pi держит другой воркер: команда идет через него
+            response, round_trip = peer_bridge.forward(pi_id, command, data, timeout)
+    except PiTimeoutError:
+        metrics.inc('command_timeouts', command=command)
+        raise
+    metrics.observe('pi', command, time.perf_counter() - started)
+    return response, round_trip
+
+def search_hit_key(row):
+    """Одно и то же совпадение с разных Pi и из резерва: id строк там разные, поэтому ключ естественный"""
+    if row.get('type') == 'homework':
+        return row['type'], row.get('group_name'), row.get('subject'), row.get('date_assigned'), row.get('homework_text')
+    if row.get('type') == 'student':
+        return row['type'], row.get('student_id') or (row.get('name'), row.get('group_name'))
+    return row.get('type'), row.get('id')
+
+# Чтения по всей школе: опрашиваются все Pi одновременно, ответы сливаются
+FAN_OUT_MERGE = {
+    'get_groups': {
+        'key': lambda row: row.get('name'),
+        'sort': lambda row: (row.get('course') or '', row.get('name') or '')
+    },
+    'get_teachers': {
+        'key': lambda row: row.get('id'),
+        'sort': lambda row: (row.get('name') or '', row.get('id') or '')
+    },
+    'get_all_students': {
+        'key': lambda row: row.get('student_id') or (row.get('name'), row.get('group_name')),
+        'sort': lambda row: (row.get('group_name') or '', row.get('name') or '', row.get('id') or 0)
+    },
+    # Совпадения ищутся на всех Pi; ранги разных БД сравнимы лишь приблизительно, но порядок по ним разумный
+    'search': {
+        'key': lambda row: search_hit_key(row),
+        'sort': lambda row: row.get('rank') or 0
+    }
+}
+
+# Учетная запись преподавателя может жить на любом Pi: берется первый успешный ответ
+FAN_OUT_FIRST_SUCCESS = {'login'}
+
+def merge_fan_out(command, data, results):
+    """Сливает ответы нескольких Pi: без дублей, в общем порядке сортировки, с учетом limit"""
+    merge = FAN_OUT_MERGE[command]
+    ok = [result for result in results.values() if result.get('status') == 'success']
+    if not ok:
+        return next(iter(results.values()))
+
+    rows = {}
+    has_more = False
+    for result in ok:
+        for row in result.get('data', []):
+            rows.setdefault(merge['key'](row), row)
+        has_more = has_more or bool(result.get('next_cursor'))
+    merged = sorted(rows.values(), key=merge['sort'])
+
+    # Каждый Pi вернул свои первые limit строк после курсора, поэтому общие первые limit строк точные
+    limit = data.get('limit')
+    if limit and len(merged) > limit:
+        merged = merged[:limit]
+        has_more = True
+    next_cursor = None
+    if has_more and merged and command in PAGED_QUERIES:
+        next_cursor = page_cursor(command, merged[-1])
+    return {
+        'status': 'success',
+        'data': merged,
+        'next_cursor': next_cursor,
+        'backup_mode': any(result.get('backup_mode') for result in results.values()),
+        'sources': {pi_id: result.get('status') for pi_id, result in results.items()}
+    }
+
+def send_command_each(pi_ids, command, data, timeout=10):
+    """send_command на каждый Pi в своей фоновой задаче (зеленой в асинхронном режиме).
+
+    Общего пула потоков нет: сколько команд ждет ответа, ограничивает планировщик
+    каждого Pi (PI_MAX_IN_FLIGHT), а не число рабочих потоков моста.
+    """
+    if len(pi_ids) == 1:
+        return {pi_ids[0]: send_command(pi_ids[0], command, data, timeout)}
+
+    outcomes = {}
+
+    def call(pi_id, finished):
+        try:
+            outcomes[pi_id] = (send_command(pi_id, command, data, timeout), None)
+        except Exception as e:
+            outcomes[pi_id] = (None, e)
+        finally:
+            finished.set()
+
+    events = {pi_id: threading.Event() for pi_id in pi_ids}
+    for pi_id, finished in events.items():
+        socketio.start_background_task(call, pi_id, finished)
+    results = {}
+    for pi_id, finished in events.items():
+        finished.wait()
+        result, error = outcomes[pi_id]
+        if error is not None:
+            raise error
+        results[pi_id] = result
+    return results
+
+def fan_out_command(command, data, timeout=10):
+    """Одна и та же команда всем подключенным Pi параллельно"""
+    pi_ids = sorted(pi_id for pi_id in pi_router.known_pis() if is_online(pi_id))
+    if not pi_ids:
+        return process_in_backup_mode(command, data)
+
+    results = send_command_each(pi_ids, command, data, timeout)
+
+    if command in FAN_OUT_FIRST_SUCCESS:
+        for result in results.values():
+            if result.get('status') == 'success':
+                return result
+        return results[pi_ids[0]]
+
+    if command == 'get_groups':
+        for pi_id, result in results.items():
+            if result.get('status') == 'success' and not result.get('backup_mode'):
+                for group in result.get('data', []):
+                    pi_router.learn(group.get('name'), pi_id)
+
+    # Если какой-то Pi недоступен, его часть данных берется из резервной БД
+    if any(not is_online(pi_id) for pi_id in pi_router.known_pis()):
+        results['backup'] = process_in_backup_mode(command, data)
+    return merge_fan_out(command, data, results)
+
+def route_command(command, data, timeout=10):
+    """Отправляет команду на Pi, который обслуживает группу/корпус, или на все Pi для общих чтений"""
+    if command in FAN_OUT_MERGE or command in FAN_OUT_FIRST_SUCCESS:
+        return fan_out_command(command, data, timeout)
+    return send_command(pi_router.route(data), command, data, timeout)
+
+def stream_rows(command, data):
+    """Строки списка по одной: из курсора SQLite в резервном режиме или страницами с Pi"""
+    if command in FAN_OUT_MERGE:
+        targets = [pi_id for pi_id in pi_router.known_pis() if is_online(pi_id)]
+    else:
+        targets = [pi_id for pi_id in [pi_router.route(data)] if is_online(pi_id)]
+    if not targets:
+        yield from iter_backup_rows(command, data)
+        return
+
+    # Курсор не зависит от источника: если Pi пропадет, send_command продолжит с той же строки из резерва
+    page = dict(data, limit=STREAM_PAGE_SIZE)
+    while True:
+        try:
+            result = route_command(command, page)
+        except PiOverloadedError as e:
+            # Заголовки уже отправлены: ошибка идет последней строкой потока
+            result = {'status': 'error', 'message': str(e)}
+        if result.get('status') != 'success':
+            yield {'status': 'error', 'message': result.get('message')}
+            return
+        yield from result.get('data', [])
+        if not result.get('next_cursor'):
+            return
+        page['cursor'] = result['next_cursor']
+
+def list_response(command, data):
+    """Ответ списочного эндпоинта: весь список, страница (?limit=&cursor=) или NDJSON-поток (?format=ndjson)"""
+    limit = request.args.get('limit', type=int)
+    if limit:
+        data['limit'] = max(1, min(limit, MAX_PAGE_SIZE))
+    if request.args.get('cursor'):
+        data['cursor'] = request.args['cursor']
+
+    if request.args.get('format') == 'ndjson':
+        lines = (json.dumps(row, ensure_ascii=False) + '\n' for row in stream_rows(command, data))
+        return Response(stream_with_context(lines), mimetype='application/x-ndjson')
+
+    result = route_command(command, data)
+    return jsonify(result)
+
+# Аналитика журнала: читается из сводок, поэтому не зависит от того, сколько лет журнала хранится
+ANALYTICS_DIMENSIONS = {'group': 'group_name', 'subject': 'subject', 'period': 'period', 'student': 'student_name'}
+PERIOD_RE = re.compile(r'\d{4}-\d{2}')
+
+def analytics_measures(entries, graded, grade_sum, present):
+    entries = entries or 0
+    graded = graded or 0
+    return {
+        'entries': entries,
+        'graded': graded,
+        'average_grade': round(grade_sum / graded, 2) if graded else None,
+        'attendance_percent': round(100 * present / entries, 1) if entries else None
+    }
+
+def journal_analytics(conn, filters, by):
+    """Оценки и посещаемость, сгруппированные по измерениям by (group, subject, period, student)"""
+    # Сводка по студентам нужна, только если студент участвует в фильтре или группировке
+    table = 'journal_student_stats' if 'student' in by or filters.get('student_name') else 'journal_group_stats'
+    columns = [ANALYTICS_DIMENSIONS[dimension] for dimension in by]
+    where = []
+    params = []
+    for column in ('group_name', 'subject', 'student_name'):
+        if filters.get(column):
+            where.append(f'{column} = ?')
+            params.append(filters[column])
+    if filters.get('from'):
+        where.append('period >= ?')
+        params.append(filters['from'])
+    if filters.get('to'):
+        where.append('period <= ?')
+        params.append(filters['to'])
+
+    sql = f"SELECT {', '.join(columns + ['SUM(entries)', 'SUM(graded)', 'SUM(grade_sum)', 'SUM(present)'])} FROM {table}"
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    if columns:
+        sql += f" GROUP BY {', '.join(columns)} ORDER BY {', '.join(columns)}"
+    return [dict(zip(columns, row), **analytics_measures(*row[len(columns):]))
+            for row in conn.execute(sql, params).fetchall()]
 
 # API endpoints
+@app.errorhandler(PiOverloadedError)
+def pi_overloaded(error):
+    """Очередь к Pi полна: быстрый отказ, клиент повторит запрос позже"""
+    response = jsonify({'status': 'error', 'message': str(error), 'overloaded': True})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
 @app.route('/api/groups')
 def get_groups():
-    result = send_command('default_pi', 'get_groups', {})
+    result = route_command('get_groups', {})
     return jsonify(result)
 
 @app.route('/api/students/<group_name>')
 def get_students(group_name):
-    result = send_command('default_pi', 'get_students', {'group_name': group_name})
-    return jsonify(result)
+    return list_response('get_students', {'group_name': group_name})
 
 @app.route('/api/all_students')
 def get_all_students():
-    result = send_command('default_pi', 'get_all_students', {})
-    return jsonify(result)
+    return list_response('get_all_students', {})
 
 @app.route('/api/teachers')
 def get_teachers():
-    result = send_command('default_pi', 'get_teachers', {})
-    return jsonify(result)
+    return list_response('get_teachers', {})
 
 @app.route('/api/login', methods=['POST'])
 def login():
     data = request.json
-    result = send_command('default_pi', 'login', data)
+    result = route_command('login', data)
     return jsonify(result)
 
 @app.route('/api/admin/add_group', methods=['POST'])
 def add_group():
     data = request.json
-    result = send_command('default_pi', 'add_group', data)
+    result = route_command('add_group', data)
     return jsonify(result)
 
 @app.route('/api/admin/add_student', methods=['POST'])
 def add_student():
     data = request.json
-    result = send_command('default_pi', 'add_student', data)
+    result = route_command('add_student', data)
     return jsonify(result)
 
 @app.route('/api/admin/add_teacher', methods=['POST'])
 def add_teacher():
     data = request.json
-    result = send_command('default_pi', 'add_teacher', data)
+    result = route_command('add_teacher', data)
     return jsonify(result)
 
+# Массовый импорт студентов из CSV: строки читаются потоком и уходят на Pi пачками через sync_batch
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 500))
+IMPORT_TIMEOUT = 30
+IMPORT_MAX_NAME = 200
+
+# Допустимые заголовки столбцов (без учета регистра)
+IMPORT_COLUMNS = {
+    'student_name': ('student_name', 'name', 'фио', 'студент'),
+    'group_name': ('group_name', 'group', 'группа'),
+    'student_id': ('student_id', 'номер', 'номер студента')
+}
+
+def read_import_csv(stream):
+    """(номер строки, поля) по одной строке файла; разделитель - запятая или точка с запятой (Excel)"""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    header_line = text.readline()
+    delimiter = ';' if header_line.count(';') > header_line.count(',') else ','
+    reader = csv.reader(chain([header_line], text), delimiter=delimiter)
+    header = [name.strip().lower() for name in next(reader, [])]
+    positions = {}
+    for field, aliases in IMPORT_COLUMNS.items():
+        found = [i for i, name in enumerate(header) if name in aliases]
+        if found:
+            positions[field] = found[0]
+    missing = [field for field in ('student_name', 'group_name') if field not in positions]
+    if missing:
+        raise ValueError(f"В заголовке нет столбцов: {', '.join(missing)}")
+
+    for values in reader:
+        if not any(value.strip() for value in values):
+            continue
+        yield reader.line_num, {field: values[i].strip() if i < len(values) else '' for field, i in positions.items()}
+
+def validate_import_row(row, seen_ids):
+    """Возвращает текст ошибки для строки импорта или None"""
+    if not row['student_name']:
+        return 'Не указано ФИО'
+    if not row['group_name']:
+        return 'Не указана группа'
+    if len(row['student_name']) > IMPORT_MAX_NAME or len(row['group_name']) > IMPORT_MAX_NAME:
+        return 'Слишком длинное значение'
+    if row.get('student_id'):
+        if row['student_id'] in seen_ids:
+            return 'Номер студента повторяется в файле'
+        seen_ids.add(row['student_id'])
+    return None
+
+def write_import_backup(pi_id, items, queue):
+    """Группы и студенты пачки в резерв одной транзакцией; queue - еще и в очередь синхронизации Pi"""
+    with backup_transaction(immediate=True) as conn:
+        conn.executemany('INSERT OR IGNORE INTO backup_groups (name, course) VALUES (?, ?)',
+                         [(item['data']['group_name'], 'Новый курс') for item in items if item['command'] == 'add_group'])
+        conn.executemany('INSERT OR IGNORE INTO backup_students (name, group_name, student_id) VALUES (?, ?, ?)',
+                         [(item['data']['student_name'], item['data']['group_name'], item['data'].get('student_id'))
+                          for item in items if item['command'] == 'add_student'])
+        if queue:
+            conn.executemany('INSERT INTO sync_queue (action_type, data_json, idempotency_key, pi_id) VALUES (?, ?, ?, ?)',
+                             [(item['command'], json.dumps(item['data']), item['idempotency_key'], pi_id) for item in items])
+
+def import_chunk(pi_id, items):
+    """Отправляет пачку импорта на Pi одной командой, без связи - в резерв и очередь.
+
+    Возвращает {ключ идемпотентности: (статус, сообщение)}.
+    """
+    if is_online(pi_id):
+        try:
+            response = send_command_direct(pi_id, 'sync_batch', {'items': items}, IMPORT_TIMEOUT)
+        except PiOverloadedError as e:
+            return {item['idempotency_key']: ('error', str(e)) for item in items}
+        except Exception as e:
+            logging.warning(f"⚠️ Импорт на {pi_id} прерван: {e}")
+            # Остаток импорта пойдет через очередь, поэтому Pi переводится в резервный режим
+            trip_pi(pi_id, str(e))
+        else:
+            results = {r.get('idempotency_key'): r for r in response.get('results') or []}
+            outcome = {}
+            for item in items:
+                r = results.get(item['idempotency_key']) or {'status': 'error', 'message': response.get('message')}
+                status = 'success' if r.get('status') in ('success', 'duplicate') else 'error'
+                outcome[item['idempotency_key']] = (status, r.get('message'))
+            run_blocking(write_import_backup, pi_id,
+                         [item for item in items if outcome[item['idempotency_key']][0] == 'success'], False)
+            return outcome
+
+    run_blocking(write_import_backup, pi_id, items, True)
+    return {item['idempotency_key']: ('success', None) for item in items}
+
+def existing_student_ids(student_ids):
+    if not student_ids:
+        return set()
+    return {row[0] for row in get_backup_db().execute(
+        f"SELECT student_id FROM backup_students WHERE student_id IN ({','.join('?' * len(student_ids))})",
+        student_ids
+    )}
+
+@app.route('/api/admin/import_students', methods=['POST'])
+def import_students():
+    """CSV файлом (поле file) или телом запроса: ФИО, группа, номер студента; ?teacher_id= администратора.
+
+    Недостающие группы создаются. В ответе - итоги и ошибки по номерам строк файла.
+    """
+    teacher_id = request.args.get('teacher_id')
+    if request.mimetype == 'multipart/form-data':
+        upload = request.files.get('file')
+        if upload is None:
+            return jsonify({'status': 'error', 'message': 'Файл не передан'})
+        teacher_id = teacher_id or request.form.get('teacher_id')
+        stream = upload.stream
+    else:
+        stream = request.stream
+    if not run_blocking(check_permission, teacher_id, 'admin'):
+        return jsonify({'status': 'error', 'message': 'Только администратор может добавлять студентов'})
+
+    shared_state.refresh(force=True)
+    known_groups = {name for (name,) in query_backup('SELECT name FROM backup_groups')}
+    report = {'imported': 0, 'failed': 0, 'groups_created': [], 'errors': []}
+    seen_ids = set()
+
+    def fail(line, message):
+        report['failed'] += 1
+        report['errors'].append({'line': line, 'message': message})
+
+    def flush(chunk):
+        existing = run_blocking(existing_student_ids, [row['student_id'] for _, row in chunk if row['student_id']])
+        batches = {}
+        lines = {}
+        for line, row in chunk:
+            if row['student_id'] in existing:
+                fail(line, 'Студент с таким номером уже есть')
+                continue
+            items = batches.setdefault(pi_router.route(row), [])
+            if row['group_name'] not in known_groups:
+                known_groups.add(row['group_name'])
+                key = uuid.uuid4().hex
+                lines[key] = ('group', row['group_name'])
+                items.append({'idempotency_key': key, 'command': 'add_group',
+                              'data': {'teacher_id': teacher_id, 'group_name': row['group_name']}})
+            key = uuid.uuid4().hex
+            lines[key] = ('student', line)
+            data = {'teacher_id': teacher_id, 'student_name': row['student_name'], 'group_name': row['group_name']}
+            if row['student_id']:
+                data['student_id'] = row['student_id']
+            items.append({'idempotency_key': key, 'command': 'add_student', 'data': data})
+
+        for pi_id, items in batches.items():
+            for key, (status, message) in import_chunk(pi_id, items).items():
+                kind, value = lines[key]
+                if kind == 'group':
+                    if status == 'success':
+                        report['groups_created'].append(value)
+                    else:
+                        # Следующая пачка попробует создать группу снова
+                        known_groups.discard(value)
+                elif status == 'success':
+                    report['imported'] += 1
+                else:
+                    fail(value, message or 'Pi не принял запись')
+
+    chunk = []
+    try:
+        for line, row in read_import_csv(stream):
+            error = validate_import_row(row, seen_ids)
+            if error:
+                fail(line, error)
+                continue
+            chunk.append((line, row))
+            if len(chunk) >= IMPORT_CHUNK_SIZE:
+                flush(chunk)
+                chunk = []
+        if chunk:
+            flush(chunk)
+    except (ValueError, csv.Error) as e:
+        # Плохая кодировка или заголовок: уже обработанные пачки остаются, файл дальше не читается
+        report['errors'].append({'line': None, 'message': str(e)})
+    finally:
+        if report['imported'] or report['groups_created']:
+            invalidate_cache(CACHE_INVALIDATION['add_group'] + CACHE_INVALIDATION['add_student'])
+
+    report['errors'].sort(key=lambda error: error['line'] or 0)
+    return jsonify(dict(report, status='success' if report['imported'] and not report['errors'] else 'error'))
+
 @app.route('/api/journal/entry', methods=['POST'])
 def add_journal_entry():
     data = request.json
-    result = send_command('default_pi', 'add_journal_entry', data)
+    if not isinstance(data, dict) or not valid_date(data.get('date')):
+        return jsonify({'status': 'error', 'message': 'Дата должна быть в формате ГГГГ-ММ-ДД'}), 400
+    result = route_command('add_journal_entry', data)
     return jsonify(result)
 
+JOURNAL_BATCH_LIMIT = 200
+
+def valid_date(value):
+    """Необязательная дата: не указана или строка ГГГГ-ММ-ДД"""
+    return value is None or isinstance(value, str) and DATE_RE.fullmatch(value) is not None
+
+def validate_journal_entry(entry, batch):
+    """Возвращает текст ошибки для записи пачки или None"""
+    if not isinstance(entry, dict) or not entry.get('student_name'):
+        return 'Не указан студент'
+    if not entry.get('topic', batch.get('topic')):
+        return 'Не указана тема'
+    if not valid_date(entry.get('date')):
+        return 'Дата должна быть в формате ГГГГ-ММ-ДД'
+    grade = entry.get('grade')
+    if grade is not None and (not isinstance(grade, int) or isinstance(grade, bool) or not 1 <= grade <= 5):
+        return 'Оценка должна быть от 1 до 5'
+    return None
+
+@app.route('/api/journal/entries', methods=['POST'])
+def add_journal_entries():
+    """Пачка оценок одной группы по одному предмету за одну дату"""
+    data = request.json or {}
+    entries = (data.get('entries') or []) if isinstance(data, dict) else None
+    if not isinstance(entries, list):
+        return jsonify({'status': 'error', 'message': 'entries должен быть списком записей'}), 400
+    if not valid_date(data.get('date')):
+        return jsonify({'status': 'error', 'message': 'Дата должна быть в формате ГГГГ-ММ-ДД'}), 400
+    if not data.get('group_name') or not data.get('subject'):
+        return jsonify({'status': 'error', 'message': 'Не указаны группа или предмет'})
+    if len(entries) > JOURNAL_BATCH_LIMIT:
+        return jsonify({'status': 'error', 'message': f'Не больше {JOURNAL_BATCH_LIMIT} записей за раз'})
+
+    results = [None] * len(entries)
+    valid = []
+    for index, entry in enumerate(entries):
+        error = validate_journal_entry(entry, data)
+        if error:
+            results[index] = {'index': index, 'status': 'error', 'message': error}
+        else:
+            valid.append(index)
+
+    result = {'status': 'error', 'message': 'Нет корректных записей'}
+    if valid:
+        # Дата фиксируется здесь, чтобы повторная отправка из очереди дала те же записи
+        payload = dict(data, date=data.get('date') or datetime.now().strftime('%Y-%m-%d'),
+                       entries=[entries[index] for index in valid])
+        result = route_command('add_journal_entries', payload)
+        entry_results = result.get('results')
+        if not entry_results or len(entry_results) != len(valid):
+            entry_results = [{'status': result.get('status'), 'message': result.get('message')}] * len(valid)
+        for index, entry_result in zip(valid, entry_results):
+            results[index] = dict(entry_result, index=index)
+
+    saved = sum(1 for r in results if r['status'] == 'success')
+    return jsonify({
+        'status': 'success' if entries and saved == len(entries) else 'error',
+        'message': result.get('message'),
+        'saved': saved,
+        'failed': len(entries) - saved,
+        'results': results,
+        'backup_mode': result.get('backup_mode', False)
+    })
+
 @app.route('/api/homework', methods=['GET', 'POST'])
 def homework():
     if request.method == 'GET':
         group_name = request.args.get('group_name')
-        result = send_command('default_pi', 'get_homework', {'group_name': group_name})
+        return list_response('get_homework', {'group_name': group_name})
     else:
         data = request.json
-        result = send_command('default_pi', 'add_homework', data)
+        result = route_command('add_homework', data)
+    return jsonify(result)
+
+@app.route('/api/analytics/journal')
+def get_journal_analytics():
+    """?group_name=&subject=&student_name=&from=2024-09&to=2024-12&by=group,subject
+
+    Администратор видит всю школу, преподаватель - только свой предмет.
+    """
+    teacher = session_teacher()
+    if not teacher:
+        return login_required_error()
+    by = [dimension for dimension in request.args.get('by', 'group,subject').split(',') if dimension]
+    unknown = [dimension for dimension in by if dimension not in ANALYTICS_DIMENSIONS]
+    if unknown:
+        return jsonify({'status': 'error', 'message': f"Неизвестная группировка: {', '.join(unknown)}"})
+
+    filters = {key: request.args.get(key) for key in ('group_name', 'subject', 'student_name')}
+    if teacher['role'] != 'admin':
+        if filters['subject'] and filters['subject'] != teacher['subject']:
+            return jsonify({'status': 'error', 'message': f'Доступна статистика только по предмету: {teacher["subject"]}'}), 403
+        filters['subject'] = teacher['subject']
+    for key in ('from', 'to'):
+        # Период - месяц: 2024-09 (день в 2024-09-15 отбрасывается)
+        value = (request.args.get(key) or '')[:7]
+        if value and not PERIOD_RE.fullmatch(value):
+            return jsonify({'status': 'error', 'message': 'Период указывается как ГГГГ-ММ'})
+        filters[key] = value
+
+    def query():
+        with backup_transaction() as conn:
+            return journal_analytics(conn, filters, by), journal_analytics(conn, filters, [])[0]
+
+    data, totals = run_blocking(query)
+    return jsonify({'status': 'success', 'by': by, 'data': data, 'totals': totals})
+
+# Архив по семестрам: в рабочих таблицах остается текущий семестр, закрытые семестры лежат
+# в сжатых архивных БД (по файлу на семестр) и открываются только для запросов к ним
+TERM_STARTS = [start.strip() for start in os.environ.get('TERM_STARTS', '09-01,01-01').split(',')]
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', os.path.join(os.path.dirname(BACKUP_DB_PATH), 'archive'))
+# Распакованные копии недавно запрошенных семестров
+ARCHIVE_CACHE_DIR = os.path.join(ARCHIVE_DIR, 'cache')
+ARCHIVE_CACHE_TERMS = int(os.environ.get('ARCHIVE_CACHE_TERMS', 4))
+MAINTENANCE_INTERVAL = float(os.environ.get('MAINTENANCE_INTERVAL', 24 * 3600))
+MAINTENANCE_START_DELAY = 60
+
+# Что уходит в архив и по какой дате; индексы архива повторяют порядок выгрузки
+ARCHIVED_TABLES = {
+    'backup_journal': {
+        'date': 'date',
+        'counter': 'journal_rows',
+        'indexes': ['(group_name, subject, date, id)']
+    },
+    'backup_homework': {
+        'date': 'date_assigned',
+        'counter': 'homework_rows',
+        'indexes': ['(group_name, date_assigned, id)']
+    },
+    # Из очереди в архив уходят только записи, которые Pi отклонил: доставленные удаляются сразу,
+    # недоставленные ждут Pi сколько угодно
+    'sync_queue': {
+        'date': 'created_at',
+        'counter': 'queue_rows',
+        'indexes': []
+    }
+}
+
+def term_of(day):
+    """Семестр даты 'ГГГГ-ММ-ДД': (ключ 'ГГГГ-N', первый день, первый день следующего)
+
+    Учебный год начинается с первой даты TERM_STARTS, ключ - год его начала и номер семестра.
+    """
+    year = int(day[:4])
+    bounds = []
+    for academic_year in (year - 1, year, year + 1):
+        for number, start in enumerate(TERM_STARTS, 1):
+            # Семестры после Нового года относятся к учебному году, начатому осенью
+            calendar_year = academic_year if start >= TERM_STARTS[0] else academic_year + 1
+            bounds.append((f'{calendar_year:04d}-{start}', f'{academic_year}-{number}'))
+    bounds.sort()
+    for (start, term), (end, _) in zip(bounds, bounds[1:]):
+        if start <= day < end:
+            return term, start, end
+
+def archived_until(conn):
+    """Первый день после последнего архивного семестра: более ранние строки живут только в архиве"""
+    return conn.execute('SELECT MAX(ends) FROM archive_terms').fetchone()[0]
+
+def archived_terms(conn, since=None, until=None):
+    """Архивные семестры, пересекающиеся с периодом [since, until]"""
+    sql = 'SELECT term FROM archive_terms WHERE archived_at IS NOT NULL'
+    params = []
+    if since:
+        sql += ' AND ends > ?'
+        params.append(since)
+    if until:
+        sql += ' AND starts <= ?'
+        params.append(until)
+    return [term for (term,) in conn.execute(sql + ' ORDER BY starts', params)]
+
+def archive_file(term):
+    return os.path.join(ARCHIVE_DIR, f'{term}.db.gz')
+
+def unpack_archive(packed, path):
+    """Распаковывает архив во временный файл и атомарно ставит на место (воркеры делят каталог)"""
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    with os.fdopen(fd, 'wb') as target, gzip.open(packed, 'rb') as source:
+        shutil.copyfileobj(source, target, 1024 * 1024)
+    os.replace(temporary, path)
+
+def archive_path(term):
+    """Распакованная копия архива семестра; лишние копии удаляются, начиная с давно не нужных"""
+    os.makedirs(ARCHIVE_CACHE_DIR, exist_ok=True)
+    path = os.path.join(ARCHIVE_CACHE_DIR, f'{term}.db')
+    packed = archive_file(term)
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(packed):
+        unpack_archive(packed, path)
+    os.utime(path)
+
+    cached = sorted((os.path.join(ARCHIVE_CACHE_DIR, name) for name in os.listdir(ARCHIVE_CACHE_DIR)
+                     if name.endswith('.db')), key=os.path.getmtime, reverse=True)
+    for stale in cached[ARCHIVE_CACHE_TERMS:]:
+        if stale != path:
+            os.unlink(stale)
+    return path
+
+def open_archive(term):
+    # Архив не меняется: immutable снимает блокировки и проверки изменений файла
+    return sqlite3.connect(f'file:{run_blocking(archive_path, term)}?mode=ro&immutable=1', uri=True,
+                           check_same_thread=False)
+
+def archive_term(term, starts, ends):
+    """Переносит строки закрытого семестра из рабочих таблиц в его архив; возвращает число перенесенных строк.
+
+    Сначала строки копируются в архив и он сжимается, и только потом удаляются из рабочих таблиц:
+    при сбое между шагами строки окажутся в обоих местах, а повторный прогон их не задвоит.
+    """
+    os.makedirs(ARCHIVE_CACHE_DIR, exist_ok=True)
+    building = os.path.join(ARCHIVE_DIR, f'{term}.db.building')
+    if os.path.exists(building):
+        os.unlink(building)
+    if os.path.exists(archive_file(term)):
+        # В закрытый семестр могли дописать задним числом: архив дополняется
+        unpack_archive(archive_file(term), building)
+
+    conn = sqlite3.connect(BACKUP_DB_PATH, isolation_level=None)
+    conn.execute('PRAGMA busy_timeout=5000')
+    try:
+        conn.execute('ATTACH DATABASE ? AS archive', (building,))
+        conn.execute('BEGIN IMMEDIATE')
+        # Граница архива сдвигается вместе с копированием: снимок Pi, пришедший раньше, еще
+        # заменяет строки семестра, а пришедший позже их уже не трогает (см. save_snapshot)
+        conn.execute('INSERT OR IGNORE INTO archive_terms (term, starts, ends) VALUES (?, ?, ?)', (term, starts, ends))
+        for table, spec in ARCHIVED_TABLES.items():
+            if not conn.execute("SELECT 1 FROM archive.sqlite_master WHERE name = ?", (table,)).fetchone():
+                conn.execute(f'CREATE TABLE archive.{table} AS SELECT * FROM main.{table} WHERE 0')
+                conn.execute(f'CREATE UNIQUE INDEX archive.{table}_id ON {table} (id)')
+                for number, columns in enumerate(spec['indexes']):
+                    conn.execute(f'CREATE INDEX archive.{table}_order_{number} ON {table} {columns}')
+            columns = ', '.join(row[1] for row in conn.execute(f'PRAGMA archive.table_info({table})'))
+            where, params = archive_condition(table, starts, ends)
+            conn.execute(f'INSERT OR REPLACE INTO archive.{table} ({columns}) SELECT {columns} FROM main.{table} WHERE {where}',
+                         params)
+        conn.execute('COMMIT')
+        conn.execute('DETACH DATABASE archive')
+
+        packed = sqlite3.connect(building, isolation_level=None)
+        try:
+            packed.execute('ANALYZE')
+            packed.execute('VACUUM')
+        finally:
+            packed.close()
+        fd, temporary = tempfile.mkstemp(dir=ARCHIVE_DIR, suffix='.part')
+        with os.fdopen(fd, 'wb') as raw:
+            with open(building, 'rb') as source, gzip.GzipFile(fileobj=raw, mode='wb') as target:
+                shutil.copyfileobj(source, target, 1024 * 1024)
+            # Строки удаляются из рабочих таблиц только после того, как архив на диске
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.chmod(temporary, 0o444)
+        os.replace(temporary, archive_file(term))
+
+        # Удаляются ровно скопированные строки; дописанные за это время уйдут в архив в следующий раз
+        moved = {}
+        conn.execute('ATTACH DATABASE ? AS archive', (building,))
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('UPDATE maintenance_state SET archiving = 1')
+        for table, spec in ARCHIVED_TABLES.items():
+            where, params = archive_condition(table, starts, ends)
+            moved[table] = conn.execute(f'DELETE FROM main.{table} WHERE {where} AND id IN (SELECT id FROM archive.{table})',
+                                        params).rowcount
+        conn.execute('UPDATE maintenance_state SET archiving = 0')
+        totals = {spec['counter']: conn.execute(f'SELECT COUNT(*) FROM archive.{table}').fetchone()[0]
+                  for table, spec in ARCHIVED_TABLES.items()}
+        conn.execute(f"UPDATE archive_terms SET {', '.join(f'{c} = ?' for c in totals)}, archived_at = ? WHERE term = ?",
+                     list(totals.values()) + [time.time(), term])
+        conn.execute('COMMIT')
+        conn.execute('DETACH DATABASE archive')
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+    # Собранный файл и есть распакованная копия архива
+    os.chmod(building, 0o444)
+    os.replace(building, os.path.join(ARCHIVE_CACHE_DIR, f'{term}.db'))
+    return moved
+
+def archive_condition(table, starts, ends):
+    column = ARCHIVED_TABLES[table]['date']
+    where = f'{column} >= ? AND {column} < ?'
+    if table == 'sync_queue':
+        where += ' AND failed_at IS NOT NULL'
+    return where, [starts, ends]
+
+def run_maintenance(today=None):
+    """Архивирует закрытые семестры, затем VACUUM (если что-то перенесено) и ANALYZE"""
+    cutoff = term_of(today or datetime.now().strftime('%Y-%m-%d'))[1]
+    conn = get_backup_db()
+    days = set()
+    for table, spec in ARCHIVED_TABLES.items():
+        # Семестры, из которых есть что переносить; границы не важны, поэтому весь период до текущего
+        where, params = archive_condition(table, '', cutoff)
+        days.update(day for (day,) in conn.execute(
+            f"SELECT DISTINCT substr({spec['date']}, 1, 10) FROM {table} WHERE {where}", params
+        ) if day and DATE_RE.fullmatch(day))
+
+    report = {'terms': {}}
+    for term, starts, ends in sorted({term_of(day) for day in days}, key=lambda t: t[1]):
+        started = time.perf_counter()
+        moved = archive_term(term, starts, ends)
+        report['terms'][term] = moved
+        logging.info(f"📦 Семестр {term} в архиве: {moved} за {time.perf_counter() - started:.1f} с")
+
+    maintenance = sqlite3.connect(BACKUP_DB_PATH, isolation_level=None)
+    maintenance.execute('PRAGMA busy_timeout=5000')
+    try:
+        if any(sum(moved.values()) for moved in report['terms'].values()):
+            # Освободившиеся страницы возвращаются файлу; это редкость - раз в семестр
+            started = time.perf_counter()
+            maintenance.execute('VACUUM')
+            maintenance.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            report['vacuum_seconds'] = round(time.perf_counter() - started, 2)
+        maintenance.execute('ANALYZE')
+    finally:
+        maintenance.close()
+    report['size_bytes'] = os.path.getsize(BACKUP_DB_PATH)
+    return report
+
+def claim_maintenance(interval):
+    """Один прогон на все воркеры: отметку забирает тот, кто первым обновил ее"""
+    now = time.time()
+    with backup_transaction(immediate=True) as conn:
+        return conn.execute('UPDATE maintenance_state SET last_run = ? WHERE id = 1 AND (last_run IS NULL OR last_run <= ?)',
+                            (now, now - interval)).rowcount == 1
+
+_maintenance_started = threading.Event()
+
+def maintenance_loop():
+    socketio.sleep(MAINTENANCE_START_DELAY)
+    while True:
+        try:
+            if run_blocking(claim_maintenance, MAINTENANCE_INTERVAL):
+                report = run_blocking(run_maintenance)
+                logging.info(f"🧹 Обслуживание резервной БД: {report}")
+        except Exception as e:
+            logging.error(f"❌ Обслуживание резервной БД не удалось: {e}")
+        socketio.sleep(min(MAINTENANCE_INTERVAL, 3600))
+
+def start_maintenance():
+    if MAINTENANCE_INTERVAL > 0 and not _maintenance_started.is_set():
+        _maintenance_started.set()
+        socketio.start_background_task(maintenance_loop)
+
+start_maintenance()
+
+@app.cli.command('maintenance')
+def maintenance_command():
+    """Архивирует закрытые семестры и обслуживает резервную БД сейчас"""
+    print(json.dumps(run_maintenance(), ensure_ascii=False, indent=2))
+
+# Выгрузка журнала и домашних заданий за отчетный период. Источник - резервная БД: репликация
+# держит в ней копию данных всех Pi, поэтому большая выгрузка не нагружает Pi и не зависит от связи
+EXPORTS = {
+    'journal': {
+        'table': 'backup_journal',
+        'columns': [('date', 'Дата'), ('group_name', 'Группа'), ('subject', 'Предмет'), ('student_name', 'Студент'),
+                    ('topic', 'Тема'), ('grade', 'Оценка'), ('attendance', 'Присутствие'),
+                    ('comments', 'Комментарий'), ('teacher_id', 'Преподаватель')],
+        'filters': ['group_name', 'subject'],
+        'date': 'date',
+        # Порядок индекса idx_journal_group_subject_date (id - это rowid): строки идут из курсора без сортировки
+        'order': ['group_name', 'subject', 'date', 'id']
+    },
+    'homework': {
+        'table': 'backup_homework',
+        'columns': [('date_assigned', 'Задано'), ('date_due', 'Срок'), ('group_name', 'Группа'), ('subject', 'Предмет'),
+                    ('homework_text', 'Задание'), ('teacher_id', 'Преподаватель')],
+        'filters': ['group_name', 'subject'],
+        'date': 'date_assigned',
+        'order': ['group_name', 'date_assigned', 'id']
+    }
+}
+
+EXPORT_FETCH_SIZE = 500
+# Размер куска ответа: меньшие куски дороже передавать и сжимать
+EXPORT_CHUNK_BYTES = 64 * 1024
+DATE_RE = re.compile(r'\d{4}-\d{2}-\d{2}')
+
+def build_export_query(kind, filters):
+    spec = EXPORTS[kind]
+    where = []
+    params = []
+    for column in spec['filters']:
+        if filters.get(column):
+            where.append(f'{column} = ?')
+            params.append(filters[column])
+    if filters.get('from'):
+        where.append(f"{spec['date']} >= ?")
+        params.append(filters['from'])
+    if filters.get('to'):
+        where.append(f"{spec['date']} <= ?")
+        params.append(filters['to'])
+    # Колонки сортировки идут в конце строки: по ним сливаются рабочая таблица и архивы
+    sql = f"SELECT {', '.join([column for column, _ in spec['columns']] + spec['order'])} FROM {spec['table']}"
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    return sql + ' ORDER BY ' + ', '.join(spec['order']), params
+
+def unique_rows(rows, width):
+    """Пропускает повторы строки, которая есть и в архиве, и в рабочей таблице.
+
+    Так бывает после сбоя между записью архива и удалением строк из рабочих таблиц.
+    Ключ слияния заканчивается id (AUTOINCREMENT, не переиспользуется), поэтому копии
+    одной строки идут подряд; heapq.merge устойчив, и первой выдается рабочая таблица.
+    """
+    previous = None
+    for row in rows:
+        key = row[width:]
+        if key != previous:
+            previous = key
+            yield row
+
+def iter_export_rows(kind, filters):
+    """Пачки строк прямо из курсоров SQLite: в памяти не больше EXPORT_FETCH_SIZE строк на источник.
+
+    Закрытые семестры периода читаются из архивов и сливаются с рабочей таблицей в общем порядке.
+    """
+    width = len(EXPORTS[kind]['columns'])
+    sql, params = build_export_query(kind, filters)
+    readers = [run_blocking(open_backup_reader)]
+    try:
+        terms = run_blocking(archived_terms, readers[0], filters.get('from'), filters.get('to'))
+        readers += [run_blocking(open_archive, term) for term in terms]
+        sources = [fetch_rows(run_blocking(conn.execute, sql, params), EXPORT_FETCH_SIZE) for conn in readers]
+        if len(sources) == 1:
+            rows = sources[0]
+        else:
+            rows = unique_rows(heapq.merge(*sources, key=lambda row: row[width:]), width)
+        while True:
+            batch = [row[:width] for row in islice(rows, EXPORT_FETCH_SIZE)]
+            if not batch:
+                return
+            yield batch
+    finally:
+        for conn in readers:
+            conn.close()
+
+# Excel и LibreOffice считают ячейку с таким началом формулой
+CSV_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+def csv_cell(value):
+    """Текст, похожий на формулу, экранируется апострофом: его пишут пользователи (темы, комментарии, ДЗ)"""
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+def csv_export(headers, batches):
+    """CSV в UTF-8 с BOM (Excel определяет кодировку), отдается кусками"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(headers)
+    for rows in batches:
+        writer.writerows([csv_cell(value) for value in row] for row in rows)
+        if buffer.tell() >= EXPORT_CHUNK_BYTES:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+class _ChunkSink(io.RawIOBase):
+    """Поток без перемотки для zipfile: записанное забирается кусками"""
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+XLSX_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="xl/workbook.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+        '</Relationships>'),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="{sheet}" sheetId="1" r:id="rId1"/></sheets></workbook>'),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+        '</Relationships>')
+}
+
+# Управляющие символы запрещены в XML; в тексте из журнала они могут встретиться случайно
+XML_INVALID_RE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+def xlsx_cell(value):
+    if value is None:
+        return '<c/>'
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f'<c><v>{value}</v></c>'
+    text = XML_INVALID_RE.sub('', str(value)).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+def xlsx_export(sheet, headers, batches):
+    """Книга xlsx с одним листом; лист пишется в zip потоком, строки без общей таблицы строк"""
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as book:
+        for name, content in XLSX_PARTS.items():
+            book.writestr(name, content.replace('{sheet}', sheet))
+        with book.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as part:
+            part.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                       b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+            part.write(('<row>' + ''.join(xlsx_cell(h) for h in headers) + '</row>').encode())
+            for rows in batches:
+                part.write(''.join('<row>' + ''.join(xlsx_cell(v) for v in row) + '</row>' for row in rows).encode())
+                if sink.size >= EXPORT_CHUNK_BYTES:
+                    yield sink.drain()
+            part.write(b'</sheetData></worksheet>')
+    yield sink.drain()
+
+def gzip_chunks(chunks):
+    """Сжатие потока на лету: в памяти только текущий кусок"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+@app.route('/api/export/<kind>')
+def export(kind):
+    """/api/export/journal|homework?from=2024-09-01&to=2024-12-31&group_name=&subject=&format=csv|xlsx
+
+    Администратор выгружает всю школу, преподаватель - только свой предмет.
+    """
+    teacher = session_teacher()
+    if not teacher:
+        return login_required_error()
+    if kind not in EXPORTS:
+        return jsonify({'status': 'error', 'message': f'Неизвестная выгрузка: {kind}'}), 404
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'xlsx'):
+        return jsonify({'status': 'error', 'message': 'Формат выгрузки: csv или xlsx'})
+    filters = {}
+    for key in EXPORTS[kind]['filters'] + ['from', 'to']:
+        value = request.args.get(key)
+        if not value:
+            continue
+        if key in ('from', 'to') and not DATE_RE.fullmatch(value):
+            return jsonify({'status': 'error', 'message': 'Дата указывается как ГГГГ-ММ-ДД'})
+        filters[key] = value
+    if teacher['role'] != 'admin':
+        if filters.get('subject', teacher['subject']) != teacher['subject']:
+            return jsonify({'status': 'error', 'message': f'Доступна выгрузка только по предмету: {teacher["subject"]}'}), 403
+        filters['subject'] = teacher['subject']
+
+    headers = [title for _, title in EXPORTS[kind]['columns']]
+    batches = iter_export_rows(kind, filters)
+    filename = '-'.join([kind] + [filters[key] for key in ('from', 'to') if key in filters])
+    if export_format == 'xlsx':
+        # xlsx уже сжат внутри, повторное сжатие ничего не дает
+        response = Response(stream_with_context(xlsx_export(kind, headers, batches)),
+                            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    else:
+        chunks = csv_export(headers, batches)
+        if 'gzip' in request.accept_encodings:
+            chunks = gzip_chunks(chunks)
+        response = Response(stream_with_context(chunks), mimetype='text/csv')
+        if 'gzip' in request.accept_encodings:
+            response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}.{export_format}"'
+    return response
+
+@app.route('/api/search')
+def search():
+    """?q=ива мар&types=students,teachers,homework&group_name=&limit=20"""
+    if not session_teacher():
+        return login_required_error()
+    query = request.args.get('q', '')
+    if not search_match_expression(query):
+        return jsonify({'status': 'error', 'message': 'Пустой поисковый запрос'})
+    types = [name for name in request.args.get('types', ','.join(SEARCH_TYPES)).split(',') if name]
+    unknown = [name for name in types if name not in SEARCH_TYPES]
+    if unknown:
+        return jsonify({'status': 'error', 'message': f"Неизвестный тип поиска: {', '.join(unknown)}"})
+
+    data = {'q': query, 'types': types,
+            'limit': max(1, min(request.args.get('limit', SEARCH_LIMIT, type=int), MAX_SEARCH_LIMIT))}
+    if request.args.get('group_name'):
+        data['group_name'] = request.args['group_name']
+
+    result = route_command('search', data)
+    if result.get('status') != 'success':
+        # Прошивка без поиска: отвечает резерв, его держит актуальным репликация
+        result = process_in_backup_mode('search', data)
     return jsonify(result)
 
 @app.route('/api/status')
 def get_status():
-    global backup_mode
+    status = bridge_status()
+    for pi_id, pi in status['pis'].items():
+        pi['sync'] = sync_status(pi_id)
+        pi['breaker'] = get_breaker(pi_id).stats()
+        pi['scheduler'] = command_scheduler.stats(pi_id)
+        pi['replication'] = replication_status.get(pi_id, {})
+        codec = wire_codecs.get(connections.get(pi_id))
+        pi['wire'] = codec.settings if codec else None
     return jsonify({
         'status': 'success',
-        'raspberry_pi_connected': 'default_pi' in connections and not backup_mode,
-        'backup_mode': backup_mode
+        **status,
+        'requests': pending_requests.stats(),
+        'single_flight': single_flight.stats(),
+        'cache': response_cache.stats(),
+        'worker': peer_bridge.stats(),
+        'archive': [dict(zip(('term', 'starts', 'ends', 'journal_rows', 'homework_rows', 'queue_rows'), row))
+                    for row in query_backup('''
+                        SELECT term, starts, ends, journal_rows, homework_rows, queue_rows
+                        FROM archive_terms WHERE archived_at IS NOT NULL ORDER BY starts
+                    ''')],
+        'async_mode': socketio.async_mode
     })
 
-# HTML ШАБЛОНЫ (основной шаблон остается прежним)
-def get_base_template():
-    return '''
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Школьная система</title>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <style>
-            * { margin: 0; padding: 0; box-sizing: border-box; }
-            body { font-family: Arial, sans-serif; background: #f5f5f5; }
-            .header { background: #2c3e50; color: white; padding: 1rem; display: flex; justify-content: space-between; align-items: center; }
-            .container { max-width: 1200px; margin: 0 auto; padding: 20px; }
-            .nav { background: white; padding: 1rem; margin-bottom: 20px; border-radius: 5px; box-shadow: 0 2px 5px rgba(0,0,0,0.1); }
-            .nav a { margin-right: 20px; text-decoration: none; color: #2c3e50; font-weight: bold; padding: 5px 10px; border-radius: 3px; }
-            .nav a:hover { background: #ecf0f1; }
-            .card { background: white; padding: 20px; margin-bottom: 20px; border-radius: 5px; box-shadow: 0 2px 5px rgba(0,0,0,0.1); }
-            .btn { background: #3498db; color: white; border: none; padding: 10px 20px; border-radius: 3px; cursor: pointer; margin: 5px; }
-            .btn:hover { background: #2980b9; }
-            .btn-danger { background: #e74c3c; }
-            .btn-success { background: #27ae60; }
-            .form-group { margin-bottom: 15px; }
-            .form-group label { display: block; margin-bottom: 5px; font-weight: bold; }
-            .form-group input, .form-group select, .form-group textarea { width: 100%; padding: 8px; border: 1px solid #ddd; border-radius: 3px; }
-            .status-indicator { padding: 10px; border-radius: 5px; margin-bottom: 20px; text-align: center; font-weight: bold; }
-            .status-online { background: #d4edda; color: #155724; }
-            .status-offline { background: #f8d7da; color: #721c24; }
-            table { width: 100%; border-collapse: collapse; margin-top: 10px; }
-            table, th, td { border: 1px solid #ddd; }
-            th, td { padding: 12px; text-align: left; }
-            th { background: #f8f9fa; }
-            .teacher-subject { background: #e8f5e8; padding: 5px 10px; border-radius: 3px; font-weight: bold; }
-        </style>
-    </head>
-    <body>
-        <div class="header">
-            <h1>🎓 Школьная система</h1>
-            <div>
-                {% if session.teacher_name %}
-                    <span>{{ session.teacher_name }}</span>
-                    {% if session.teacher_subject and session.role != 'admin' %}
-                        <span class="teacher-subject" style="margin-left: 10px;">{{ session.teacher_subject }}</span>
-                    {% endif %}
-                    <a href="/logout" style="color: white; margin-left: 20px;">Выйти</a>
-                {% endif %}
-            </div>
-        </div>
-        <div class="container">
-            {% if session.teacher_name %}
-            <div class="nav">
-                <a href="/dashboard">📊 Дашборд</a>
-                {% if session.role != 'admin' %}
-                <a href="/journal">📝 Журнал</a>
-                <a href="/homework">📚 Домашние задания</a>
-                {% endif %}
-                {% if session.role == 'admin' %}
-                <a href="/admin">👑 Админ-панель</a>
-                {% endif %}
-            </div>
-            {% endif %}
-            
-            <div id="status-indicator" class="status-indicator">
-                <!-- Статус подключения -->
-            </div>
-            
-            {% block content %}{% endblock %}
-        </div>
-
-        <script>
-            async function checkStatus() {
-                try {
-                    const response = await fetch('/api/status');
-                    const data = await response.json();
-                    const indicator = document.getElementById('status-indicator');
-                    
-                    if (data.raspberry_pi_connected) {
-                        indicator.innerHTML = '<div class="status-online">✅ База данных подключена</div>';
-                    } else {
-                        indicator.innerHTML = '<div class="status-offline">⚠️ Режим резервного копирования</div>';
-                    }
-                } catch (error) {
-                    document.getElementById('status-indicator').innerHTML = 
-                        '<div class="status-offline">❌ Ошибка подключения</div>';
-                }
+@app.route('/api/status/summary')
+def get_status_summary():
+    """Сводка для браузеров без сокета: условный запрос с ETag, 304 пока статус не изменился"""
+    status = bridge_status()
+    response = jsonify(dict(status, status='success'))
+    response.set_etag(status_etag(status))
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+BREAKER_STATES = [BREAKER_CLOSED, BREAKER_HALF_OPEN, BREAKER_OPEN]
+
+@app.route('/metrics')
+def get_metrics():
+    queue_depth, queue_rejected = {}, {}
+    for pi_id, rejected, count in query_backup(
+        'SELECT pi_id, failed_at IS NOT NULL, COUNT(*) FROM sync_queue GROUP BY pi_id, failed_at IS NOT NULL'
+    ):
+        (queue_rejected if rejected else queue_depth)[pi_id] = count
+    pis = sorted(pi_router.known_pis() | set(queue_depth) | set(queue_rejected))
+    cache = response_cache.stats()
+    requests_stats = pending_requests.stats()
+    flights = single_flight.stats()
+    scheduling = {pi_id: command_scheduler.stats(pi_id) for pi_id in pis}
+    samples = [
+        ('pending_requests', 'gauge', 'Запросы к Pi, ожидающие ответа', [({}, len(pending_requests))]),
+        ('sync_queue_depth', 'gauge', 'Записи в очереди синхронизации',
+         [({'pi_id': pi_id}, queue_depth.get(pi_id, 0)) for pi_id in pis]),
+        ('sync_queue_rejected', 'gauge', 'Записи очереди, которые Pi отклонил',
+         [({'pi_id': pi_id}, queue_rejected.get(pi_id, 0)) for pi_id in pis]),
+        ('connected_pis', 'gauge', 'Raspberry Pi, подключенные к этому воркеру', [({}, len(connections))]),
+        ('backup_mode', 'gauge', 'Pi в резервном режиме (1) или онлайн (0)',
+         [({'pi_id': pi_id}, int(not is_online(pi_id))) for pi_id in pis]),
+        ('breaker_state', 'gauge', 'Предохранитель Pi: 0 - closed, 1 - half_open, 2 - open',
+         [({'pi_id': pi_id}, BREAKER_STATES.index(get_breaker(pi_id).state)) for pi_id in pis]),
+        ('scheduler_in_flight', 'gauge', 'Команды к Pi в полете через планировщик',
+         [({'pi_id': pi_id}, scheduling[pi_id]['in_flight']) for pi_id in pis]),
+        ('scheduler_waiting', 'gauge', 'Команды в очереди к Pi по классам приоритета',
+         [({'pi_id': pi_id, 'priority': priority}, scheduling[pi_id]['waiting'].get(priority, 0))
+          for pi_id in pis for priority in PRIORITY_CLASSES]),
+        ('cache_size', 'gauge', 'Записи в кэше справочных данных', [({}, cache['size'])]),
+        ('responses_completed', 'counter', 'Ответы Pi, доставленные ожидающим запросам',
+         [({}, requests_stats['completed'])]),
+        ('responses_late', 'counter', 'Опоздавшие или неизвестные ответы Pi', [({}, requests_stats['late_responses'])]),
+        ('cache_hits', 'counter', 'Попадания в кэш справочных данных', [({}, cache['hits'])]),
+        ('cache_misses', 'counter', 'Промахи кэша справочных данных', [({}, cache['misses'])]),
+        ('cache_stale_puts', 'counter', 'Ответы, не попавшие в кэш из-за сброса во время запроса', [({}, cache['stale_puts'])]),
+        ('single_flight_coalesced', 'counter', 'Чтения, склеенные с уже идущим запросом', [({}, flights['coalesced'])])
+    ]
+    return Response(metrics.render(samples), mimetype='text/plain; version=0.0.4')
+
+# Статические файлы: читаются, хешируются и сжимаются один раз при старте
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+# Ссылки на ресурсы содержат хеш содержимого, поэтому их можно кэшировать надолго
+STATIC_MAX_AGE = 30 * 24 * 3600
+
+static_assets = {}
+
+def load_static_assets():
+    for root, _, files in os.walk(STATIC_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            filename = os.path.relpath(path, STATIC_DIR).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                content = f.read()
+            static_assets[filename] = {
+                'content': content,
+                'gzip': gzip.compress(content, 9),
+                'etag': hashlib.sha1(content).hexdigest()[:16],
+                'mimetype': mimetypes.guess_type(name)[0] or 'application/octet-stream'
             }
-            
-            setInterval(checkStatus, 10000);
-            checkStatus();
-        </script>
-    </body>
-    </html>
-    '''
+
+load_static_assets()
+
+@app.context_processor
+def inject_asset_url():
+    def asset_url(filename):
+        return f"/static/{filename}?v={static_assets[filename]['etag']}"
+    return {'asset_url': asset_url}
+
+@app.route('/static/<path:filename>')
+def static_file(filename):
+    asset = static_assets.get(filename)
+    if asset is None:
+        return jsonify({'status': 'error', 'message': 'Файл не найден'}), 404
+
+    if asset['etag'] in request.if_none_match:
+        response = Response(status=304)
+    elif 'gzip' in request.accept_encodings:
+        response = Response(asset['gzip'], mimetype=asset['mimetype'])
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(asset['content'], mimetype=asset['mimetype'])
+    response.set_etag(asset['etag'])
+    response.headers['Cache-Control'] = f'public, max-age={STATIC_MAX_AGE}'
+    response.vary.add('Accept-Encoding')
+    return response
+
+# HTML-шаблоны из templates/ компилируются один раз при старте и дальше берутся из кэша Jinja
+PAGE_TEMPLATES = ('base.html', 'index.html', 'login_error.html', 'dashboard.html')
+
+for template_name in PAGE_TEMPLATES:
+    app.jinja_env.get_template(template_name)
 
 @app.route('/')
 def index():
     if 'teacher_id' in session:
         return redirect('/dashboard')
-    
-    return render_template_string(get_base_template() + '''
-        <div class="card" style="max-width: 400px; margin: 50px auto;">
-            <h2 style="text-align: center; margin-bottom: 20px;">Вход в систему</h2>
-            <form method="POST" action="/login">
-                <div class="form-group">
-                    <label>ID преподавателя:</label>
-                    <input type="text" name="teacher_id" required value="admin">
-                </div>
-                <div class="form-group">
-                    <label>Пароль:</label>
-                    <input type="password" name="password" required value="admin123">
-                </div>
-                <button type="submit" class="btn" style="width: 100%;">Войти</button>
-            </form>
-            <div style="margin-top: 20px; padding: 15px; background: #f8f9fa; border-radius: 5px;">
-                <h4>Тестовые аккаунты:</h4>
-                <p><strong>Админ:</strong> admin / admin123</p>
-                <p><strong>Математика:</strong> teacher_001 / 123456</p>
-                <p><strong>Русский язык:</strong> teacher_002 / 123456</p>
-                <p><strong>История:</strong> teacher_003 / 123456</p>
-            </div>
-        </div>
-    ''')
+
+    return render_template('index.html')
 
 @app.route('/login', methods=['POST'])
 def login_http():
     teacher_id = request.form.get('teacher_id')
     password = request.form.get('password')
-    
-    result = send_command('default_pi', 'login', {
+
+    result = route_command('login', {
         'teacher_id': teacher_id, 'password': password
     })
-    
+
     if result.get('status') == 'success':
         teacher_data = result.get('teacher', {})
         session['teacher_id'] = teacher_data['id']
@@ -671,13 +4038,7 @@ def login_http():
         session['teacher_subject'] = teacher_data.get('subject', '')
         return redirect('/dashboard')
     else:
-        return render_template_string(get_base_template() + '''
-            <div class="card" style="max-width: 400px; margin: 50px auto;">
-                <h2 style="text-align: center; color: #e74c3c;">Ошибка входа</h2>
-                <p style="text-align: center;">Неверный ID или пароль</p>
-                <a href="/" class="btn" style="display: block; text-align: center;">Вернуться к входу</a>
-            </div>
-        ''')
+        return render_template('login_error.html')
 
 @app.route('/logout')
 def logout():
@@ -688,51 +4049,10 @@ def logout():
 def dashboard():
     if 'teacher_id' not in session:
         return redirect('/')
-    
+
     role_display = "Администратор" if session['role'] == 'admin' else f"Преподаватель ({session['teacher_subject']})"
-    
-    return render_template_string(get_base_template() + '''
-        <div class="card">
-            <h2>📊 Дашборд</h2>
-            <p>Добро пожаловать, <strong>{{ session.teacher_name }}</strong>! ({{ role_display }})</p>
-            
-            <div style="display: grid; grid-template-columns: repeat(auto-fit, minmax(250px, 1fr)); gap: 20px; margin-top: 20px;">
-                <div class="card">
-                    <h3>👥 Группы</h3>
-                    <button class="btn" onclick="loadGroups()">Просмотреть группы</button>
-                    <div id="groups-list"></div>
-                </div>
-                
-                <div class="card">
-                    <h3>📝 Быстрые действия</h3>
-                    {% if session.role != 'admin' %}
-                    <button class="btn" onclick="location.href='/journal'">📝 Выставить оценку</button>
-                    <button class="btn" onclick="location.href='/homework'">📚 Добавить ДЗ</button>
-                    {% else %}
-                    <button class="btn" onclick="location.href='/admin'">👑 Управление системой</button>
-                    {% endif %}
-                </div>
-            </div>
-        </div>
-
-        <script>
-            async function loadGroups() {
-                const response = await fetch('/api/groups');
-                const data = await response.json();
-                
-                if (data.status === 'success') {
-                    const groupsHtml = data.data.map(group => 
-                        `<div style="padding: 10px; margin: 5px; background: #f8f9fa; border-radius: 3px;">
-                            ${group.name} (${group.course})
-                        </div>`
-                    ).join('');
-                    document.getElementById('groups-list').innerHTML = groupsHtml;
-                } else {
-                    document.getElementById('groups-list').innerHTML = 'Ошибка загрузки групп';
-                }
-            }
-        </script>
-    ''', role_display=role_display)
+
+    return render_template('dashboard.html', role_display=role_display)
 
 # Остальные маршруты (/journal, /homework, /admin) остаются аналогичными, 
 # но с проверкой прав доступа в каждом шаблоне
@@ -0,0 +1,356 @@
+"""Имитация Raspberry Pi для нагрузочного тестирования моста.
+
+Подключается к мосту по Socket.IO (raspberry_connect / command / raspberry_response),
+хранит данные в памяти и отвечает с настраиваемыми задержкой, разбросом, долей ошибок
+и обрывами связи. С --legacy-wire ведет себя как старая прошивка (только JSON-объекты).
+
+    python -m bench.fake_pi --url http://localhost:5001 --latency 0.02 --jitter 0.01
+"""
+import argparse
+import base64
+import json
+import logging
+import random
+import re
+import threading
+import time
+
+import socketio
+
+import wire
+
+
+def _decode_cursor(cursor):
+    return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+
+
+def _encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, ensure_ascii=False).encode()).decode()
+
+
+# Порядок сортировки списков, как в мосте: (поле курсора, поле строки), по убыванию ли
+LIST_SORT = {
+    'get_groups': ((('course', 'course'), ('name', 'name')), False),
+    'get_students': ((('name', 'name'), ('id', 'id')), False),
+    'get_all_students': ((('group_name', 'group_name'), ('name', 'name'), ('id', 'id')), False),
+    'get_teachers': ((('name', 'name'), ('teacher_id', 'id')), False),
+    'get_homework': ((('date_assigned', 'date_assigned'), ('id', 'id')), True)
+}
+
+
+# Ключ строки каждой таблицы в снимке и ленте изменений
+SNAPSHOT_KEYS = {'teachers': 'teacher_id', 'groups': 'name', 'students': 'student_id', 'journal': 'id', 'homework': 'id'}
+
+
+class MemoryStore:
+    """Данные Pi в памяти: группы, студенты, преподаватели, журнал, ДЗ и лента изменений"""
+
+    def __init__(self, groups=10, students_per_group=30, changelog_limit=100000):
+        self.lock = threading.Lock()
+        self.groups = {}
+        self.students = []
+        self.teachers = {
+            'admin': {'id': 'admin', 'name': 'Администратор Системы', 'password': 'admin123',
+                      'role': 'admin', 'subject': 'Администрирование'},
+            'teacher_001': {'id': 'teacher_001', 'name': 'Иванова Мария Сергеевна', 'password': '123456',
+                            'role': 'teacher', 'subject': 'Математика'}
+        }
+        self.journal = []
+        self.homework = []
+        self.applied_keys = set()
+        # Ключ идемпотентности строк журнала и ДЗ: мост узнает по нему свои строки в снимке
+        self.row_keys = {}
+        self.changes = []
+        self.version = 0
+        self.changelog_limit = changelog_limit
+        for g in range(groups):
+            group_name = f'Г-{g + 1:02d}'
+            self.groups[group_name] = {'id': g + 1, 'name': group_name, 'course': str(g % 4 + 1)}
+            for n in range(students_per_group):
+                self.students.append({
+                    'id': len(self.students) + 1,
+                    'name': f'Студент {n:03d}',
+                    'group_name': group_name,
+                    'student_id': f'{group_name}-{n:03d}'
+                })
+
+    def _changed(self, table, row, key=None):
+        self.version += 1
+        if key:
+            self.row_keys[table, row['id']] = key
+            row = dict(row, idempotency_key=key)
+        self.changes.append({'version': self.version, 'table': table, 'op': 'upsert', 'row': row})
+        if len(self.changes) > self.changelog_limit:
+            del self.changes[:len(self.changes) - self.changelog_limit]
+
+    def _table_rows(self, table):
+        if table == 'teachers':
+            return [{'teacher_id': t['id'], 'name': t['name'], 'password': t['password'], 'role': t['role'],
+                     'subject': t['subject']} for t in self.teachers.values()]
+        if table == 'groups':
+            return [{'name': g['name'], 'course': g['course']} for g in self.groups.values()]
+        if table == 'students':
+            return [{k: s[k] for k in ('name', 'group_name', 'student_id')} for s in self.students]
+        return [dict(row, idempotency_key=self.row_keys.get((table, row['id'])))
+                for row in (self.journal if table == 'journal' else self.homework)]
+
+    def snapshot(self, data):
+        key = SNAPSHOT_KEYS[data.get('table')]
+        rows = sorted(self._table_rows(data.get('table')), key=lambda r: r[key])
+        if data.get('cursor') is not None:
+            rows = [r for r in rows if r[key] > data['cursor']]
+        limit = data.get('limit') or len(rows) or 1
+        next_cursor = rows[limit - 1][key] if len(rows) > limit else None
+        return {'status': 'success', 'rows': rows[:limit], 'next_cursor': next_cursor, 'version': self.version}
+
+    def changes_since(self, data):
+        since = data.get('since') or 0
+        if self.changes and since < self.changes[0]['version'] - 1:
+            return {'status': 'error', 'snapshot_required': True, 'message': 'Лента изменений обрезана'}
+        pending = [c for c in self.changes if c['version'] > since]
+        limit = data.get('limit') or len(pending)
+        return {'status': 'success', 'changes': pending[:limit], 'has_more': len(pending) > limit,
+                'version': self.version}
+
+    def search(self, data):
+        """Поиск по началу слов без индекса: ранг - доля совпавших слов в тексте"""
+        tokens = [t.lower() for t in re.findall(r'\w+', data.get('q', ''))]
+        limit = data.get('limit') or 20
+        sources = {
+            'students': ('student', ('name',), [dict(s) for s in self.students]),
+            'teachers': ('teacher', ('name', 'subject'),
+                         [{k: t[k] for k in ('id', 'name', 'subject')} for t in self.teachers.values()]),
+            'homework': ('homework', ('homework_text', 'subject'), [dict(h) for h in self.homework])
+        }
+        hits = []
+        for name in data.get('types') or sources:
+            kind, fields, rows = sources[name]
+            for row in rows:
+                if data.get('group_name') and row.get('group_name', data['group_name']) != data['group_name']:
+                    continue
+                words = re.findall(r'\w+', ' '.join(str(row.get(f) or '') for f in fields).lower())
+                if words and all(any(w.startswith(t) for w in words) for t in tokens):
+                    hits.append(dict(row, type=kind, rank=-len(tokens) / len(words)))
+        hits.sort(key=lambda hit: hit['rank'])
+        return {'status': 'success', 'data': hits[:limit]}
+
+    def page(self, command, rows, data):
+        """Постраничная выдача по ключу, совместимая с курсорами моста"""
+        fields, descending = LIST_SORT[command]
+        rows = sorted(rows, key=lambda r: [r[f] for _, f in fields], reverse=descending)
+        if data.get('cursor'):
+            after = _decode_cursor(data['cursor'])
+            if descending:
+                rows = [r for r in rows if [r[f] for _, f in fields] < after]
+            else:
+                rows = [r for r in rows if [r[f] for _, f in fields] > after]
+        limit = data.get('limit')
+        next_cursor = None
+        if limit and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = _encode_cursor([rows[-1][f] for _, f in fields])
+        return {'status': 'success', 'data': rows, 'next_cursor': next_cursor}
+
+    def execute(self, command, data):
+        with self.lock:
+            return self._execute(command, data or {})
+
+    def _execute(self, command, data):
+        key = data.get('idempotency_key')
+        if command == 'ping':
+            return {'status': 'success'}
+        if command == 'get_groups':
+            return self.page(command, list(self.groups.values()), data)
+        if command == 'get_students':
+            rows = [s for s in self.students if s['group_name'] == data.get('group_name')]
+            return self.page(command, rows, data)
+        if command == 'search':
+            return self.search(data)
+        if command == 'get_snapshot':
+            return self.snapshot(data)
+        if command == 'get_changes':
+            return self.changes_since(data)
+        if command == 'get_all_students':
+            return self.page(command, self.students, data)
+        if command == 'get_teachers':
+            rows = [{k: t[k] for k in ('id', 'name', 'role', 'subject')} for t in self.teachers.values()]
+            return self.page(command, rows, data)
+        if command == 'get_homework':
+            rows = [h for h in self.homework if h['group_name'] == data.get('group_name')]
+            return self.page(command, rows, data)
+        if command == 'login':
+            teacher = self.teachers.get(data.get('teacher_id'))
+            if teacher and teacher['password'] == data.get('password'):
+                return {'status': 'success', 'teacher': {k: teacher[k] for k in ('id', 'name', 'role', 'subject')}}
+            return {'status': 'error', 'message': 'Неверный ID или пароль'}
+        if command == 'add_group':
+            name = data.get('group_name')
+            if name not in self.groups:
+                self.groups[name] = {'id': len(self.groups) + 1, 'name': name, 'course': 'Новый курс'}
+                self._changed('groups', {'name': name, 'course': 'Новый курс'})
+            return {'status': 'success'}
+        if command == 'add_student':
+            self.students.append({'id': len(self.students) + 1, 'name': data.get('student_name'),
+                                  'group_name': data.get('group_name'), 'student_id': data.get('student_id')})
+            self._changed('students', {'name': data.get('student_name'), 'group_name': data.get('group_name'),
+                                       'student_id': data.get('student_id')})
+            return {'status': 'success'}
+        if command == 'add_teacher':
+            self.teachers[data.get('new_teacher_id')] = {
+                'id': data.get('new_teacher_id'), 'name': data.get('new_teacher_name'),
+                'password': data.get('new_teacher_password'), 'role': data.get('new_teacher_role', 'teacher'),
+                'subject': data.get('new_teacher_subject')
+            }
+            self._changed('teachers', self._table_rows('teachers')[-1])
+            return {'status': 'success'}
+        if command in ('add_journal_entry', 'add_journal_entries'):
+            entries = data.get('entries', []) if command == 'add_journal_entries' else [data]
+            for entry in entries:
+                row = {k: entry.get(k, data.get(k)) for k in ('date', 'student_name', 'group_name', 'subject', 'topic',
+                                                              'grade', 'attendance', 'comments', 'teacher_id')}
+                row['date'] = row['date'] or time.strftime('%Y-%m-%d')
+                row['id'] = len(self.journal) + 1
+                self.journal.append(row)
+                self._changed('journal', row, key)
+            if command == 'add_journal_entry':
+                return {'status': 'success'}
+            return {'status': 'success', 'results': [{'status': 'success'} for _ in entries]}
+        if command == 'add_homework':
+            row = {k: data.get(k) for k in ('group_name', 'subject', 'homework_text', 'date_assigned', 'date_due',
+                                            'teacher_id')}
+            row['id'] = len(self.homework) + 1
+            self.homework.append(row)
+            self._changed('homework', row, key)
+            return {'status': 'success'}
+        if command == 'sync_batch':
+            results = []
+            for item in data.get('items', []):
+                key = item.get('idempotency_key')
+                if key in self.applied_keys:
+                    results.append({'idempotency_key': key, 'status': 'duplicate'})
+                    continue
+                result = self._execute(item.get('command'), dict(item.get('data') or {}, idempotency_key=key))
+                if result.get('status') == 'success':
+                    self.applied_keys.add(key)
+                results.append({'idempotency_key': key, 'status': result.get('status'), 'message': result.get('message')})
+            return {'status': 'success', 'results': results}
+        return {'status': 'error', 'message': f'Неизвестная команда {command}'}
+
+
+class FakePi:
+    """Socket.IO-клиент, который ведет себя как Raspberry Pi"""
+
+    def __init__(self, url, pi_id='default_pi', latency=0.01, jitter=0.0, error_rate=0.0,
+                 drop_rate=0.0, disconnect_every=None, store=None, seed=None, negotiate_wire=True):
+        self.url = url
+        self.pi_id = pi_id
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.disconnect_every = disconnect_every
+        self.store = store or MemoryStore()
+        self.random = random.Random(seed)
+        self.negotiate_wire = negotiate_wire
+        self.codec = None
+        self.stats = {'commands': 0, 'errors': 0, 'dropped': 0, 'disconnects': 0}
+        self._stopped = threading.Event()
+        self.client = socketio.Client(reconnection=False)
+        self.client.on('command', self._on_command)
+
+    def _delay(self):
+        return max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+
+    def _on_command(self, payload):
+        if isinstance(payload, (bytes, bytearray, str)):
+            try:
+                payload = wire.WireCodec.decode(payload)
+            except wire.FrameError as e:
+                # Мост не получит ответа и завершит запрос по таймауту
+                logging.warning(f"{self.pi_id}: {e}")
+                self.stats['dropped'] += 1
+                return
+        self.stats['commands'] += 1
+        if self.random.random() < self.drop_rate:
+            self.stats['dropped'] += 1
+            return
+        # Ответ уходит из отдельного потока, чтобы задержка не блокировала прием команд
+        timer = threading.Timer(self._delay(), self._respond, args=(payload,))
+        timer.daemon = True
+        timer.start()
+
+    def _respond(self, payload):
+        if self.random.random() < self.error_rate:
+            self.stats['errors'] += 1
+            response = {'status': 'error', 'message': 'Имитация ошибки Pi'}
+        else:
+            response = self.store.execute(payload.get('command'), payload.get('data'))
+        message = {'request_id': payload.get('request_id'), 'response': response}
+        try:
+            self.client.emit('raspberry_response', self.codec.encode(message) if self.codec else message)
+        except socketio.exceptions.BadNamespaceError:
+            pass
+
+    def connect(self):
+        self.client.connect(self.url, wait_timeout=10)
+        hello = {'pi_id': self.pi_id}
+        if self.negotiate_wire:
+            # Клиент python-socketio теряет бинарные вложения: кадры просим текстом
+            hello['wire'] = wire.supported(binary=False)
+        ack = self.client.call('raspberry_connect', hello, timeout=10) or {}
+        self.codec = wire.WireCodec(ack['wire']) if ack.get('wire') else None
+
+    def disconnect(self):
+        if self.client.connected:
+            self.client.disconnect()
+
+    def start(self):
+        self.connect()
+        if self.disconnect_every:
+            threading.Thread(target=self._flap, daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        self.disconnect()
+
+    def _flap(self):
+        # Периодические обрывы связи с переподключением через секунду
+        while not self._stopped.wait(self.disconnect_every):
+            self.stats['disconnects'] += 1
+            self.disconnect()
+            if self._stopped.wait(1):
+                return
+            self.client = socketio.Client(reconnection=False)
+            self.client.on('command', self._on_command)
+            self.connect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Имитация Raspberry Pi для моста')
+    parser.add_argument('--url', default='http://localhost:5001')
+    parser.add_argument('--pi-id', default='default_pi')
+    parser.add_argument('--latency', type=float, default=0.01, help='Время обработки команды, с')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Разброс задержки, с')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Доля ответов с ошибкой')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='Доля команд без ответа')
+    parser.add_argument('--disconnect-every', type=float, default=None, help='Обрыв связи каждые N секунд')
+    parser.add_argument('--groups', type=int, default=10)
+    parser.add_argument('--students-per-group', type=int, default=30)
+    parser.add_argument('--legacy-wire', action='store_true', help='Не согласовывать формат канала')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    pi = FakePi(args.url, args.pi_id, args.latency, args.jitter, args.error_rate, args.drop_rate,
+                args.disconnect_every, MemoryStore(args.groups, args.students_per_group),
+                negotiate_wire=not args.legacy_wire)
+    pi.start()
+    logging.info(f"Имитация {args.pi_id} подключена к {args.url}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pi.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+"""Нагрузочный прогон моста: пропускная способность и p50/p95/p99 по эндпоинтам.
+
+Сценарии:
+    online   - мост работает с имитацией Raspberry Pi
+    backup   - Pi не подключен, все обслуживает резервная БД
+    recovery - очередь синхронизации копится без Pi, затем Pi подключается;
+               замеряется время догоняния очереди под нагрузкой
+
+    python -m bench.load --spawn --scenario online --duration 20 --concurrency 32 --output online.json
+    python -m bench.load --spawn --scenario online --compare online.json
+
+С --spawn мост запускается отдельным процессом с временной резервной БД,
+иначе нагрузка идет на уже запущенный мост по --url. Режим моста берется из окружения:
+    BRIDGE_ASYNC_MODE=eventlet python -m bench.load --spawn --concurrency 200 --latency 0.3
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import quote, urlsplit
+
+from bench.fake_pi import FakePi, MemoryStore
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+GROUPS = [f'Г-{g + 1:02d}' for g in range(10)]
+
+
+def journal_entry(rnd):
+    return {
+        'teacher_id': 'teacher_001', 'subject': 'Математика', 'group_name': rnd.choice(GROUPS),
+        'student_name': f'Студент {rnd.randrange(30):03d}', 'topic': 'Нагрузочный тест',
+        'grade': rnd.randint(2, 5)
+    }
+
+
+def journal_batch(rnd):
+    return {
+        'teacher_id': 'teacher_001', 'subject': 'Математика', 'group_name': rnd.choice(GROUPS),
+        'topic': 'Нагрузочный тест',
+        'entries': [{'student_name': f'Студент {n:03d}', 'grade': rnd.randint(2, 5)} for n in range(30)]
+    }
+
+
+# (вес, имя, метод, путь, тело)
+REQUEST_MIX = [
+    (30, 'groups', 'GET', lambda rnd: '/api/groups', None),
+    (20, 'students', 'GET', lambda rnd: f'/api/students/{rnd.choice(GROUPS)}', None),
+    (5, 'all_students', 'GET', lambda rnd: '/api/all_students?limit=200', None),
+    (10, 'teachers', 'GET', lambda rnd: '/api/teachers', None),
+    (10, 'login', 'POST', lambda rnd: '/api/login',
+     lambda rnd: {'teacher_id': 'teacher_001', 'password': '123456'}),
+    (20, 'journal_entry', 'POST', lambda rnd: '/api/journal/entry', journal_entry),
+    (5, 'journal_batch', 'POST', lambda rnd: '/api/journal/entries', journal_batch)
+]
+
+
+class Recorder:
+    """Задержки и ошибки по типам запросов"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, name, seconds, ok):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(seconds)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self, elapsed):
+        def percentile(values, p):
+            return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+        summary = {}
+        everything = []
+        for name, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            everything.extend(values)
+            summary[name] = {
+                'requests': len(values),
+                'errors': self.errors.get(name, 0),
+                'rps': round(len(values) / elapsed, 1),
+                'p50_ms': round(percentile(values, 50) * 1000, 2),
+                'p95_ms': round(percentile(values, 95) * 1000, 2),
+                'p99_ms': round(percentile(values, 99) * 1000, 2)
+            }
+        if everything:
+            everything.sort()
+            summary['total'] = {
+                'requests': len(everything),
+                'errors': sum(self.errors.values()),
+                'rps': round(len(everything) / elapsed, 1),
+                'p50_ms': round(percentile(everything, 50) * 1000, 2),
+                'p95_ms': round(percentile(everything, 95) * 1000, 2),
+                'p99_ms': round(percentile(everything, 99) * 1000, 2)
+            }
+        return summary
+
+
+class Client:
+    """HTTP-клиент одного потока нагрузки (keep-alive, где сервер его поддерживает)"""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+
+    def request(self, method, path, body=None):
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        payload = json.dumps(body).encode() if body is not None else None
+        try:
+            self.conn.request(method, quote(path, safe='/?=&'), body=payload, headers=headers)
+            response = self.conn.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            self.conn.close()
+            raise
+        return response.status, data
+
+
+def run_load(url, duration, concurrency, recorder, mix=REQUEST_MIX, seed=0):
+    weights = [item[0] for item in mix]
+    deadline = time.monotonic() + duration
+
+    def worker(index):
+        rnd = random.Random(seed + index)
+        client = Client(url)
+        while time.monotonic() < deadline:
+            _, name, method, path, body = rnd.choices(mix, weights)[0]
+            started = time.perf_counter()
+            try:
+                status, data = client.request(method, path(rnd), body(rnd) if body else None)
+                ok = status == 200 and json.loads(data or b'{}').get('status') != 'error'
+            except Exception:
+                ok = False
+            recorder.record(name, time.perf_counter() - started, ok)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.monotonic() - started
+
+
+def get_status(url):
+    status, data = Client(url).request('GET', '/api/status')
+    return json.loads(data)
+
+
+def spawn_bridge(port):
+    """Запускает мост отдельным процессом с чистой резервной БД"""
+    db_dir = tempfile.mkdtemp(prefix='bridge-bench-')
+    env = dict(os.environ, PORT=str(port), BACKUP_DB_PATH=os.path.join(db_dir, 'backup.db'))
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'app.py')], cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            get_status(url)
+            return process, url
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise SystemExit('Мост не запустился')
+
+
+def wait_for_sync(url, pi_id, timeout):
+    """Ждет, пока Pi догонит очередь; возвращает время в секундах или None"""
+    started = time.monotonic()
+    while time.monotonic() - started < timeout:
+        pi = get_status(url).get('pis', {}).get(pi_id, {})
+        if pi.get('online') and pi.get('sync', {}).get('state') != 'draining':
+            return time.monotonic() - started
+        time.sleep(0.05)
+    return None
+
+
+def print_report(summary, previous=None):
+    header = f"{'запрос':<16}{'кол-во':>9}{'ошибки':>8}{'rps':>9}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}"
+    print(header)
+    print('-' * len(header))
+    for name, row in summary.get('requests', {}).items():
+        line = (f"{name:<16}{row['requests']:>9}{row['errors']:>8}{row['rps']:>9}"
+                f"{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}")
+        before = (previous or {}).get('requests', {}).get(name)
+        if before:
+            line += f"   rps {row['rps'] - before['rps']:+.1f}, p95 {row['p95_ms'] - before['p95_ms']:+.2f} мс"
+        print(line)
+    for key in ('backlog', 'drain_seconds', 'replay_rate'):
+        if key in summary:
+            print(f'{key}: {summary[key]}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный прогон моста')
+    parser.add_argument('--url', default='http://127.0.0.1:5001')
+    parser.add_argument('--spawn', action='store_true', help='Запустить мост отдельным процессом')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--scenario', choices=['online', 'backup', 'recovery'], default='online')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--pi-id', default='default_pi')
+    parser.add_argument('--latency', type=float, default=0.01)
+    parser.add_argument('--jitter', type=float, default=0.005)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--drop-rate', type=float, default=0.0)
+    parser.add_argument('--disconnect-every', type=float, default=None)
+    parser.add_argument('--legacy-wire', action='store_true', help='Pi без согласования формата канала')
+    parser.add_argument('--backlog', type=int, default=2000, help='Записей в очереди для сценария recovery')
+    parser.add_argument('--output', help='Сохранить результат в JSON')
+    parser.add_argument('--compare', help='Сравнить с результатом прошлого прогона (JSON)')
+    args = parser.parse_args()
+
+    process = None
+    url = args.url
+    if args.spawn:
+        process, url = spawn_bridge(args.port)
+
+    pi = FakePi(url, args.pi_id, args.latency, args.jitter, args.error_rate, args.drop_rate,
+                args.disconnect_every, MemoryStore(len(GROUPS)), negotiate_wire=not args.legacy_wire)
+    summary = {'scenario': args.scenario, 'concurrency': args.concurrency, 'duration': args.duration}
+    try:
+        recorder = Recorder()
+        if args.scenario == 'online':
+            pi.start()
+            elapsed = run_load(url, args.duration, args.concurrency, recorder)
+        elif args.scenario == 'backup':
+            elapsed = run_load(url, args.duration, args.concurrency, recorder)
+        else:
+            # Копим очередь без Pi, затем подключаем его и нагружаем мост, пока очередь догоняется
+            client = Client(url)
+            rnd = random.Random(1)
+            for _ in range(args.backlog):
+                client.request('POST', '/api/journal/entry', journal_entry(rnd))
+            pi.start()
+            drain = {}
+            waiter = threading.Thread(target=lambda: drain.update(seconds=wait_for_sync(url, args.pi_id, 600)))
+            waiter.start()
+            elapsed = run_load(url, args.duration, args.concurrency, recorder)
+            waiter.join()
+            summary['backlog'] = args.backlog
+            summary['drain_seconds'] = round(drain['seconds'], 2) if drain.get('seconds') else None
+            if summary['drain_seconds']:
+                summary['replay_rate'] = round(args.backlog / summary['drain_seconds'], 1)
+        summary['requests'] = recorder.report(elapsed)
+        summary['fake_pi'] = pi.stats
+    finally:
+        pi.stop()
+        if process:
+            process.terminate()
+            process.wait()
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_report(summary, previous)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
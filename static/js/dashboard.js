@@ -0,0 +1,15 @@
+async function loadGroups() {
+    const response = await fetch('/api/groups');
+    const data = await response.json();
+    
+    if (data.status === 'success') {
+        const groupsHtml = data.data.map(group => 
+            `<div style="padding: 10px; margin: 5px; background: #f8f9fa; border-radius: 3px;">
+                ${group.name} (${group.course})
+            </div>`
+        ).join('');
+        document.getElementById('groups-list').innerHTML = groupsHtml;
+    } else {
+        document.getElementById('groups-list').innerHTML = 'Ошибка загрузки групп';
+    }
+}
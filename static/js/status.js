@@ -0,0 +1,60 @@
+// Статус моста приходит по Socket.IO при изменении; без сокета - условный опрос с ETag
+let statusEtag = null;
+
+function renderStatus(data) {
+    const indicator = document.getElementById('status-indicator');
+    
+    if (data.raspberry_pi_connected) {
+        indicator.innerHTML = '<div class="status-online">✅ База данных подключена</div>';
+    } else {
+        const draining = Object.values(data.pis || {}).find(pi => pi.sync && pi.sync.state === 'draining');
+        const progress = draining ? ` (синхронизация: ${draining.sync.acknowledged} из ${draining.sync.queued})` : '';
+        indicator.innerHTML = `<div class="status-offline">⚠️ Режим резервного копирования${progress}</div>`;
+    }
+}
+
+function renderError() {
+    document.getElementById('status-indicator').innerHTML = 
+        '<div class="status-offline">❌ Ошибка подключения</div>';
+}
+
+async function checkStatus() {
+    try {
+        const headers = statusEtag ? {'If-None-Match': statusEtag} : {};
+        const response = await fetch('/api/status/summary', {headers: headers, cache: 'no-store'});
+        if (response.status === 304) {
+            return;
+        }
+        statusEtag = response.headers.get('ETag');
+        renderStatus(await response.json());
+    } catch (error) {
+        renderError();
+    }
+}
+
+let pollTimer = null;
+
+function startPolling() {
+    if (!pollTimer) {
+        checkStatus();
+        pollTimer = setInterval(checkStatus, 10000);
+    }
+}
+
+function stopPolling() {
+    clearInterval(pollTimer);
+    pollTimer = null;
+}
+
+if (typeof io === 'function') {
+    const socket = io({transports: ['websocket', 'polling']});
+    socket.on('connect', () => {
+        stopPolling();
+        socket.emit('subscribe_status');
+    });
+    socket.on('bridge_status', renderStatus);
+    socket.on('disconnect', startPolling);
+    socket.on('connect_error', startPolling);
+} else {
+    startPolling();
+}
@@ -0,0 +1,149 @@
+"""Формат сообщений канала мост <-> Raspberry Pi.
+
+Формат согласуется при raspberry_connect: Pi сообщает, что умеет
+    {'wire': {'formats': ['msgpack', 'json'], 'compression': ['zlib'], 'columnar': True}}
+мост выбирает вариант и возвращает его в подтверждении подключения. Старая
+прошивка ничего не сообщает и обменивается обычными JSON-объектами, как раньше.
+
+Согласованные сообщения идут кадрами: 1 байт флагов + тело.
+FLAG_MSGPACK - тело в msgpack (иначе JSON в UTF-8), FLAG_ZLIB - тело сжато.
+Кадр уходит бинарным вложением Socket.IO, только если Pi явно предложил
+'binary': True. Клиент python-socketio разбирает сообщения engine.io в
+отдельных потоках, вложения приходят не по порядку и кадр теряется, поэтому
+по умолчанию кадр передается текстом в base64.
+Списки строк-словарей (data, rows, entries...) передаются по столбцам:
+имена полей один раз, дальше только значения.
+
+Модуль используется мостом и имитацией Pi; прошивка Pi может взять его как есть.
+"""
+import base64
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    # Без msgpack бинарные кадры несут JSON, сжатие и столбцы работают
+    msgpack = None
+
+FLAG_ZLIB = 1
+FLAG_MSGPACK = 2
+
+# Меньшие сообщения сжимать дороже, чем передать как есть
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_LEVEL = 6
+
+COLUMNAR_KEY = '_columnar'
+
+
+class FrameError(ValueError):
+    """Кадр поврежден или пришел не целиком"""
+
+
+def supported(binary=False):
+    """Что умеет эта сторона канала, в порядке предпочтения.
+
+    binary - клиент Socket.IO надежно собирает бинарные вложения (не python-socketio)
+    """
+    return {
+        'formats': (['msgpack'] if msgpack else []) + ['json'],
+        'compression': ['zlib'],
+        'columnar': True,
+        'binary': binary
+    }
+
+
+def negotiate(offer, local=None):
+    """Выбирает формат из предложения Pi; None - Pi не поддерживает согласование (старая прошивка)"""
+    if not offer:
+        return None
+    local = local or supported()
+    formats = offer.get('formats') or []
+    chosen = next((f for f in local['formats'] if f in formats), None)
+    if chosen is None:
+        return None
+    return {
+        'format': chosen,
+        'compression': 'zlib' if 'zlib' in (offer.get('compression') or []) else None,
+        'columnar': bool(offer.get('columnar')) and local['columnar'],
+        # Сервер Socket.IO собирает вложения по порядку: решает только клиент
+        'binary': bool(offer.get('binary'))
+    }
+
+
+def to_columnar(message):
+    """Заменяет списки одинаковых словарей на {'columns': [...], 'values': [[...], ...]}.
+
+    Обходит вложенные словари (ответ Pi лежит в message['response']), но не строки списков.
+    """
+    packed = []
+    result = dict(message)
+    for key, value in message.items():
+        if isinstance(value, dict):
+            result[key] = to_columnar(value)
+            continue
+        if not isinstance(value, list) or len(value) < 2 or not isinstance(value[0], dict):
+            continue
+        columns = list(value[0])
+        if not all(isinstance(row, dict) and row.keys() == value[0].keys() for row in value):
+            continue
+        result[key] = {'columns': columns, 'values': [[row[c] for c in columns] for row in value]}
+        packed.append(key)
+    if packed:
+        result[COLUMNAR_KEY] = packed
+    return result
+
+
+def from_columnar(message):
+    packed = message.pop(COLUMNAR_KEY, None) or ()
+    for key, value in message.items():
+        if isinstance(value, dict) and key not in packed:
+            from_columnar(value)
+    for key in packed:
+        columns = message[key]['columns']
+        message[key] = [dict(zip(columns, values)) for values in message[key]['values']]
+    return message
+
+
+class WireCodec:
+    """Кодирует и разбирает сообщения в согласованном формате"""
+
+    def __init__(self, settings, compress_min_bytes=COMPRESS_MIN_BYTES):
+        self.settings = settings
+        self.msgpack = settings['format'] == 'msgpack'
+        self.compression = settings.get('compression') == 'zlib'
+        self.columnar = settings.get('columnar', False)
+        self.binary = settings.get('binary', False)
+        self.compress_min_bytes = compress_min_bytes
+
+    def encode(self, message):
+        if self.columnar:
+            message = to_columnar(message)
+        if self.msgpack:
+            body, flags = msgpack.packb(message, use_bin_type=True), FLAG_MSGPACK
+        else:
+            body, flags = json.dumps(message, ensure_ascii=False, separators=(',', ':')).encode(), 0
+        if self.compression and len(body) >= self.compress_min_bytes:
+            body, flags = zlib.compress(body, COMPRESS_LEVEL), flags | FLAG_ZLIB
+        frame = bytes([flags]) + body
+        return frame if self.binary else base64.b64encode(frame).decode('ascii')
+
+    @staticmethod
+    def decode(frame):
+        # Флаги в кадре: разбор не зависит от согласованных настроек
+        try:
+            if isinstance(frame, str):
+                frame = base64.b64decode(frame, validate=True)
+            flags, body = frame[0], frame[1:]
+            if flags & FLAG_ZLIB:
+                body = zlib.decompress(body)
+            if flags & FLAG_MSGPACK:
+                message = msgpack.unpackb(body, raw=False)
+            else:
+                message = json.loads(body)
+        except (ValueError, IndexError, TypeError, AttributeError, zlib.error) as e:
+            # binascii.Error и ошибки msgpack - подклассы ValueError; AttributeError - msgpack не установлен
+            raise FrameError(f'Поврежденный кадр: {e}') from e
+        if not isinstance(message, dict):
+            raise FrameError('Кадр не содержит сообщения')
+        return from_columnar(message)